@@ -14,9 +14,9 @@ from celery import Celery
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api_config.settings')
 
+# The broker is configured by CELERY_BROKER_URL in the settings.
 app = Celery(
     'api_config',
-    broker='amqp://',
     # backend='amqp://',
     # result_expires=300,
 )
@@ -54,6 +54,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'caviart.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -81,12 +82,33 @@ WSGI_APPLICATION = 'api_config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# PostgreSQL is recommended whenever the API and the workers run on
+# more than one node. Persistent connections (CONN_MAX_AGE) avoid a
+# connection setup per request. SQLite runs in WAL mode (see
+# caviart.apps) and waits up to `timeout` seconds on locks.
+
+if os.environ.get('CAVIART_DB_ENGINE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('CAVIART_DB_NAME', 'caviart'),
+            'USER': os.environ.get('CAVIART_DB_USER', ''),
+            'PASSWORD': os.environ.get('CAVIART_DB_PASSWORD', ''),
+            'HOST': os.environ.get('CAVIART_DB_HOST', ''),
+            'PORT': os.environ.get('CAVIART_DB_PORT', ''),
+            'CONN_MAX_AGE': int(os.environ.get('CAVIART_DB_CONN_MAX_AGE', 600)),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'OPTIONS': {
+                'timeout': 20,
+            },
+        }
     }
-}
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -137,4 +159,125 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
+    # Listings are cursor-paginated; see caviart.pagination
+    'PAGE_SIZE': 100,
 }
+
+# Hand raw file downloads over to the front proxy instead of streaming
+# them from the worker. One of None, 'x-sendfile' (Apache, lighttpd)
+# or 'x-accel-redirect' (nginx). With 'x-accel-redirect', files are
+# redirected to CAVIART_ACCEL_REDIRECT_PREFIX + their path relative to
+# MEDIA_ROOT, which must be an internal location on the proxy.
+CAVIART_SENDFILE = None
+CAVIART_ACCEL_REDIRECT_PREFIX = '/protected/'
+
+# Deduplicate project files through a content-addressed blob store.
+# The blob root must live on the same filesystem as MEDIA_ROOT, as
+# files are hardlinked into project trees.
+CAVIART_DEDUPLICATE = True
+CAVIART_BLOB_ROOT = os.path.join(MEDIA_ROOT, '.blobs')
+
+# Per-project bookkeeping of the tools (e.g. incremental build
+# fingerprints), kept outside of the project trees.
+CAVIART_STATE_ROOT = os.path.join(MEDIA_ROOT, '.state')
+
+# Maximum number of inputs processed concurrently by a tool, by tool
+# name. Tools not listed here use their own `parallelism` attribute.
+CAVIART_TOOL_PARALLELISM = {}
+
+# Limits on operations queued or running at the same time, globally
+# and per project (tools of the same project share its tree).
+CAVIART_MAX_OPERATIONS_IN_FLIGHT = 32
+CAVIART_MAX_OPERATIONS_IN_FLIGHT_PER_PROJECT = 1
+
+# Cache of tool results shared by every project, bounded in bytes and
+# evicted in LRU order. Requires CAVIART_DEDUPLICATE.
+CAVIART_RESULT_CACHE = True
+CAVIART_RESULT_CACHE_ROOT = os.path.join(MEDIA_ROOT, '.results')
+CAVIART_RESULT_CACHE_MAX_SIZE = 10 * 1024 ** 3
+
+# How often (in seconds) the output of running tools is appended to
+# the log of their operation.
+CAVIART_LOG_FLUSH_INTERVAL = 1.0
+
+# Default chunk size and maximum total size of resumable uploads, in
+# bytes. Uploads left without writes for CAVIART_UPLOAD_TTL seconds are
+# deleted by the purge job, which opening an upload dispatches at most
+# every CAVIART_UPLOAD_EXPIRY_INTERVAL seconds.
+CAVIART_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CAVIART_UPLOAD_MAX_SIZE = 4 * 1024 ** 3
+CAVIART_UPLOAD_TTL = 24 * 3600
+CAVIART_UPLOAD_EXPIRY_INTERVAL = 3600
+
+# Archive imports are refused past this many members, or past this
+# total size once extracted, in bytes.
+CAVIART_IMPORT_MAX_FILES = 100000
+CAVIART_IMPORT_MAX_SIZE = 10 * 1024 ** 3
+
+# Opt-in request profiling (see caviart.profiling). Staff can profile a
+# request by sending an X-Caviart-Profile header; a fraction of all
+# requests can also be sampled. The latest profiles are kept in memory
+# and listed at /profiles.
+CAVIART_PROFILING = False
+CAVIART_PROFILING_SAMPLE_RATE = 0.0
+CAVIART_PROFILING_BUFFER_SIZE = 100
+
+# Where dispatched operations run (see caviart.backends): 'celery'
+# (workers behind CELERY_BROKER_URL), 'executor' (a pool of
+# CAVIART_EXECUTOR_WORKERS threads in the API process, no broker
+# needed) or 'eager' (synchronously, for tests and benchmarks).
+CAVIART_TASK_BACKEND = os.environ.get('CAVIART_TASK_BACKEND', 'celery')
+CAVIART_EXECUTOR_WORKERS = 4
+CELERY_BROKER_URL = os.environ.get('CAVIART_BROKER_URL', 'amqp://')
+
+# Resource limits of tools (see Tool.get_limits). Operations running
+# longer than CAVIART_TOOL_TIME_LIMIT seconds are stopped; limits can
+# be set per tool name, e.g. {'fake_clirize': {'time': 600,
+# 'cpu_time': 300, 'memory': 2 * 1024 ** 3}}. Running operations check
+# whether they were canceled every CAVIART_CANCEL_POLL_INTERVAL seconds.
+# CPU time and memory limits are set by running subprocesses through
+# prlimit(1) from util-linux, found at CAVIART_PRLIMIT.
+CAVIART_TOOL_TIME_LIMIT = 3600
+CAVIART_TOOL_LIMITS = {}
+CAVIART_CANCEL_POLL_INTERVAL = 1.0
+CAVIART_PRLIMIT = 'prlimit'
+
+# Operations whose worker is gone are recovered by the scheduler (see
+# caviart.scheduler): queued for more than CAVIART_QUEUED_OPERATION_LEASE
+# seconds, they are planned again; running without a heartbeat (sent
+# every CAVIART_OPERATION_HEARTBEAT_INTERVAL seconds) for more than
+# CAVIART_RUNNING_OPERATION_LEASE seconds, they are marked as crashed.
+CAVIART_QUEUED_OPERATION_LEASE = 3600
+CAVIART_RUNNING_OPERATION_LEASE = 300
+CAVIART_OPERATION_HEARTBEAT_INTERVAL = 30
+
+# Trees of deleted projects are moved to the trash (on the same
+# filesystem as MEDIA_ROOT) and purged in the background, removing at
+# most CAVIART_TRASH_PURGE_RATE files per second.
+CAVIART_TRASH_ROOT = os.path.join(MEDIA_ROOT, '.trash')
+CAVIART_TRASH_PURGE_RATE = 5000
+
+# Largest number of operations accepted by one batch submission.
+CAVIART_MAX_OPERATIONS_PER_BATCH = 1000
+
+# Admission control of new operations (see caviart.admission): caps on
+# the operations planned, queued or running per user and per project,
+# and on the operations waiting to run overall. Submissions over a cap
+# are answered 429 with a Retry-After of CAVIART_ADMISSION_RETRY_AFTER
+# seconds. None disables a cap. The counters live in the default cache
+# (use a shared one, e.g. memcached, with several API processes) and
+# are recounted every CAVIART_ADMISSION_COUNTER_TTL seconds.
+CAVIART_MAX_QUEUED_OPERATIONS = 10000
+CAVIART_MAX_QUEUED_OPERATIONS_PER_USER = 500
+CAVIART_MAX_QUEUED_OPERATIONS_PER_PROJECT = 100
+CAVIART_ADMISSION_RETRY_AFTER = 30
+CAVIART_ADMISSION_COUNTER_TTL = 5
+
+# Operation metrics exposed at /metrics are running totals kept in the
+# default cache (use a shared one with several API processes), which
+# the operations finished meanwhile are added to at most every
+# CAVIART_OPERATION_METRICS_TTL seconds. /metrics is only served to
+# staff users, or to scrapers sending CAVIART_METRICS_TOKEN as a bearer
+# token (Authorization: Bearer <token>); None only allows staff.
+CAVIART_OPERATION_METRICS_TTL = 10
+CAVIART_METRICS_TOKEN = os.environ.get('CAVIART_METRICS_TOKEN')
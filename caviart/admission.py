@@ -0,0 +1,86 @@
+"""Admission control of new operations.
+
+Operations are only accepted while the operations in flight (planned,
+queued or running) stay within a per-user and a per-project cap, and
+the operations waiting to run stay below a global queue depth, so a
+single script cannot bury the queue for every other user. Rejected
+submissions get a 429 answer with a Retry-After header.
+
+The checks read counters from the Django cache instead of counting
+operations on every submission. A counter is recomputed from the
+database (with an indexed count) when it expires, every
+CAVIART_ADMISSION_COUNTER_TTL seconds, and incremented by the
+operations admitted meanwhile, so it may overestimate the load by
+what finished since, but never underestimates it."""
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from rest_framework.exceptions import Throttled
+
+from . import models
+
+
+PENDING_OR_RUNNING = ('P', 'Q', 'R')
+WAITING = ('P', 'Q')
+KEY_PREFIX = 'caviart:admission:'
+
+
+class AdmissionController(object):
+    def __init__(self, cache=None):
+        self.cache = cache or default_cache
+
+    @property
+    def counter_ttl(self):
+        return getattr(settings, 'CAVIART_ADMISSION_COUNTER_TTL', 5)
+
+    @property
+    def retry_after(self):
+        return getattr(settings, 'CAVIART_ADMISSION_RETRY_AFTER', 30)
+
+    def admit(self, user, project_counts):
+        """Admit the operations submitted by `user`, given as {project
+        id: number of new operations}, or raise Throttled."""
+        total = sum(project_counts.values())
+        if not total:
+            return
+
+        checks = [
+            ('queue', 'the server',
+             getattr(settings, 'CAVIART_MAX_QUEUED_OPERATIONS', None), total,
+             lambda: models.Operation.objects.filter(status__in=WAITING)),
+            ('user:%s' % user.pk, 'this user',
+             getattr(settings, 'CAVIART_MAX_QUEUED_OPERATIONS_PER_USER', None), total,
+             lambda: models.Operation.objects.filter(
+                 sent_by_id=user.pk, status__in=PENDING_OR_RUNNING)),
+        ]
+        project_limit = getattr(settings, 'CAVIART_MAX_QUEUED_OPERATIONS_PER_PROJECT', None)
+        for project_id, count in sorted(project_counts.items()):
+            checks.append((
+                'project:%s' % project_id, 'project %s' % project_id,
+                project_limit, count,
+                lambda project_id=project_id: models.Operation.objects.filter(
+                    project_id=project_id, status__in=PENDING_OR_RUNNING)))
+
+        checks = [check for check in checks if check[2] is not None]
+        for key, owner, limit, count, queryset in checks:
+            if self._get(key, queryset) + count > limit:
+                raise Throttled(wait=self.retry_after, detail=(
+                    'Too many operations pending for %s (at most %d).' % (owner, limit)))
+        for key, owner, limit, count, queryset in checks:
+            self._add(key, count)
+
+    def _get(self, key, queryset):
+        value = self.cache.get(KEY_PREFIX + key)
+        if value is None:
+            value = queryset().count()
+            self.cache.add(KEY_PREFIX + key, value, self.counter_ttl)
+        return value
+
+    def _add(self, key, count):
+        try:
+            self.cache.incr(KEY_PREFIX + key, count)
+        except ValueError:
+            pass  # Expired: the next check recounts
+
+
+default_admission_controller = AdmissionController()
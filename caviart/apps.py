@@ -1,5 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Use SQLite in WAL mode, so that API reads and worker writes do
+    not block each other. Busy waits are configured through the
+    `timeout` database option."""
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
 
 
 class CaviartConfig(AppConfig):
     name = 'caviart'
+
+    def ready(self):
+        connection_created.connect(configure_sqlite)
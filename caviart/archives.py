@@ -0,0 +1,264 @@
+"""Import and export of whole project trees as archives.
+
+Archives are never held in memory: tar streams (optionally gzip, bzip2
+or xz compressed) are extracted while they are being received, and zip
+files, which need random access, are spooled to a temporary file on
+disk first. Imports are bounded in member count and total extracted
+size (CAVIART_IMPORT_MAX_FILES and CAVIART_IMPORT_MAX_SIZE); a failed
+import leaves the files extracted so far in place, and reports them so
+they can be registered all the same.
+
+Exports are generated on the fly by a producer thread writing into a
+bounded queue that the response iterates over, so compression overlaps
+with sending and memory use does not depend on the project size."""
+
+import os, queue, shutil, stat, tarfile, tempfile, threading, zipfile
+from glob import escape as glob_escape, iglob as glob
+
+from django.conf import settings
+
+from .tools import atomic_output, is_internal_file
+
+
+COPY_BUFFER_SIZE = 256 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 16
+ZIP_MAGIC = b'PK\x03\x04'
+
+EXPORT_FORMATS = {
+    'zip': 'application/zip',
+    'tar.gz': 'application/gzip',
+}
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _PrefixedStream(object):
+    """Readable stream replaying `prefix` before the rest of `stream`."""
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def safe_member_path(name):
+    """Normalize an archive member name into a path relative to the
+    project root, or return None if it would escape it."""
+    name = name.replace('\\', '/')
+    if name.startswith('/'):
+        return None
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return os.path.join(*parts)
+
+
+class _ImportLimits(object):
+    """Counts the members of an archive and their extracted size
+    against the limits from the settings."""
+    def __init__(self):
+        self.max_files = getattr(settings, 'CAVIART_IMPORT_MAX_FILES', 100000)
+        self.max_size = getattr(settings, 'CAVIART_IMPORT_MAX_SIZE', 10 * 1024 ** 3)
+        self.files = self.size = 0
+
+    def add(self, size):
+        self.files += 1
+        self.size += size
+        if self.files > self.max_files:
+            raise ArchiveError('Archives are limited to %d members.' % self.max_files)
+        if self.size > self.max_size:
+            raise ArchiveError(
+                'Archives are limited to %d bytes once extracted.' % self.max_size)
+
+
+def _write_member(root, path, fileobj):
+    target = os.path.join(root, path)
+    directory = os.path.dirname(target)
+    # Links already in the tree must not lead the member out of it
+    real_root = os.path.realpath(root)
+    if os.path.commonpath([real_root, os.path.realpath(directory)]) != real_root:
+        raise ArchiveError('Cannot extract %s: outside of the project.' % path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with atomic_output(target) as tmp:
+            with open(tmp, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, COPY_BUFFER_SIZE)
+    except OSError as e:
+        # e.g. a file `a` followed by a file `a/b`
+        raise ArchiveError('Cannot extract %s: %s' % (path, e.strerror or e))
+
+
+def _extract_tar(stream, root, paths):
+    limits = _ImportLimits()
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                limits.add(member.size if member.isfile() else 0)
+                path = safe_member_path(member.name)
+                if path is None or not member.isfile():
+                    continue  # Directories are implied; links are not allowed
+                _write_member(root, path, archive.extractfile(member))
+                paths.append(path)
+    except tarfile.TarError as e:
+        raise ArchiveError('Invalid tar archive: %s' % e)
+
+
+def _extract_zip(stream, root, paths):
+    limits = _ImportLimits()
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, COPY_BUFFER_SIZE)
+        spool.seek(0)
+        try:
+            with zipfile.ZipFile(spool) as archive:
+                for member in archive.infolist():
+                    # Reading a member fails if it is longer than declared
+                    limits.add(member.file_size)
+                    path = safe_member_path(member.filename)
+                    if (path is None or member.filename.endswith('/') or
+                            stat.S_ISLNK(member.external_attr >> 16)):
+                        continue  # Links are not allowed either
+                    with archive.open(member) as fileobj:
+                        _write_member(root, path, fileobj)
+                    paths.append(path)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError('Invalid zip archive: %s' % e)
+
+
+def extract_archive(stream, root, paths=None):
+    """Extract the tar or zip archive read from `stream` into `root`.
+    Returns the relative paths of the extracted files, which are also
+    appended to `paths` as they are written, so callers know what was
+    extracted when this raises ArchiveError."""
+    if paths is None:
+        paths = []
+    magic = stream.read(len(ZIP_MAGIC))
+    stream = _PrefixedStream(magic, stream)
+    if magic == ZIP_MAGIC:
+        _extract_zip(stream, root, paths)
+    else:
+        _extract_tar(stream, root, paths)
+    return paths
+
+
+def list_tree(root, pattern=None):
+    """Relative paths of the regular files under `root`, optionally
+    restricted to those matching the recursive glob `pattern`, which
+    must be relative and stay within `root` (ArchiveError otherwise)."""
+    if pattern:
+        parts = pattern.replace('\\', '/').split('/')
+        if os.path.isabs(pattern) or pattern.startswith('/') or '..' in parts:
+            raise ArchiveError('Invalid pattern: %s' % pattern)
+        real_root = os.path.join(os.path.realpath(root), '')
+        matches = glob(os.path.join(glob_escape(root), pattern), recursive=True)
+        paths = (os.path.relpath(path, root) for path in matches
+                 if os.path.isfile(path) and not os.path.islink(path)
+                 and os.path.realpath(path).startswith(real_root))
+    else:
+        paths = (os.path.relpath(os.path.join(dirpath, name), root)
+                 for dirpath, _, names in os.walk(root)
+                 for name in names
+                 if not os.path.islink(os.path.join(dirpath, name)))
+    return sorted(path for path in paths
+                  if not is_internal_file(os.path.basename(path)))
+
+
+class _Canceled(Exception):
+    pass
+
+
+_END = object()
+
+
+class _QueueWriter(object):
+    """Unseekable file-like object handing what is written to it to a
+    consumer thread in chunks, through a bounded queue."""
+    def __init__(self, canceled):
+        self.queue = queue.Queue(STREAM_QUEUE_SIZE)
+        self.canceled = canceled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=None):
+        if self.buffer and error is None:
+            self._put(bytes(self.buffer))
+        self._put(_END if error is None else error)
+
+    def _put(self, item):
+        while True:
+            if self.canceled.is_set():
+                raise _Canceled()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+def _write_archive(fileobj, root, paths, archive_format):
+    if archive_format == 'zip':
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for path in paths:
+                archive.write(os.path.join(root, path), path)
+    else:
+        with tarfile.open(fileobj=fileobj, mode='w|gz') as archive:
+            for path in paths:
+                archive.add(os.path.join(root, path), path, recursive=False)
+
+
+def stream_archive(root, paths, archive_format):
+    """Yield the chunks of an archive of `paths` (relative to `root`)
+    in `archive_format` (one of EXPORT_FORMATS)."""
+    canceled = threading.Event()
+    writer = _QueueWriter(canceled)
+
+    def produce():
+        try:
+            _write_archive(writer, root, paths, archive_format)
+        except _Canceled:
+            return
+        except Exception as e:
+            try:
+                writer.close(e)
+            except _Canceled:
+                pass
+            return
+        try:
+            writer.close()
+        except _Canceled:
+            pass
+
+    producer = threading.Thread(target=produce, name='archive-export')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = writer.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stops the producer if the client went away
+        canceled.set()
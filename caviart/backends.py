@@ -0,0 +1,167 @@
+"""Execution backends of the task queue.
+
+A backend decides where operations run once the scheduler dispatched
+them (see TaskQueue.submit):
+
+* `celery` sends them to Celery workers through the broker configured
+  by CELERY_BROKER_URL.
+* `executor` runs them in a thread pool inside the API process, so a
+  single box needs neither a broker nor workers.
+* `eager` runs them synchronously in the calling thread, which is
+  mostly useful for tests and benchmarks.
+
+The backend is chosen by CAVIART_TASK_BACKEND, either one of the names
+above or the dotted path of a backend class."""
+
+import logging, threading, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from . import trash
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseBackend(object):
+    def run_tool(self, op_id):
+        """Run the queued operation `op_id`. Returns a job id."""
+        raise NotImplementedError
+
+    def run_planned(self):
+        """Dispatch the planned operations that became ready."""
+        raise NotImplementedError
+
+    def purge_trash(self):
+        """Remove the trees moved to the trash (see caviart.trash)."""
+        raise NotImplementedError
+
+
+class CeleryBackend(BaseBackend):
+    def run_tool(self, op_id):
+        from . import tasks
+        return tasks.run_tool.delay(op_id).id
+
+    def run_planned(self):
+        from . import tasks
+        tasks.run_planned.delay()
+
+    def purge_trash(self):
+        from . import tasks
+        tasks.purge_trash.delay()
+
+
+class EagerBackend(BaseBackend):
+    """Runs jobs in the calling thread. Jobs submitted by a running job
+    are run after it returns rather than nested in it, so long chains
+    of operations do not grow the stack."""
+    def __init__(self):
+        self._local = threading.local()
+
+    def run_tool(self, op_id):
+        from .tools import default_task_queue
+        job_id = uuid.uuid4().hex
+        self._submit(default_task_queue.run_operation, op_id)
+        return job_id
+
+    def run_planned(self):
+        from .tools import default_task_queue
+        self._submit(default_task_queue.run_planned)
+
+    def purge_trash(self):
+        self._submit(trash.purge)
+
+    def _submit(self, fn, *args):
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append((fn, args))
+            return
+        self._local.pending = pending = deque([(fn, args)])
+        try:
+            while pending:
+                fn, args = pending.popleft()
+                fn(*args)
+        finally:
+            self._local.pending = None
+
+
+class ExecutorBackend(BaseBackend):
+    """Runs jobs in a pool of CAVIART_EXECUTOR_WORKERS threads of the
+    current process."""
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = getattr(settings, 'CAVIART_EXECUTOR_WORKERS', 4)
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._planned_pending = False
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def run_tool(self, op_id):
+        from .tools import default_task_queue
+        job_id = uuid.uuid4().hex
+        self.executor.submit(self._run, default_task_queue.run_operation, op_id)
+        return job_id
+
+    def run_planned(self):
+        with self._lock:
+            if self._planned_pending:
+                return  # The pending run will see the new operations
+            self._planned_pending = True
+        self.executor.submit(self._run_planned)
+
+    def purge_trash(self):
+        self.executor.submit(self._run, trash.purge)
+
+    def _run_planned(self):
+        from .tools import default_task_queue
+        with self._lock:
+            self._planned_pending = False
+        self._run(default_task_queue.run_planned)
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Background job %s%r failed", fn.__name__, args)
+        finally:
+            # Pool threads own their database connections
+            connection.close()
+
+
+BACKENDS = {
+    'celery': CeleryBackend,
+    'executor': ExecutorBackend,
+    'eager': EagerBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """The backend called `name`, by default CAVIART_TASK_BACKEND. A
+    single instance of each backend is created per process. Unknown
+    names raise ImproperlyConfigured."""
+    if name is None:
+        name = getattr(settings, 'CAVIART_TASK_BACKEND', 'celery')
+    with _backends_lock:
+        if name not in _backends:
+            try:
+                cls = BACKENDS[name] if name in BACKENDS else import_string(name)
+            except ImportError as e:
+                raise ImproperlyConfigured(
+                    "Unknown CAVIART_TASK_BACKEND %r: %s" % (name, e))
+            _backends[name] = cls()
+        return _backends[name]
@@ -21,4 +21,4 @@ class IsOwnerFilterBackend(filters.BaseFilterBackend):
         if request.user.is_authenticated():
             return queryset.for_owner(request.user)
         else:
-            return []
+            return queryset.none()
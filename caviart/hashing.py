@@ -0,0 +1,23 @@
+"""Content hashing helpers.
+
+Every stored file is identified by the SHA-256 of its contents, which
+is used both for HTTP validators and for content-addressed storage."""
+
+import hashlib
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_fileobj(f, chunk_size=HASH_CHUNK_SIZE):
+    """Return the hex SHA-256 of a file-like object, reading it in
+    chunks from its current position."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256_file(path, chunk_size=HASH_CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        return sha256_fileobj(f, chunk_size)
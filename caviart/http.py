@@ -0,0 +1,195 @@
+"""HTTP helpers for serving project files.
+
+Files are never read into memory as a whole: they are either streamed
+in fixed-size chunks or, when configured, handed over to the front
+proxy through X-Sendfile / X-Accel-Redirect.
+
+Conditional requests (If-None-Match / If-Modified-Since) are answered
+from the validators stored in the database, so a 304 never needs to
+open the file."""
+
+import calendar, os, re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class UnsatisfiableRange(Exception):
+    pass
+
+
+def quote_etag(etag):
+    return '"%s"' % etag
+
+
+def _parse_etags(header):
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def _weak_match(header, etag):
+    """Weak comparison as required for If-None-Match (RFC 7232 2.3.2)."""
+    quoted = quote_etag(etag)
+    for tag in _parse_etags(header):
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == quoted:
+            return True
+    return False
+
+
+def _timestamp(last_modified):
+    return calendar.timegm(last_modified.utctimetuple())
+
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """Return a 304 response if the request validators match, None
+    otherwise. If-None-Match takes precedence over If-Modified-Since."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if etag is None or not _weak_match(if_none_match, etag):
+            return None
+    else:
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since is None or last_modified is None:
+            return None
+        if _timestamp(last_modified) > if_modified_since:
+            return None
+
+    response = HttpResponse(status=304)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(_timestamp(last_modified))
+    return response
+
+
+def file_chunks(path, start=0, length=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield `length` bytes of the file at `path` starting at offset
+    `start`, at most `chunk_size` bytes at a time. The file is only
+    opened once the response starts being consumed."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            to_read = chunk_size if remaining is None else min(chunk_size, remaining)
+            data = f.read(to_read)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+def parse_range_header(header, size):
+    """Parse a single-range `Range` header into an inclusive (start,
+    end) pair.
+
+    Returns None when the header is absent or is not something we
+    serve partially (e.g. multiple ranges), in which case the whole
+    file must be sent. Raises UnsatisfiableRange when the range lies
+    outside the file."""
+    if not header:
+        return None
+    match = RANGE_RE.match(header)
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+
+    if not first:
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise UnsatisfiableRange()
+        return (max(size - suffix, 0), size - 1)
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise UnsatisfiableRange()
+    return (start, min(end, size - 1))
+
+
+def _sendfile_response(path, content_type):
+    mode = getattr(settings, 'CAVIART_SENDFILE', None)
+    if not mode:
+        return None
+
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-sendfile':
+        response['X-Sendfile'] = path
+    elif mode == 'x-accel-redirect':
+        relpath = os.path.relpath(path, settings.MEDIA_ROOT)
+        prefix = getattr(settings, 'CAVIART_ACCEL_REDIRECT_PREFIX', '/protected/')
+        # A URI: nginx decodes it, so names with spaces, '%', '?' or
+        # non-ASCII characters are served as they are
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(relpath)
+    else:
+        raise ValueError("Unknown CAVIART_SENDFILE mode %r" % mode)
+    return response
+
+
+def serve_file(request, path, content_type, etag=None,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    """Build a response for the file at `path` honoring `Range`
+    requests. Supports handing the transfer to the front proxy when
+    settings.CAVIART_SENDFILE is set.
+
+    When `etag` is given, a Range request carrying a non-matching
+    If-Range gets the full file, as the client copy is stale."""
+    response = _sendfile_response(path, content_type)
+    if response is not None:
+        return response
+
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and (etag is None or if_range.strip() != quote_etag(etag)):
+        range_header = None
+
+    size = os.path.getsize(path)
+    try:
+        byte_range = parse_range_header(range_header, size)
+    except UnsatisfiableRange:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if byte_range is None:
+        response = StreamingHttpResponse(
+            file_chunks(path, chunk_size=chunk_size),
+            content_type=content_type,
+        )
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            file_chunks(path, start, length, chunk_size=chunk_size),
+            content_type=content_type,
+            status=206,
+        )
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,75 @@
+"""Input fingerprints for incremental tool execution.
+
+For every (project, tool) pair we persist the fingerprint of each
+input file (size, mtime and SHA-256) as of its last successful
+processing. An input only needs to be rebuilt when its fingerprint
+changed or one of its outputs is missing.
+
+Fingerprints are only trusted for the same tool signature (version and
+parameters); changing either invalidates every recorded input."""
+
+import json, os
+
+from . import hashing
+
+
+class FingerprintStore(object):
+    def __init__(self, path, signature, root):
+        self.path = path
+        self.signature = signature
+        self.root = root
+        self.files = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if state.get('signature') == self.signature:
+            self.files = state.get('files', {})
+
+    def save(self):
+        # Imported here: tools imports this module
+        from .tools import atomic_output
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_output(self.path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump({'signature': self.signature, 'files': self.files}, f)
+
+    def fingerprint(self, path, previous=None):
+        """Fingerprint of the file at `path` (relative to the root).
+        The contents are only hashed when size or mtime differ from
+        `previous`."""
+        path = os.path.join(self.root, path)
+        st = os.stat(path)
+        if previous and previous[0] == st.st_size and previous[1] == st.st_mtime_ns:
+            return previous
+        return [st.st_size, st.st_mtime_ns, hashing.sha256_file(path)]
+
+    def is_up_to_date(self, path, outputs=()):
+        previous = self.files.get(path)
+        if previous is None:
+            return False
+        if not all(os.path.exists(os.path.join(self.root, output))
+                   for output in outputs):
+            return False
+        current = self.fingerprint(path, previous)
+        if current[2] != previous[2]:
+            return False
+        # Touched but unchanged: remember the new mtime to avoid
+        # hashing it again next time.
+        self.files[path] = current
+        return True
+
+    def record(self, path):
+        self.files[path] = self.fingerprint(path, self.files.get(path))
+
+    def forget_missing(self, paths):
+        """Drop inputs that no longer exist (not in `paths`)."""
+        existing = set(paths)
+        for path in list(self.files):
+            if path not in existing:
+                del self.files[path]
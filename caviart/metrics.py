@@ -0,0 +1,323 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Metrics are plain counters and histograms guarded by a lock, so
+observing a value costs a dictionary lookup and a few additions.
+
+Operations usually run in other processes (the Celery workers), so
+their metrics are not observed where they run. Instead, running totals
+are kept in the Django cache, shared by every API process, and the
+operations finished since they were last updated are added to them
+from the timestamps and durations stored on the operations (see
+OperationCollector). Whichever process gets scraped thus exposes the
+same operation metrics.
+
+The metrics are only served to staff users, or to scrapers sending
+CAVIART_METRICS_TOKEN as a bearer token."""
+
+import bisect, hmac, threading, time
+from datetime import timedelta
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.db.models import Case, Count, Sum, When
+from django.http import HttpResponse
+from django.utils import timezone
+
+from . import models
+from .profiling import _is_staff
+from .resultcache import default_result_cache
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def replace(self, values):
+        """Replace every value by `values`, {label values: value}. The
+        values of a counter must never decrease."""
+        with self._lock:
+            self._values = defaultdict(float, values)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._counts.get(label_values)
+            if counts is None:
+                counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[label_values] += value
+
+    def replace(self, values):
+        """Replace every observation by `values`, {label values:
+        (cumulative counts of each bucket then +Inf, sum)}."""
+        counts, sums = {}, defaultdict(float)
+        for label_values, (cumulative, total) in values.items():
+            counts[label_values] = [count - previous for count, previous
+                                    in zip(cumulative, [0] + cumulative[:-1])]
+            sums[label_values] = total or 0.0
+        with self._lock:
+            self._counts, self._sums = counts, sums
+
+    def samples(self):
+        with self._lock:
+            counts = {key: list(value) for key, value in self._counts.items()}
+            sums = dict(self._sums)
+        for label_values, bucket_counts in sorted(counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), bucket_counts):
+                cumulative += count
+                yield (self.name + '_bucket' +
+                       _format_labels(self.labels, label_values, [('le', bound)]),
+                       cumulative)
+            yield self.name + '_sum' + _format_labels(self.labels, label_values), sums[label_values]
+            yield self.name + '_count' + _format_labels(self.labels, label_values), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """`collector` is called before every scrape."""
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'caviart_request_duration_seconds',
+    'Latency of API requests by viewset action.',
+    labels=('viewset', 'action', 'method')))
+
+operations_finished = registry.register(Counter(
+    'caviart_operations_finished_total',
+    'Operations finished, by tool and final status.',
+    labels=('tool', 'status')))
+
+operation_queue_wait = registry.register(Histogram(
+    'caviart_operation_queue_wait_seconds',
+    'Time from queuing to start of operations, by tool.',
+    labels=('tool',)))
+
+operation_phase_duration = registry.register(Histogram(
+    'caviart_operation_phase_duration_seconds',
+    'Duration of each phase of operations (tool, registration, save), by tool.',
+    labels=('tool', 'phase')))
+
+
+class OperationCollector(object):
+    """Keeps running totals of the operation metrics in the cache. At
+    most every CAVIART_OPERATION_METRICS_TTL seconds, one process adds
+    to them the operations that finished since the last refresh, past a
+    `finished_at` watermark, so a refresh costs the same whatever the
+    number of operations in the database.
+
+    Operations that finished less than SETTLE_TIME seconds ago are left
+    for a later refresh, as their rows may not be committed yet. The
+    totals never decrease, even when operations are deleted; if the
+    cache loses them, they are rebuilt from every operation still in
+    the database, which scrapers see as a counter reset."""
+    CACHE_KEY = 'caviart:metrics:operations'
+    REFRESH_KEY = 'caviart:metrics:operations:refresh'
+    PHASES = ('tool', 'registration', 'save')
+    SETTLE_TIME = 60
+
+    def __init__(self, cache=None):
+        self.cache = cache or default_cache
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CAVIART_OPERATION_METRICS_TTL', 10)
+
+    def __call__(self):
+        totals = self.cache.get(self.CACHE_KEY)
+        # Only one process refreshes the totals at a time
+        if self.cache.add(self.REFRESH_KEY, True, self.ttl):
+            totals = self.refresh(totals)
+            self.cache.set(self.CACHE_KEY, totals, None)
+        if totals is None:
+            return
+        operations_finished.replace(totals['finished'])
+        operation_queue_wait.replace(totals['queue_wait'])
+        operation_phase_duration.replace(totals['phases'])
+
+    def refresh(self, totals=None):
+        """Return `totals` plus the operations finished since its
+        watermark (every operation when `totals` is None)."""
+        if totals is None:
+            totals = {'watermark': None, 'finished': {}, 'queue_wait': {}, 'phases': {}}
+        until = timezone.now() - timedelta(seconds=self.SETTLE_TIME)
+        if totals['watermark'] is not None and totals['watermark'] >= until:
+            return totals
+
+        finished, queue_wait, phases = self.aggregate(totals['watermark'], until)
+        for key, count in finished.items():
+            totals['finished'][key] = totals['finished'].get(key, 0) + count
+        _add_histograms(totals['queue_wait'], queue_wait)
+        _add_histograms(totals['phases'], phases)
+        totals['watermark'] = until
+        return totals
+
+    def aggregate(self, since, until):
+        """Metrics of the operations finished after `since` (if not
+        None) and up to `until`."""
+        operations = models.Operation.objects.filter(finished_at__lte=until)
+        if since is not None:
+            operations = operations.filter(finished_at__gt=since)
+        finished = {
+            (row['type'], row['status']): row['count']
+            for row in operations.values('type', 'status')
+                                 .annotate(count=Count('pk')).order_by()
+        }
+        queue_wait = self._histogram(operations, 'queue_duration',
+                                     operation_queue_wait.buckets)
+        phases = {}
+        for phase in self.PHASES:
+            histogram = self._histogram(operations, phase + '_duration',
+                                        operation_phase_duration.buckets)
+            for (tool,), value in histogram.items():
+                phases[(tool, phase)] = value
+        return finished, queue_wait, phases
+
+    def _histogram(self, operations, field, buckets):
+        """{(tool,): (cumulative bucket counts, sum)} of `field` over
+        `operations`, in one query."""
+        bucket_counts = {
+            'le%d' % index: Count(Case(When(then=1, **{field + '__lte': bound})))
+            for index, bound in enumerate(buckets)
+        }
+        rows = (operations.filter(**{field + '__isnull': False})
+                .values('type')
+                .annotate(count=Count('pk'), sum=Sum(field), **bucket_counts)
+                .order_by())
+        return {
+            (row['type'],): ([row['le%d' % index] for index in range(len(buckets))] +
+                             [row['count']], row['sum'] or 0.0)
+            for row in rows
+        }
+
+
+def _add_histograms(totals, values):
+    """Add the histogram `values` to `totals`, both as returned by
+    OperationCollector._histogram."""
+    for key, (cumulative, total) in values.items():
+        if key in totals:
+            previous, previous_total = totals[key]
+            cumulative = [a + b for a, b in zip(previous, cumulative)]
+            total += previous_total
+        totals[key] = (cumulative, total)
+
+
+result_cache_stats = registry.register(Gauge(
+    'caviart_result_cache',
+    'Result cache counters (hits, misses, entries, size in bytes).',
+    labels=('stat',)))
+
+
+def collect_result_cache_stats():
+    if not default_result_cache.enabled:
+        return
+    for stat, value in default_result_cache.stats().items():
+        result_cache_stats.set(value, stat)
+
+
+registry.add_collector(OperationCollector())
+registry.add_collector(collect_result_cache_stats)
+
+
+class InstrumentedViewMixin(object):
+    """Records the latency of every request to a viewset action."""
+    def initial(self, request, *args, **kwargs):
+        self._metrics_started = time.monotonic()
+        super(InstrumentedViewMixin, self).initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        started = getattr(self, '_metrics_started', None)
+        if started is not None:
+            request_duration.observe(
+                time.monotonic() - started, self.__class__.__name__,
+                getattr(self, 'action', None) or '', request.method)
+        return super(InstrumentedViewMixin, self).finalize_response(
+            request, response, *args, **kwargs)
+
+
+def _is_scraper(request):
+    token = getattr(settings, 'CAVIART_METRICS_TOKEN', None)
+    if not token:
+        return False
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return hmac.compare_digest(authorization.encode('utf-8'),
+                               ('Bearer ' + token).encode('utf-8'))
+
+
+def metrics_view(request):
+    if not (_is_scraper(request) or _is_staff(request)):
+        return HttpResponse('Forbidden.\n', status=403, content_type='text/plain')
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import caviart.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Operation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('fake_clirize', 'fake_clirize')], max_length=40)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(choices=[('P', 'Planned'), ('Q', 'Queued'), ('R', 'Running'), ('F', 'Finished'), ('X', 'Crashed'), ('C', 'Canceled'), ('CD', 'Canceled due to dependencies')], max_length=10)),
+                ('log', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Project',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProjectFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('file_type', models.CharField(max_length=80)),
+                ('last_mod', models.DateTimeField(auto_now=True)),
+                ('content', models.FileField(upload_to=caviart.models.get_file_storage)),
+                ('content_hash', models.CharField(blank=True, editable=False, max_length=64)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='caviart.Project')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='caviart.Project'),
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='sent_by',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='triggered_by',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='caviart.Operation'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='projectfile',
+            unique_together=set([('project', 'path')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='projectfile',
+            index_together=set([('project', 'last_mod')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='operation',
+            index_together=set([('project', 'status', 'sent_at'), ('status', 'sent_at')]),
+        ),
+    ]
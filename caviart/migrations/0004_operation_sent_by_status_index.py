@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('caviart', '0003_operation_timing'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='operation',
+            index_together=set([('project', 'status', 'sent_at'), ('status', 'sent_at'), ('sent_by', 'status')]),
+        ),
+    ]
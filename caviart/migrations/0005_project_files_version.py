@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caviart', '0004_operation_sent_by_status_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='files_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='files_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caviart', '0005_project_files_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operation',
+            name='queue_duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caviart', '0007_operation_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operation',
+            name='batch',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -1,14 +1,20 @@
 from __future__ import absolute_import, unicode_literals
 
-import os, shutil, uuid
+import logging, mimetypes, os, uuid
+from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.db import models
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 from six import python_2_unicode_compatible
-from . import tasks, tools
+from . import hashing, tools, trash
+from .backends import get_backend
+from .storage import default_blob_store
+
+
+logger = logging.getLogger(__name__)
 
 
 class OwningQuerySet(models.QuerySet):
@@ -24,38 +30,99 @@ class OwningQuerySet(models.QuerySet):
     pass
 
 
+def _delete_project_rows(queryset, project):
+    """Delete the rows of `queryset`'s model belonging to `project` in
+    one statement, without loading them nor sending signals. Returns
+    how many rows were deleted."""
+    field = queryset.model._meta.get_field('project')
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM %s WHERE %s = %%s' % (
+                connection.ops.quote_name(queryset.model._meta.db_table),
+                connection.ops.quote_name(field.column)),
+            [field.get_db_prep_value(project.pk, connection)])
+        return cursor.rowcount
+
+
 @python_2_unicode_compatible
 class Project(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL)
 
+    # Bumped by every write to the files of the project, so listings of
+    # them can be validated without scanning them.
+    files_version = models.PositiveIntegerField(default=0)
+    files_changed_at = models.DateTimeField(null=True, blank=True)
+
     objects = OwningQuerySet.as_manager()
 
     OWNER_FIELD = 'owner'
 
+    def is_owner(self, user):
+        return self.owner_id == user.pk
+
     def get_project_root(self):
         return os.path.join(settings.MEDIA_ROOT, self.id.hex)
 
+    def get_state_root(self):
+        """Directory for the bookkeeping of tools on this project, kept
+        outside of the project tree."""
+        state_root = getattr(settings, 'CAVIART_STATE_ROOT',
+                             os.path.join(settings.MEDIA_ROOT, '.state'))
+        return os.path.join(state_root, self.id.hex)
+
     def __str__(self):
         return ("project-%s" % self.id)
 
-@receiver(pre_save, sender=Project)
-def create_dir_on_project_creation(sender, instance, **kwargs):
-    os.mkdir(instance.get_project_root(), mode=0o775)
+def files_changed(project_id):
+    """Record a change to the files of the project `project_id`."""
+    Project.objects.filter(pk=project_id).update(
+        files_version=models.F('files_version') + 1,
+        files_changed_at=timezone.now())
+
+@receiver(post_save, sender=Project)
+def create_dir_on_project_creation(sender, instance, created, **kwargs):
+    if created:
+        os.makedirs(instance.get_project_root(), mode=0o775, exist_ok=True)
 
 @receiver(pre_delete, sender=Project)
-def remove_dir_recursively_on_project_deletion(sender, instance, **kwargs):
-    shutil.rmtree(instance.get_project_root())
+def trash_dir_on_project_deletion(sender, instance, **kwargs):
+    # The whole tree goes at once; see the drop_project methods of
+    # ProjectFile and Operation to also skip the cascade over them.
+    def move_to_trash():
+        trash.move_to_trash(instance.get_project_root())
+        trash.move_to_trash(instance.get_state_root())
+        get_backend().purge_trash()
+    transaction.on_commit(move_to_trash)
+
+
+class OperationQuerySet(OwningQuerySet):
+    def drop_project(self, project):
+        """Delete the operations of `project` without loading them, as
+        their logs may be huge (the self-referencing triggered_by keeps
+        the cascade from deleting them without fetching them). Only
+        meant for projects being deleted. Returns how many rows of the
+        project were deleted."""
+        # Operations of other projects triggered by these are deleted
+        # as the cascade would; there are few, if any
+        self.filter(triggered_by__project=project).exclude(project=project).delete()
+        # Databases checking foreign keys on every row (MySQL) would
+        # refuse to delete a trigger before its dependents
+        self.filter(project=project, triggered_by__isnull=False).update(triggered_by=None)
+        return _delete_project_rows(self, project)
 
 
 class Operation(models.Model):
     STATUS_CHOICES = (('P', 'Planned'),
+                      ('Q', 'Queued'),
                       ('R', 'Running'),
                       ('F', 'Finished'),
                       ('X', 'Crashed'),
                       ('C', 'Canceled'),
                       ('CD', 'Canceled due to dependencies'),
     )
+    TERMINAL_STATUSES = ('F', 'X', 'C', 'CD')
 
     type = models.CharField(
         max_length=40,
@@ -68,11 +135,40 @@ class Operation(models.Model):
     status = models.CharField(choices=STATUS_CHOICES, max_length=10)
     log = models.TextField(null=True, blank=True)
 
+    # Lifecycle timestamps and per-phase durations (in seconds)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by the worker while the operation runs (see
+    # OperationWatchdog), so runs whose worker died can be told apart
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    queue_duration = models.FloatField(null=True, blank=True)
+    tool_duration = models.FloatField(null=True, blank=True)
+    registration_duration = models.FloatField(null=True, blank=True)
+    save_duration = models.FloatField(null=True, blank=True)
+    # Operations submitted together (see OperationViewSet.batch)
+    batch = models.UUIDField(null=True, blank=True, editable=False, db_index=True)
+
+    objects = OperationQuerySet.as_manager()
+
+    OWNER_FIELD = 'project__' + Project.OWNER_FIELD
+
+    def is_owner(self, user):
+        return self.project.is_owner(user)
+
+    class Meta:
+        index_together = (
+            ('project', 'status', 'sent_at'),  # operations of a project
+            ('status', 'sent_at'),             # scheduler
+            ('sent_by', 'status'),             # admission control
+        )
+
 @receiver(post_save, sender=Operation)
 def send_operation_to_queue_if_planned(sender, instance, **kwargs):
     if instance.status == Operation.STATUS_CHOICES[0][0]:
-        print("Run task on planned update for ", instance)
-        tasks.run_tool.delay(instance.pk)
+        logger.debug("Schedule planned operations on update for %s", instance)
+        # Workers must see the operation once they get the message
+        transaction.on_commit(tools.default_task_queue.submit_planned)
 
 
 def get_file_storage(instance, filename):
@@ -86,6 +182,161 @@ def get_file_storage(instance, filename):
     return os.path.join(project, path)
 
 
+def guess_file_type(path, default='text/plain'):
+    return mimetypes.guess_type(path)[0] or default
+
+
+def _stat_paths(root, paths):
+    """Stat every relative path in `paths` under `root` with a single
+    os.scandir walk, descending only into directories that lead to one
+    of them. Returns {path: stat_result} for the paths found."""
+    wanted = set(paths)
+    wanted_dirs = set()
+    for path in wanted:
+        parent = os.path.dirname(path)
+        while parent and parent not in wanted_dirs:
+            wanted_dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+    stats = {}
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, reldir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            if relpath in wanted_dirs and entry.is_dir(follow_symlinks=False):
+                pending.append(relpath)
+            elif relpath in wanted:
+                stats[relpath] = entry.stat(follow_symlinks=False)
+    return stats
+
+
+class ProjectFileQuerySet(OwningQuerySet):
+    BATCH_SIZE = 100
+
+    def drop_project(self, project):
+        """Delete the rows of every file of `project` in one statement,
+        without sending pre_delete for each file (which unlinks it).
+        Only meant for projects being deleted, whose tree goes to the
+        trash as a whole. Returns how many rows were deleted."""
+        return _delete_project_rows(self, project)
+
+    def register_paths(self, project, paths, file_type=None):
+        """Create or refresh the rows for files already written to
+        `paths` (relative to the project root) in one transaction.
+        New rows get `file_type`, or the type guessed from their name.
+
+        Existing rows are prefetched, missing ones are bulk-created and
+        then every row gets its on-disk mtime and content hash with one
+        UPDATE per batch. Blobs of the replaced contents are released
+        after commit. Paths that do not exist on disk are ignored.
+        Returns the list of registered paths."""
+        root = project.get_project_root()
+        stats = _stat_paths(root, paths)
+        paths = sorted(stats)
+
+        values = {}
+        for path in paths:
+            digest = hashing.sha256_file(os.path.join(root, path))
+            default_blob_store.ingest(os.path.join(root, path), digest)
+            values[path] = (
+                datetime.fromtimestamp(stats[path].st_mtime, timezone.utc),
+                digest,
+                os.path.join(project.id.hex, path),
+            )
+
+        with transaction.atomic():
+            existing = {}
+            for batch in _batches(paths, self.BATCH_SIZE):
+                existing.update(self.filter(project=project, path__in=batch)
+                                .values_list('path', 'content_hash'))
+
+            self.bulk_create([
+                ProjectFile(project=project, path=path,
+                            file_type=file_type or guess_file_type(path),
+                            content=values[path][2])
+                for path in paths if path not in existing
+            ], batch_size=self.BATCH_SIZE)
+
+            # bulk_create stamps last_mod with auto_now, so every row
+            # gets its actual mtime here.
+            for batch in _batches(paths, self.BATCH_SIZE):
+                self.filter(project=project, path__in=batch).update(
+                    last_mod=_case_by_path(batch, values, 0, models.DateTimeField()),
+                    content_hash=_case_by_path(batch, values, 1, models.CharField()),
+                    content=_case_by_path(batch, values, 2, models.CharField()),
+                )
+            if paths:
+                files_changed(project.pk)
+
+            # The files were replaced, so the blobs of their previous
+            # contents may not be referenced anymore
+            replaced = set(digest for path, digest in existing.items()
+                           if digest and digest != values[path][1])
+            def release_replaced():
+                for digest in replaced:
+                    default_blob_store.release(digest)
+            transaction.on_commit(release_replaced)
+        return paths
+
+    def unregister_paths(self, project, paths):
+        """Delete the rows of the files at `paths`, which are no longer
+        on disk, with one DELETE per batch and without sending signals
+        for each file. Blobs of their contents are released after
+        commit. Returns how many rows were deleted."""
+        deleted, digests = 0, set()
+        with transaction.atomic():
+            for batch in _batches(sorted(paths), self.BATCH_SIZE):
+                rows = self.filter(project=project, path__in=batch)
+                digests.update(digest for digest in
+                               rows.values_list('content_hash', flat=True) if digest)
+                deleted += rows._raw_delete(rows.db)
+            if deleted:
+                files_changed(project.pk)
+
+            def release_deleted():
+                for digest in digests:
+                    default_blob_store.release(digest)
+            transaction.on_commit(release_deleted)
+        return deleted
+
+    def remove_paths(self, project, paths):
+        """Delete the files at `paths` from the project tree after
+        commit, and their rows as unregister_paths does. Returns how
+        many rows were deleted."""
+        root = project.get_project_root()
+        def unlink_files():
+            for path in paths:
+                try:
+                    os.unlink(os.path.join(root, path))
+                except FileNotFoundError:
+                    pass  # Removed by a tool or by hand
+
+        with transaction.atomic():
+            # Registered first, so the blobs of the files are released
+            # once they are unlinked
+            transaction.on_commit(unlink_files)
+            return self.unregister_paths(project, paths)
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _case_by_path(paths, values, index, output_field):
+    return models.Case(
+        *[models.When(path=path, then=models.Value(values[path][index],
+                                                   output_field=output_field))
+          for path in paths],
+        output_field=output_field
+    )
+
+
 @python_2_unicode_compatible
 class ProjectFile(models.Model):
     project = models.ForeignKey(Project, related_name='files')
@@ -93,30 +344,154 @@ class ProjectFile(models.Model):
     file_type = models.CharField(max_length=80)
     last_mod = models.DateTimeField(auto_now=True)
     content = models.FileField(upload_to=get_file_storage)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
 
     def natural_key(self):
         return (self.project, self.path)
 
+    def is_owner(self, user):
+        return self.project.is_owner(user)
+
+    def get_etag(self):
+        """Strong validator for the raw contents of the file."""
+        return self.content_hash or None
+
     def verified(self):
         # FIXME check last_mod dates
-        if self.verification_file_set.count() > 0:
-            return all([file.verified() for file in self.verification_file_set.all()])
-        return False
+        files = list(self.verification_file_set.all())
+        return bool(files) and all(file.verified() for file in files)
 
     def __str__(self):
         return ("file %s (%s) in %s" % (self.path, self.file_type, self.project))
 
-    objects = OwningQuerySet.as_manager()
+    objects = ProjectFileQuerySet.as_manager()
 
     OWNER_FIELD = 'project__' + Project.OWNER_FIELD
 
     class Meta:
         unique_together = (('project', 'path'),) # natural key
+        index_together = (('project', 'last_mod'),)
+
+@receiver(pre_save, sender=ProjectFile)
+def compute_content_hash_on_save(sender, instance, **kwargs):
+    if not instance.content:
+        return
+
+    committed = instance.content._committed
+    instance.content.seek(0)
+    instance.content_hash = hashing.sha256_fileobj(instance.content)
+    if committed:
+        instance.content.close()
+    else:
+        # Leave uncommitted uploads ready to be written by the storage
+        instance.content.seek(0)
+
+@receiver(post_save, sender=ProjectFile)
+def deduplicate_file_on_save(sender, instance, **kwargs):
+    if instance.content and instance.content_hash:
+        default_blob_store.ingest(instance.content.path, instance.content_hash)
+
+@receiver(post_save, sender=ProjectFile)
+@receiver(post_delete, sender=ProjectFile)
+def record_file_change(sender, instance, **kwargs):
+    files_changed(instance.project_id)
 
 @receiver(pre_delete, sender=ProjectFile)
 def really_remove_file_on_database_deletion(sender, instance, **kwargs):
-    os.unlink(os.path.join(
-        instance.project.get_project_root(),
-        instance.path
+    try:
+        os.unlink(os.path.join(
+            instance.project.get_project_root(),
+            instance.path
+            )
         )
-    )
+    except FileNotFoundError:
+        pass # Removed by a tool or by hand
+    default_blob_store.release(instance.content_hash)
+
+
+class UploadSessionQuerySet(OwningQuerySet):
+    def purge_expired(self, ttl=None):
+        """Delete the sessions whose partial file was not written to
+        for `ttl` seconds (settings.CAVIART_UPLOAD_TTL by default), with
+        their partial files. Returns how many were deleted."""
+        if ttl is None:
+            ttl = getattr(settings, 'CAVIART_UPLOAD_TTL', 24 * 3600)
+        cutoff = timezone.now() - timedelta(seconds=ttl)
+
+        expired = []
+        for session in self.filter(created_at__lt=cutoff).select_related('project'):
+            try:
+                written = datetime.fromtimestamp(
+                    os.stat(session.get_partial_path()).st_mtime, timezone.utc)
+            except FileNotFoundError:
+                written = None  # Committed meanwhile, or lost
+            if written is None or written < cutoff:
+                expired.append(session.pk)
+
+        deleted = 0
+        for batch in _batches(expired, ProjectFileQuerySet.BATCH_SIZE):
+            _, counts = self.filter(pk__in=batch).delete()
+            deleted += counts.get(self.model._meta.label, 0)
+        return deleted
+
+
+class UploadSession(models.Model):
+    """A resumable upload of a single file, sent in numbered chunks of
+    `chunk_size` bytes (the last one may be shorter).
+
+    Chunks are written in place into a hidden partial file next to the
+    final path, which is moved over it on commit. Sessions left without
+    writes for CAVIART_UPLOAD_TTL seconds are deleted by the purge job
+    (see trash.purge)."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    project = models.ForeignKey(Project, related_name='uploads')
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    checksum = models.CharField(max_length=64, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = UploadSessionQuerySet.as_manager()
+
+    OWNER_FIELD = 'project__' + Project.OWNER_FIELD
+
+    def is_owner(self, user):
+        return self.project.is_owner(user)
+
+    def get_partial_path(self):
+        directory, name = os.path.split(self.path)
+        return os.path.join(self.project.get_project_root(), directory,
+                            '.%s.%s.upload' % (name, self.id.hex))
+
+    def get_chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def get_chunk_length(self, index):
+        if index == self.get_chunk_count() - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+@receiver(post_save, sender=UploadSession)
+def create_partial_file_on_upload_creation(sender, instance, created, **kwargs):
+    if created:
+        partial = instance.get_partial_path()
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(partial, 'wb') as f:
+            f.truncate(instance.size)
+
+@receiver(pre_delete, sender=UploadSession)
+def remove_partial_file_on_upload_deletion(sender, instance, **kwargs):
+    try:
+        os.unlink(instance.get_partial_path())
+    except FileNotFoundError:
+        pass # Already committed
+
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, related_name='chunks')
+    index = models.IntegerField()
+    checksum = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = (('session', 'index'),)
@@ -0,0 +1,83 @@
+"""Incremental operation logs.
+
+While a tool runs, whatever it logs is buffered by an OperationLog and
+appended to `Operation.log` in the database every `flush_interval`
+seconds by a single background thread, so clients can follow the
+output of long analyses (see OperationViewSet.log) instead of waiting
+for the operation to finish.
+
+Appends are done with an UPDATE concatenating to the stored log, so
+neither the flusher nor readers ever need to load the whole log."""
+
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import TextField, Value
+from django.db.models.functions import Coalesce, Concat
+
+from . import models
+
+
+class OperationLog(object):
+    def __init__(self, operation_id, flush_interval=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'CAVIART_LOG_FLUSH_INTERVAL', 1.0)
+        self.operation_id = operation_id
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._written = []
+        self._closed = threading.Event()
+        self._thread = None
+
+    def write(self, text):
+        """Append `text` to the log. Safe to call from any thread."""
+        if not text:
+            return
+        with self._lock:
+            self._pending.append(text)
+            self._written.append(text)
+
+    def getvalue(self):
+        with self._lock:
+            return ''.join(self._written)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='oplog-%s' % self.operation_id)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the flusher thread after writing everything pending."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            chunk = ''.join(self._pending)
+            self._pending = []
+        if chunk:
+            models.Operation.objects.filter(pk=self.operation_id).update(
+                log=Concat(Coalesce('log', Value('')), Value(chunk),
+                           output_field=TextField()))
+
+    def _run(self):
+        try:
+            while not self._closed.wait(self.flush_interval):
+                self.flush()
+            self.flush()
+        finally:
+            # This thread owns its own database connection
+            connection.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,20 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination over an indexed column: every page costs the
+    same query no matter how deep into the listing it is."""
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ProjectPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class ProjectFilePagination(KeysetPagination):
+    ordering = ('-last_mod', '-id')
+
+
+class OperationPagination(KeysetPagination):
+    ordering = ('-sent_at', '-id')
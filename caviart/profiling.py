@@ -0,0 +1,159 @@
+"""Opt-in profiling of API requests.
+
+ProfilingMiddleware profiles requests carrying the `X-Caviart-Profile`
+header and a random sample of CAVIART_PROFILING_SAMPLE_RATE of the
+others. For each of them it records the SQL queries run (count, total
+time and the slowest ones), the time spent serializing and rendering,
+and a cProfile of the request, into a bounded in-memory ring buffer
+readable by staff through ProfileViewSet.
+
+Header requests are only profiled for staff users. As the API
+authenticates inside its views, the middleware runs the configured
+authentication classes itself before enabling the profiler, so other
+clients cannot make their requests more expensive.
+
+When CAVIART_PROFILING is off the middleware removes itself from the
+stack at startup, so leaving it in MIDDLEWARE costs nothing."""
+
+import cProfile, io, itertools, pstats, random, threading, time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
+
+PROFILE_HEADER = 'HTTP_X_CAVIART_PROFILE'
+PROFILE_ID_HEADER = 'X-Caviart-Profile-Id'
+SLOWEST_QUERIES = 5
+PROFILE_LINES = 40
+
+
+class ProfileBuffer(object):
+    """Thread-safe ring buffer of the latest request profiles."""
+    def __init__(self, size=None):
+        if size is None:
+            size = getattr(settings, 'CAVIART_PROFILING_BUFFER_SIZE', 100)
+        self._entries = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        with self._lock:
+            entry['id'] = next(self._ids)
+            self._entries.append(entry)
+        return entry['id']
+
+    def get(self, entry_id):
+        with self._lock:
+            for entry in self._entries:
+                if entry['id'] == entry_id:
+                    return entry
+        return None
+
+    def entries(self):
+        """Entries, newest first."""
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+default_profile_buffer = ProfileBuffer()
+
+
+def _code_key(function):
+    code = function.__code__
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _timed_functions():
+    """pstats keys of the functions whose cumulative time is reported,
+    by name in the profile entry."""
+    from rest_framework.response import Response
+    from rest_framework.serializers import BaseSerializer
+    return {
+        'serializer_time': _code_key(BaseSerializer.data.fget),
+        'render_time': _code_key(Response.rendered_content.fget),
+    }
+
+
+def _is_staff(request):
+    """Whether the request comes from a staff user, authenticated by
+    the session or by the API authentication classes."""
+    from rest_framework.exceptions import APIException
+    from rest_framework.request import Request
+    from rest_framework.settings import api_settings
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return user.is_staff
+    api_request = Request(request)
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            user_auth = authentication_class().authenticate(api_request)
+        except APIException:
+            return False
+        if user_auth is not None:
+            return user_auth[0].is_staff
+    return False
+
+
+class ProfilingMiddleware(object):
+    def __init__(self, get_response):
+        if not getattr(settings, 'CAVIART_PROFILING', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'CAVIART_PROFILING_SAMPLE_RATE', 0.0)
+        self.buffer = default_profile_buffer
+        self.timed_functions = _timed_functions()
+
+    def __call__(self, request):
+        requested = PROFILE_HEADER in request.META and _is_staff(request)
+        if not requested and not (self.sample_rate and
+                                  random.random() < self.sample_rate):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process
+            return self.get_response(request)
+
+        debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        first_query = len(connection.queries_log)
+        started = time.monotonic()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration = time.monotonic() - started
+            profiler.disable()
+            queries = list(connection.queries_log)[first_query:]
+            connection.force_debug_cursor = debug_cursor
+
+        user = getattr(request, 'user', None)
+        entry = self._make_entry(request, response, user, duration, queries, profiler)
+        response[PROFILE_ID_HEADER] = str(self.buffer.add(entry))
+        return response
+
+    def _make_entry(self, request, response, user, duration, queries, profiler):
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        entry = {
+            'time': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'user': user.get_username() if user is not None and user.is_authenticated() else None,
+            'duration': duration,
+            'query_count': len(queries),
+            'query_time': sum(float(query['time']) for query in queries),
+            'slowest_queries': sorted(queries, key=lambda query: float(query['time']),
+                                      reverse=True)[:SLOWEST_QUERIES],
+        }
+        for name, key in self.timed_functions.items():
+            # stats[key] is (primitive calls, calls, total, cumulative, callers)
+            entry[name] = stats.stats[key][3] if key in stats.stats else 0.0
+
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        entry['profile'] = stats.stream.getvalue()
+        return entry
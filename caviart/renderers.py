@@ -0,0 +1,13 @@
+from rest_framework import renderers
+
+
+class EventStreamRenderer(renderers.BaseRenderer):
+    """Allows negotiating server-sent events. Views answering with it
+    return their own StreamingHttpResponse, so there is nothing to
+    render."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
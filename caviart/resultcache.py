@@ -0,0 +1,199 @@
+"""Cross-project cache of tool results.
+
+Results are keyed by the tool signature and the contents of its
+relevant input files (see Tool.get_cache_key), so identical analyses
+on identical sources (forks, assignments, CI re-runs) only run once.
+
+An entry stores the log of the run and the digests of its outputs. The
+outputs themselves live in the blob store: each entry keeps a hardlink
+to every blob it needs, so blobs stay alive while they are cached, and
+a hit materializes outputs into a project by linking them in.
+
+The cache is bounded in size and evicts least recently used entries.
+Its index (the size of every entry) is a JSON file shared by every
+worker and protected by a file lock: shared to read it, exclusive to
+change it, and it is only rewritten when entries are added or evicted.
+The last use of an entry is the mtime of its manifest, and the hit and
+miss counters live in a small file of their own, so lookups never
+rewrite the index."""
+
+import fcntl, json, os, shutil, uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import hashing
+from .storage import default_blob_store
+
+
+class ResultCache(object):
+    def __init__(self, root=None, max_size=None, blob_store=None):
+        self._root = root
+        self._max_size = max_size
+        self.blob_store = blob_store or default_blob_store
+
+    @property
+    def root(self):
+        if self._root is not None:
+            return self._root
+        return getattr(settings, 'CAVIART_RESULT_CACHE_ROOT',
+                       os.path.join(settings.MEDIA_ROOT, '.results'))
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'CAVIART_RESULT_CACHE_MAX_SIZE', 10 * 1024 ** 3)
+
+    @property
+    def enabled(self):
+        return (getattr(settings, 'CAVIART_RESULT_CACHE', True) and
+                self.blob_store.enabled)
+
+    def lookup(self, key):
+        """Return the entry for `key` ({'log': ..., 'outputs': {path:
+        digest}}) or None, counting the hit or miss."""
+        with self._index(write=False) as index:
+            cached = key in index['entries']
+        entry = None
+        if cached:
+            manifest = self._manifest_path(key)
+            try:
+                with open(manifest) as f:
+                    entry = json.load(f)
+                os.utime(manifest)  # Last use, for LRU eviction
+            except (IOError, OSError, ValueError):
+                with self._index() as index:
+                    self._evict(index, key)
+        self._count('hits' if entry is not None else 'misses')
+        return entry
+
+    def materialize(self, entry, project_root):
+        """Link the outputs of `entry` into `project_root`. Returns False
+        if any of them is no longer available."""
+        for path, digest in sorted(entry['outputs'].items()):
+            if not self.blob_store.link_into(digest, os.path.join(project_root, path)):
+                return False
+        return True
+
+    def store(self, key, log, project_root, outputs, digests=None):
+        """Cache the result of a successful run whose outputs are the
+        files `outputs` (relative to `project_root`), given their
+        `digests` if known. Outputs already in the blob store are only
+        linked to the entry, so storing a run that rebuilt a few outputs
+        only copies those."""
+        known, digests, size = digests or {}, {}, 0
+        entry_dir = self._entry_path(key)
+        os.makedirs(os.path.join(entry_dir, 'blobs'), exist_ok=True)
+        try:
+            for path in outputs:
+                abspath = os.path.join(project_root, path)
+                digest = known.get(path) or hashing.sha256_file(abspath)
+                # The entry references the blob from the start, so it is
+                # never collectable while being stored
+                if self.blob_store.store_copy(
+                        abspath, digest, os.path.join(entry_dir, 'blobs', digest)) is None:
+                    # Not deduplicable, thus not cacheable
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    return False
+                digests[path] = digest
+                size += os.path.getsize(abspath)
+
+            with open(self._manifest_path(key), 'w') as f:
+                json.dump({'log': log, 'outputs': digests}, f)
+        except Exception:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            raise
+
+        with self._index() as index:
+            index['entries'][key] = {'size': size}
+            self._evict_over_size(index)
+        return True
+
+    def stats(self):
+        with self._index(write=False) as index:
+            stats = {
+                'entries': len(index['entries']),
+                'size': sum(entry['size'] for entry in index['entries'].values()),
+            }
+        stats.update(self._read_counters())
+        return stats
+
+    def _evict_over_size(self, index):
+        entries = index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        if total <= self.max_size:
+            return
+        for key in sorted(entries, key=self._last_used):
+            if total <= self.max_size:
+                break
+            total -= entries[key]['size']
+            self._evict(index, key)
+
+    def _last_used(self, key):
+        try:
+            return os.stat(self._manifest_path(key)).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def _evict(self, index, key):
+        index['entries'].pop(key, None)
+        entry_dir = self._entry_path(key)
+        try:
+            digests = os.listdir(os.path.join(entry_dir, 'blobs'))
+        except FileNotFoundError:
+            digests = []
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        for digest in digests:
+            self.blob_store.release(digest)
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, 'entries', key)
+
+    def _manifest_path(self, key):
+        return os.path.join(self._entry_path(key), 'manifest.json')
+
+    @contextmanager
+    def _index(self, write=True):
+        """Yield the index while holding the cache lock, exclusively
+        and saving the changes made to it if `write`."""
+        os.makedirs(self.root, exist_ok=True)
+        index_path = os.path.join(self.root, 'index.json')
+        with open(os.path.join(self.root, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                with open(index_path) as f:
+                    index = {'entries': json.load(f)['entries']}
+            except (IOError, OSError, ValueError, KeyError):
+                index = {'entries': {}}
+            before = json.dumps(index, sort_keys=True)
+            yield index
+            if write and json.dumps(index, sort_keys=True) != before:
+                self._write_json(index_path, index)
+
+    def _count(self, name):
+        """Add one to the counter `name` (hits or misses)."""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'counters.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            counters = self._read_counters()
+            counters[name] += 1
+            self._write_json(os.path.join(self.root, 'counters.json'), counters)
+
+    def _read_counters(self):
+        counters = {'hits': 0, 'misses': 0}
+        try:
+            with open(os.path.join(self.root, 'counters.json')) as f:
+                counters.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+        return counters
+
+    def _write_json(self, path, value):
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+
+
+default_result_cache = ResultCache()
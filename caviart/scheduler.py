@@ -0,0 +1,142 @@
+"""Batch scheduler for planned operations.
+
+Operations form a dependency graph through `triggered_by`: an
+operation is ready once the operation that triggered it finished, and
+is canceled (CD) as soon as it crashed or was canceled. Ready
+operations are dispatched oldest first, within a global and a
+per-project limit of operations in flight, and shared fairly between
+users: the next slot always goes to the user with the fewest
+operations in flight.
+
+Dispatching an operation moves it from Planned to Queued with a
+conditional UPDATE, so concurrent schedulers never dispatch the same
+operation twice.
+
+Operations in flight whose worker is gone would hold their slots for
+good, so every scheduling pass first recovers them: operations queued
+for more than CAVIART_QUEUED_OPERATION_LEASE seconds (their message was
+lost) are planned again, and running operations whose heartbeat is
+older than CAVIART_RUNNING_OPERATION_LEASE seconds (their worker died)
+are marked as crashed. Workers keep the heartbeat going until the
+files of the operation are registered (see OperationWatchdog), and
+never overwrite a status changed meanwhile. A late message for a
+replanned operation is harmless: workers only run operations they
+claim."""
+
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Q, TextField, Value
+from django.db.models.functions import Coalesce, Concat
+from django.utils import timezone
+
+from . import models
+
+
+PLANNED = 'P'
+QUEUED = 'Q'
+RUNNING = 'R'
+FINISHED = 'F'
+IN_FLIGHT = (QUEUED, RUNNING)
+FAILED = ('X', 'C', 'CD')
+
+
+class Scheduler(object):
+    def __init__(self, max_in_flight=None, max_in_flight_per_project=None):
+        if max_in_flight is None:
+            max_in_flight = getattr(settings, 'CAVIART_MAX_OPERATIONS_IN_FLIGHT', 32)
+        if max_in_flight_per_project is None:
+            max_in_flight_per_project = getattr(
+                settings, 'CAVIART_MAX_OPERATIONS_IN_FLIGHT_PER_PROJECT', 1)
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_project = max_in_flight_per_project
+        self.queued_lease = getattr(settings, 'CAVIART_QUEUED_OPERATION_LEASE', 3600)
+        self.running_lease = getattr(settings, 'CAVIART_RUNNING_OPERATION_LEASE', 300)
+
+    def recover_stale(self):
+        """Plan again the operations queued for longer than their lease
+        and mark as crashed the running ones whose heartbeat expired.
+        Returns how many operations were (replanned, crashed)."""
+        now = timezone.now()
+        replanned = models.Operation.objects.filter(
+            status=QUEUED, queued_at__lt=now - timedelta(seconds=self.queued_lease),
+        ).update(status=PLANNED)
+        crashed = models.Operation.objects.filter(
+            status=RUNNING, heartbeat_at__lt=now - timedelta(seconds=self.running_lease),
+        ).update(status='X', finished_at=now, log=Concat(
+            Coalesce('log', Value('')), Value('\nWorker lost.'),
+            output_field=TextField()))
+        return replanned, crashed
+
+    def cancel_dependents(self):
+        """Mark as CD every planned operation whose trigger crashed or
+        was canceled, transitively. Returns how many were canceled."""
+        canceled = 0
+        while True:
+            count = models.Operation.objects.filter(
+                status=PLANNED,
+                triggered_by__status__in=FAILED,
+            ).update(status='CD')
+            if not count:
+                return canceled
+            canceled += count
+
+    def schedule(self, dispatch):
+        """Dispatch every operation that is ready and fits the limits by
+        calling `dispatch(operation_id)`. Returns the dispatched ids."""
+        self.recover_stale()
+        self.cancel_dependents()
+
+        project_load = defaultdict(int)
+        user_load = defaultdict(int)
+        total_load = 0
+        in_flight = (models.Operation.objects
+                     .filter(status__in=IN_FLIGHT)
+                     .values('project_id', 'sent_by_id')
+                     .annotate(n=Count('id'))
+                     .order_by())
+        for row in in_flight:
+            project_load[row['project_id']] += row['n']
+            user_load[row['sent_by_id']] += row['n']
+            total_load += row['n']
+
+        capacity = self.max_in_flight - total_load
+        if capacity <= 0:
+            return []
+
+        ready = (models.Operation.objects
+                 .filter(Q(triggered_by__isnull=True) |
+                         Q(triggered_by__status=FINISHED),
+                         status=PLANNED)
+                 .order_by('sent_at', 'id')
+                 .values_list('id', 'project_id', 'sent_by_id'))
+        queues = defaultdict(deque)
+        for op_id, project_id, user_id in ready:
+            queues[user_id].append((op_id, project_id))
+
+        dispatched = []
+        while capacity > 0 and queues:
+            user_id = min(queues, key=lambda user: (user_load[user], queues[user][0][0]))
+            queue = queues[user_id]
+            while queue:
+                op_id, project_id = queue.popleft()
+                if project_load[project_id] >= self.max_in_flight_per_project:
+                    continue  # Stays planned until the project frees a slot
+                if not self._claim(op_id):
+                    continue  # Dispatched by someone else
+                dispatch(op_id)
+                dispatched.append(op_id)
+                project_load[project_id] += 1
+                user_load[user_id] += 1
+                capacity -= 1
+                break
+            if not queue:
+                del queues[user_id]
+
+        return dispatched
+
+    def _claim(self, op_id):
+        return models.Operation.objects.filter(
+            pk=op_id, status=PLANNED,
+        ).update(status=QUEUED, queued_at=timezone.now()) == 1
@@ -1,24 +1,44 @@
 
+from django.conf import settings
 from django.utils import timezone
 
 from rest_framework.authentication import get_user_model
-from rest_framework.fields import HiddenField, ListField, ModelField, SerializerMethodField
+from rest_framework.fields import (
+    BooleanField, CharField, HiddenField, ListField, ModelField, SerializerMethodField)
 from rest_framework.reverse import reverse
-from rest_framework.serializers import HyperlinkedModelSerializer, SlugRelatedField, ValidationError
+from rest_framework.serializers import HyperlinkedModelSerializer, ModelSerializer, Serializer, SlugRelatedField, ValidationError
 
 from caviart import models
+from caviart.archives import safe_member_path
 from rest_framework_extensions.fields import NestedHyperlinkedIdentityField
 from rest_framework_extensions.serializers import (
     NestedHyperlinkedModelSerializer)
 
 
+class SparseFieldsetMixin(object):
+    """Restrict the representation to the comma-separated fields in
+    the `fields` query parameter, when given. Fields left out are not
+    computed at all (e.g. no hyperlinks are built for them)."""
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsetMixin, self).__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method not in ('GET', 'HEAD'):
+            return
+
+        fields = request.query_params.get('fields')
+        if fields:
+            requested = set(field.strip() for field in fields.split(','))
+            for field in set(self.fields) - requested:
+                self.fields.pop(field)
+
+
 class UserSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = get_user_model()
         fields = ('url', 'username', 'first_name', 'last_name', 'email')
 
 
-class ProjectSerializer(HyperlinkedModelSerializer):
+class ProjectSerializer(SparseFieldsetMixin, HyperlinkedModelSerializer):
     files = NestedHyperlinkedIdentityField(
         read_only=True,
         view_name='projectfile-list',
@@ -37,11 +57,17 @@ class ProjectSerializer(HyperlinkedModelSerializer):
             }
         }
 
-class OperationSerializer(NestedHyperlinkedModelSerializer):
+class OperationSerializer(SparseFieldsetMixin, NestedHyperlinkedModelSerializer):
     sent_at = HiddenField(default=timezone.now)
     class Meta:
         model = models.Operation
         depth = 0
+        # Set by the scheduler, rerun, cancel and the workers; the
+        # timings also feed the operation metrics
+        read_only_fields = ('status', 'log', 'queued_at', 'started_at',
+                            'heartbeat_at', 'finished_at', 'queue_duration',
+                            'tool_duration', 'registration_duration',
+                            'save_duration')
         extra_kwargs = {
             'url': {
                 'lookup_map': 'caviart.viewsets.OperationViewSet'
@@ -55,7 +81,14 @@ class OperationSerializer(NestedHyperlinkedModelSerializer):
             },
         }
 
-class ProjectFileSerializer(NestedHyperlinkedModelSerializer):
+class OperationListSerializer(OperationSerializer):
+    """Operations in listings come without their (possibly huge)
+    log, which is read from the operation itself or followed through
+    its log endpoint."""
+    class Meta(OperationSerializer.Meta):
+        exclude = ('log',)
+
+class ProjectFileSerializer(SparseFieldsetMixin, NestedHyperlinkedModelSerializer):
     class Meta:
         model = models.ProjectFile
         fields = ('url', 'project', 'path', 'content', 'file_type', 'last_mod')
@@ -71,7 +104,7 @@ class ProjectFileSerializer(NestedHyperlinkedModelSerializer):
             }
         }
 
-class ProjectFileReadSerializer(NestedHyperlinkedModelSerializer):
+class ProjectFileReadSerializer(SparseFieldsetMixin, NestedHyperlinkedModelSerializer):
     content = NestedHyperlinkedIdentityField(
         read_only=True,
         view_name='projectfile-raw',
@@ -88,3 +121,65 @@ class ProjectFileReadSerializer(NestedHyperlinkedModelSerializer):
                 'lookup_map': 'caviart.viewsets.ProjectViewSet',
             },
         }
+
+class UploadSessionSerializer(ModelSerializer):
+    chunk_count = SerializerMethodField()
+    received = SerializerMethodField()
+
+    MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+    class Meta:
+        model = models.UploadSession
+        fields = ('id', 'path', 'size', 'chunk_size', 'checksum',
+                  'chunk_count', 'received', 'created_at')
+        read_only_fields = ('id', 'created_at')
+        extra_kwargs = {
+            'chunk_size': {'required': False},
+            'checksum': {'required': False},
+        }
+
+    def get_chunk_count(self, obj):
+        return obj.get_chunk_count()
+
+    def get_received(self, obj):
+        return sorted(obj.chunks.values_list('index', flat=True))
+
+    def validate_path(self, value):
+        path = safe_member_path(value)
+        if path is None:
+            raise ValidationError('Invalid path.')
+        return path
+
+    def validate_size(self, value):
+        if value < 0:
+            raise ValidationError('Invalid size.')
+        # The partial file is allocated at its full size on creation
+        max_size = getattr(settings, 'CAVIART_UPLOAD_MAX_SIZE', 4 * 1024 ** 3)
+        if value > max_size:
+            raise ValidationError('Uploads are limited to %d bytes.' % max_size)
+        return value
+
+    def validate_chunk_size(self, value):
+        if not 0 < value <= self.MAX_CHUNK_SIZE:
+            raise ValidationError(
+                'Chunks must be between 1 and %d bytes.' % self.MAX_CHUNK_SIZE)
+        return value
+
+
+class ManifestEntrySerializer(Serializer):
+    path = CharField(max_length=255)
+    hash = CharField(max_length=64)
+
+    def validate_path(self, value):
+        path = safe_member_path(value)
+        if path is None:
+            raise ValidationError('Invalid path.')
+        return path
+
+    def validate_hash(self, value):
+        return value.lower()
+
+
+class SyncManifestSerializer(Serializer):
+    files = ManifestEntrySerializer(many=True)
+    prune = BooleanField(default=False)
@@ -0,0 +1,115 @@
+"""Snapshots of project trees, to find what a tool changed.
+
+A snapshot maps the path of every regular file in a tree to its size,
+mtime and inode. Diffing the snapshots taken before and after running
+a tool gives the exact set of files it created, modified or deleted,
+whatever it reports in its touched_files.
+
+Listing a directory is only needed when its mtime changed: the
+listings of every directory are cached in the project state (see
+Project.get_state_root) across runs, so a snapshot of an unchanged
+tree costs one stat per directory and per file."""
+
+import json, os, time
+
+
+# Listings of directories modified this recently (in nanoseconds) are
+# not cached: further changes within the same mtime tick would go
+# unnoticed.
+RACY_WINDOW = 2 * 10 ** 9
+
+
+class TreeSnapshotter(object):
+    def __init__(self, root, cache_path=None):
+        self.root = root
+        self.cache_path = cache_path
+        self.listings = {}
+        self._load()
+
+    def _load(self):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as f:
+                self.listings = json.load(f).get('listings', {})
+        except (IOError, OSError, ValueError):
+            pass
+
+    def save(self):
+        # Imported here: tools imports this module
+        from .tools import atomic_output
+
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with atomic_output(self.cache_path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump({'listings': self.listings}, f)
+
+    def take(self):
+        """Return {path: (size, mtime_ns, inode)} for every regular file
+        under the root, relative to it. Symbolic links and in-progress
+        writes are ignored."""
+        files = {}
+        visited = set()
+        now = int(time.time() * 10 ** 9)
+        pending = ['']
+        while pending:
+            reldir = pending.pop()
+            listing = self._list(reldir, now)
+            if listing is None:
+                continue
+            visited.add(reldir)
+            for name in listing[1]:
+                path = os.path.join(reldir, name)
+                try:
+                    st = os.lstat(os.path.join(self.root, path))
+                except FileNotFoundError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            pending.extend(os.path.join(reldir, name) for name in listing[2])
+
+        for reldir in set(self.listings) - visited:
+            del self.listings[reldir]
+        return files
+
+    def _list(self, reldir, now):
+        """[mtime_ns, file names, subdirectory names] of `reldir`, or
+        None if it does not exist."""
+        from .tools import is_internal_file
+
+        path = os.path.join(self.root, reldir)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        listing = self.listings.get(reldir)
+        if listing is not None and listing[0] == mtime:
+            return listing
+
+        names, subdirs = [], []
+        try:
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif (entry.is_file(follow_symlinks=False) and
+                      not is_internal_file(entry.name)):
+                    names.append(entry.name)
+        except FileNotFoundError:
+            return None
+        listing = [mtime, names, subdirs]
+        if now - mtime > RACY_WINDOW:
+            self.listings[reldir] = listing
+        else:
+            self.listings.pop(reldir, None)
+        return listing
+
+
+def diff_snapshots(before, after):
+    """Return the (created, modified, deleted) paths between two
+    snapshots, each sorted."""
+    created = sorted(path for path in after if path not in before)
+    deleted = sorted(path for path in before if path not in after)
+    modified = sorted(path for path, entry in after.items()
+                      if path in before and before[path] != entry)
+    return created, modified, deleted
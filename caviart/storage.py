@@ -0,0 +1,196 @@
+"""Content-addressed blob storage.
+
+Every file in a project tree may be deduplicated by hardlinking it to
+a blob named after the SHA-256 of its contents. The blob store keeps
+one link of its own, so the number of references to a blob is its link
+count minus one: a blob whose link count drops to one is garbage.
+
+Deduplicated files share their inode, hence they are made read-only.
+Anything writing into a project tree must replace files (write to a
+temporary file and rename it over) rather than modify them in place;
+see tools.atomic_output, which tools write their outputs through.
+
+Files that must not be linked before they are published (tool outputs
+being cached, see resultcache.ResultCache) are stored with
+`store_copy`, which clones them (sharing extents on filesystems with
+reflinks, copying them otherwise)."""
+
+import errno, fcntl, os, shutil, stat, uuid
+
+from django.conf import settings
+
+from . import hashing
+
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+COPY_BUFFER_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # From linux/fs.h
+
+
+def clone_file(source, target):
+    """Copy `source` to `target`, as a reflink sharing the extents of
+    the source where the filesystem supports it."""
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+class BlobStore(object):
+    def __init__(self, root=None, enabled=None):
+        self._root = root
+        self._enabled = enabled
+
+    @property
+    def root(self):
+        if self._root is not None:
+            return self._root
+        return getattr(settings, 'CAVIART_BLOB_ROOT',
+                       os.path.join(settings.MEDIA_ROOT, '.blobs'))
+
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return getattr(settings, 'CAVIART_DEDUPLICATE', True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def ingest(self, path, digest=None):
+        """Deduplicate the file at `path` against the store.
+
+        If a blob with the same contents exists, `path` is atomically
+        replaced by a link to it; otherwise the file becomes the new
+        blob. Returns the digest, or None if the file could not be
+        deduplicated (e.g. the store lives on another filesystem)."""
+        if not self.enabled:
+            return None
+        if digest is None:
+            digest = hashing.sha256_file(path)
+
+        blob = self.blob_path(digest)
+        # Two attempts: a concurrent release may remove the blob
+        # between our existence check and the link.
+        for _ in range(2):
+            try:
+                if os.path.exists(blob):
+                    if not os.path.samefile(blob, path):
+                        self._replace_with_link(blob, path)
+                    return digest
+
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.chmod(path, READ_ONLY)
+                os.link(path, blob)
+                return digest
+            except FileExistsError:
+                continue  # Someone stored the same contents meanwhile
+            except FileNotFoundError:
+                continue  # The blob was garbage-collected meanwhile
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    return None
+                raise
+        return None
+
+    def link_into(self, digest, path):
+        """Materialize the blob `digest` at `path`. Returns False if
+        there is no such blob."""
+        blob = self.blob_path(digest)
+        try:
+            self._replace_with_link(blob, path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store_copy(self, path, digest=None, reference=None):
+        """Store a copy of the file at `path` as a blob, leaving `path`
+        untouched, and link the blob at `reference` if given. A new blob
+        is linked at `reference` before it is published, so it is never
+        unreferenced (and collectable) in between. Returns the digest,
+        or None if the store is off or the blob could not be stored."""
+        if not self.enabled:
+            return None
+        if digest is None:
+            digest = hashing.sha256_file(path)
+
+        blob = self.blob_path(digest)
+        # Two attempts: a concurrent release may remove the blob
+        # between our existence check and the link.
+        for _ in range(2):
+            if os.path.exists(blob):
+                try:
+                    if reference is not None and not os.path.exists(reference):
+                        os.link(blob, reference)
+                    return digest
+                except FileExistsError:
+                    return digest
+                except FileNotFoundError:
+                    continue  # The blob was garbage-collected meanwhile
+
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # Outside of the blob directories, which are garbage-collected
+            tmp = os.path.join(self.root, '.%s.tmp' % uuid.uuid4().hex)
+            try:
+                clone_file(path, tmp)
+                os.chmod(tmp, READ_ONLY)
+                if reference is not None:
+                    os.link(tmp, reference)
+                try:
+                    os.link(tmp, blob)
+                except FileExistsError:
+                    # Someone stored the same contents meanwhile
+                    if reference is not None:
+                        self._replace_with_link(blob, reference)
+                return digest
+            except FileNotFoundError:
+                continue
+            finally:
+                os.unlink(tmp)
+        return None
+
+    def release(self, digest):
+        """Drop the blob for `digest` if nothing references it anymore."""
+        if not digest:
+            return
+        blob = self.blob_path(digest)
+        try:
+            if os.stat(blob).st_nlink <= 1:
+                os.unlink(blob)
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self):
+        """Remove every unreferenced blob. Returns how many were removed."""
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    if entry.stat(follow_symlinks=False).st_nlink <= 1:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _replace_with_link(self, blob, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = os.path.join(directory, '.%s.blob-link' % uuid.uuid4().hex)
+        os.link(blob, tmp)
+        try:
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+default_blob_store = BlobStore()
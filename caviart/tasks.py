@@ -1,14 +1,22 @@
 from __future__ import absolute_import
 
-from . import models, tools
+from . import tools, trash
 from celery import shared_task
 
 
 @shared_task
 def run_tool(op_id: int):
-    operation = models.Operation.objects.get(pk=op_id)
-    project = operation.project
-    tool = operation.type
-    operation = tools.default_task_queue.run_task(operation)
+    operation = tools.default_task_queue.run_operation(op_id)
     return "Ended running operation %s." % operation
 
+
+@shared_task
+def run_planned():
+    dispatched = tools.default_task_queue.run_planned()
+    return "Dispatched operations %s." % dispatched
+
+
+@shared_task
+def purge_trash():
+    purged = trash.purge()
+    return "Purged %s trees from the trash." % purged
@@ -1,3 +1,1556 @@
-from django.test import TestCase
+import base64, hashlib, os, resource, shutil, signal, subprocess, sys, tempfile, threading, time, uuid
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_delete
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+
+from caviart import hashing, http, models, profiling, tools
+
+
+BENCHMARKS = bool(os.environ.get('CAVIART_BENCHMARKS'))
+
+
+def report(name, **results):
+    """Print the results of a benchmark."""
+    sys.stderr.write('\n%s: %s' % (name, ', '.join(
+        '%s=%s' % item for item in sorted(results.items()))))
+
+
+class CaviartTestMixin(object):
+    """Runs every test against its own MEDIA_ROOT."""
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CAVIART_BLOB_ROOT=os.path.join(self.media_root, '.blobs'),
+            CAVIART_STATE_ROOT=os.path.join(self.media_root, '.state'),
+            CAVIART_TRASH_ROOT=os.path.join(self.media_root, '.trash'),
+            CAVIART_RESULT_CACHE_ROOT=os.path.join(self.media_root, '.results'),
+            CAVIART_TASK_BACKEND='eager',
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.user = get_user_model().objects.create_user('alice', password='secret')
+        self.project = models.Project.objects.create(owner=self.user)
+
+    def write(self, path, data, project=None):
+        """Write `data` at `path` in the project tree, replacing it."""
+        path = os.path.join((project or self.project).get_project_root(), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)  # May be a read-only link to a blob
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+class CaviartTestCase(CaviartTestMixin, TestCase):
+    pass
+
+
+class CaviartTransactionTestCase(CaviartTestMixin, TransactionTestCase):
+    """For tests relying on on_commit callbacks."""
+
+
+class ProjectDeletionTests(CaviartTestCase):
+    def test_dropping_files_skips_per_file_receivers(self):
+        for i in range(5):
+            self.write('src/F%d.java' % i, 'class F%d {}' % i)
+        models.ProjectFile.objects.register_paths(
+            self.project, ['src/F%d.java' % i for i in range(5)])
+
+        calls = []
+        def receiver(sender, instance, **kwargs):
+            calls.append(instance.path)
+        pre_delete.connect(receiver, sender=models.ProjectFile)
+        self.addCleanup(pre_delete.disconnect, receiver, sender=models.ProjectFile)
+
+        self.assertEqual(models.ProjectFile.objects.drop_project(self.project), 5)
+        self.project.delete()
+        self.assertEqual(calls, [])
+        self.assertFalse(models.ProjectFile.objects.exists())
+
+    def test_dropping_operations_skips_the_cascade(self):
+        other = models.Project.objects.create(owner=self.user)
+        first = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='F')
+        second = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize',
+            status='F', triggered_by=first)
+        models.Operation.objects.create(
+            project=other, sent_by=self.user, type='fake_clirize',
+            status='CD', triggered_by=second)
+        kept = models.Operation.objects.create(
+            project=other, sent_by=self.user, type='fake_clirize', status='F')
+
+        calls = []
+        def receiver(sender, instance, **kwargs):
+            calls.append(instance.pk)
+        pre_delete.connect(receiver, sender=models.Operation)
+        self.addCleanup(pre_delete.disconnect, receiver, sender=models.Operation)
+
+        self.assertEqual(models.Operation.objects.drop_project(self.project), 2)
+        self.project.delete()
+        # Only the dependent in the other project goes through the ORM
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(list(models.Operation.objects.all()), [kept])
+
+    def test_deleting_a_project_with_operations_in_flight_conflicts(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        running = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='R')
+        planned = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='P')
+
+        response = client.delete('/projects/%s' % self.project.pk)
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(models.Project.objects.filter(pk=self.project.pk).exists())
+        planned.refresh_from_db()
+        self.assertEqual(planned.status, 'P')
+
+        models.Operation.objects.filter(pk=running.pk).update(status='X')
+        response = client.delete('/projects/%s' % self.project.pk)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(models.Operation.objects.exists())
+
+
+class SyncTests(CaviartTestCase):
+    def setUp(self):
+        super(SyncTests, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/projects/%s/sync' % self.project.pk
+        for name in ('same.txt', 'changed.txt', 'server_only.txt'):
+            self.write(name, name)
+        models.ProjectFile.objects.register_paths(
+            self.project, ['same.txt', 'changed.txt', 'server_only.txt'])
+
+    def sync(self, files, **options):
+        return self.client.post(self.url, dict(options, files=[
+            {'path': path, 'hash': hashlib.sha256(data).hexdigest()}
+            for path, data in files]), format='json')
+
+    def test_differences(self):
+        response = self.sync([('same.txt', b'same.txt'), ('changed.txt', b'new'),
+                              ('client_only.txt', b'new')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'upload': ['changed.txt', 'client_only.txt'],
+            'download': ['server_only.txt'],
+            'deleted': [],
+            'in_sync': 1,
+        })
+
+    def test_prune(self):
+        response = self.sync([('same.txt', b'same.txt')], prune=True)
+        self.assertEqual(response.data['deleted'], ['changed.txt', 'server_only.txt'])
+        self.assertEqual(response.data['download'], [])
+        self.assertEqual(list(self.project.files.values_list('path', flat=True)),
+                         ['same.txt'])
+
+    def test_prune_queries_do_not_grow_with_files(self):
+        paths = ['extra/F%d.txt' % i for i in range(50)]
+        for path in paths:
+            self.write(path, path)
+        models.ProjectFile.objects.register_paths(self.project, paths)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.sync([('same.txt', b'same.txt')], prune=True)
+        self.assertEqual(len(response.data['deleted']), 52)
+        self.assertLess(len(queries), 20)
+
+    def test_paths_outside_the_project_are_rejected(self):
+        for path in ('../other/same.txt', '/etc/passwd', 'a/../../same.txt'):
+            with self.subTest(path=path):
+                response = self.sync([(path, b'x')], prune=True)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.project.files.count(), 3)
+
+
+class ProfilingTests(CaviartTestCase):
+    def basic_auth_request(self, username, password):
+        credentials = base64.b64encode(('%s:%s' % (username, password)).encode('utf-8'))
+        return RequestFactory().get(
+            '/projects', HTTP_X_CAVIART_PROFILE='1',
+            HTTP_AUTHORIZATION='Basic ' + credentials.decode('ascii'))
+
+    def test_profiling_header_is_only_honored_for_staff(self):
+        get_user_model().objects.create_user('admin', password='secret', is_staff=True)
+        self.assertTrue(profiling._is_staff(self.basic_auth_request('admin', 'secret')))
+        self.assertFalse(profiling._is_staff(self.basic_auth_request('alice', 'secret')))
+        self.assertFalse(profiling._is_staff(self.basic_auth_request('admin', 'wrong')))
+        self.assertFalse(profiling._is_staff(
+            RequestFactory().get('/projects', HTTP_X_CAVIART_PROFILE='1')))
+
+
+class BlobStoreTests(CaviartTestCase):
+    def test_tool_outputs_are_deduplicated(self):
+        from caviart.storage import default_blob_store
+
+        for name in ('first', 'second'):
+            self.write('out/%s.txt' % name, 'report')
+        models.ProjectFile.objects.register_paths(
+            self.project, ['out/first.txt', 'out/second.txt'])
+        root = self.project.get_project_root()
+        first = os.path.join(root, 'out/first.txt')
+        self.assertTrue(os.path.samefile(first, os.path.join(root, 'out/second.txt')))
+        blob = default_blob_store.blob_path(hashlib.sha256(b'report').hexdigest())
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+
+        # Rewriting an output breaks its link, leaving the blob alone
+        with tools.atomic_output(first) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('changed')
+        with open(blob) as f:
+            self.assertEqual(f.read(), 'report')
+        self.assertEqual(os.stat(blob).st_nlink, 2)
+
+
+class ResultCacheTests(CaviartTransactionTestCase):
+    def test_entries_reference_blobs_before_they_are_published(self):
+        from caviart.storage import default_blob_store
+        self.write('out.txt', 'output')
+        path = os.path.join(self.project.get_project_root(), 'out.txt')
+        references = os.path.join(self.media_root, 'references')
+        os.makedirs(references)
+
+        for name in ('first', 'second'):  # A new blob, then an existing one
+            reference = os.path.join(references, name)
+            digest = default_blob_store.store_copy(path, reference=reference)
+            self.assertTrue(os.path.samefile(reference, default_blob_store.blob_path(digest)))
+        self.assertEqual(default_blob_store.collect_garbage(), 0)
+        # Temporary copies are not left behind
+        self.assertEqual(os.stat(reference).st_nlink, 3)
+
+    def test_caching_failures_do_not_fail_the_run(self):
+        from caviart.resultcache import ResultCache
+        self.write('src/A.java', 'class A {}')
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='Q')
+        with mock.patch.object(ResultCache, 'store', side_effect=OSError(28, 'No space left')):
+            operation = tools.default_task_queue.run_task(operation)
+        self.assertEqual(operation.status, 'F')
+        self.assertTrue(models.ProjectFile.objects.filter(path='src/A.java.clir').exists())
+
+    def test_incremental_runs_only_store_rebuilt_outputs(self):
+        from caviart import storage
+        for i in range(3):
+            self.write('src/F%d.java' % i, 'class F%d {}' % i)
+        self.run_clirize()
+
+        self.write('src/F0.java', 'class F0 { int x; }')
+        with mock.patch('caviart.storage.clone_file', wraps=storage.clone_file) as clone_file:
+            self.assertEqual(self.run_clirize().status, 'F')
+        self.assertEqual(clone_file.call_count, 1)
+
+    def test_lookups_do_not_rewrite_the_index(self):
+        from caviart.resultcache import ResultCache
+        cache = ResultCache()
+        self.write('out.txt', 'output')
+        self.assertTrue(cache.store('key', 'log', self.project.get_project_root(), ['out.txt']))
+        index = os.stat(os.path.join(cache.root, 'index.json'))
+
+        self.assertEqual(cache.lookup('key')['outputs'].keys(), {'out.txt'})
+        self.assertIsNone(cache.lookup('other'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'size': 6})
+        self.assertEqual(os.stat(os.path.join(cache.root, 'index.json')).st_ino, index.st_ino)
+
+    def run_clirize(self):
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='Q')
+        return tools.default_task_queue.run_task(operation)
+
+
+class RegistrationTests(CaviartTransactionTestCase):
+    def register(self, count, data='x'):
+        paths = ['out/F%d.txt' % i for i in range(count)]
+        for path in paths:
+            self.write(path, '%s %s' % (data, path))
+        with CaptureQueriesContext(connection) as queries:
+            started = time.monotonic()
+            models.ProjectFile.objects.register_paths(self.project, paths)
+            duration = time.monotonic() - started
+        return len(queries), duration
+
+    def test_replaced_contents_are_released(self):
+        from caviart.storage import default_blob_store
+
+        self.write('a.txt', 'old')
+        models.ProjectFile.objects.register_paths(self.project, ['a.txt'])
+        old = models.ProjectFile.objects.get(path='a.txt').content_hash
+        self.assertTrue(os.path.exists(default_blob_store.blob_path(old)))
+
+        self.write('a.txt', 'new')
+        models.ProjectFile.objects.register_paths(self.project, ['a.txt'])
+        self.assertFalse(os.path.exists(default_blob_store.blob_path(old)))
+
+    def test_queries_grow_with_batches(self):
+        batch_size = models.ProjectFileQuerySet.BATCH_SIZE
+        small, _ = self.register(batch_size)
+        models.ProjectFile.objects.all().delete()
+        large, _ = self.register(3 * batch_size)
+        # One SELECT, one INSERT and one UPDATE per extra batch
+        self.assertLessEqual(large - small, 2 * 3)
+
+    @skipUnless(BENCHMARKS, 'Set CAVIART_BENCHMARKS=1 to run benchmarks')
+    def test_benchmark_registration(self):
+        for count in (10, 100, 1000, 10000):
+            models.ProjectFile.objects.all().delete()
+            created = self.register(count)
+            updated = self.register(count, data='y')
+            report('register_paths(%d files)' % count,
+                   create_s='%.3f' % created[1], create_queries=created[0],
+                   update_s='%.3f' % updated[1], update_queries=updated[0])
+
+
+class QueryBudgetTests(CaviartTestCase):
+    """Every endpoint runs a bounded number of queries, the same
+    whatever the number of rows."""
+    SIZES = (10, 1000, 10000)
+    BUDGET = 5
+
+    def setUp(self):
+        super(QueryBudgetTests, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.rows = 0
+
+    def grow(self, size):
+        """Give the user `size` projects, and the project `size` files
+        and operations."""
+        count = size - self.rows
+        models.Project.objects.bulk_create([
+            models.Project(owner=self.user) for i in range(count)])
+        models.ProjectFile.objects.bulk_create([
+            models.ProjectFile(project=self.project, path='src/F%d.java' % i,
+                               file_type='java', content_hash='0' * 64,
+                               content='%s/src/F%d.java' % (self.project.id.hex, i))
+            for i in range(self.rows, size)], batch_size=500)
+        models.Operation.objects.bulk_create([
+            models.Operation(project=self.project, sent_by=self.user,
+                             type='fake_clirize', status='F',
+                             finished_at=timezone.now())
+            for i in range(count)], batch_size=500)
+        self.rows = size
+
+    def endpoints(self):
+        project = '/projects/%s' % self.project.pk
+        return [
+            '/projects',
+            project,
+            project + '/files',
+            project + '/files/%d' % models.ProjectFile.objects.earliest('pk').pk,
+            project + '/ops',
+            project + '/ops/%d' % models.Operation.objects.earliest('pk').pk,
+        ]
+
+    def test_query_budget(self):
+        baseline = {}
+        for size in self.SIZES:
+            self.grow(size)
+            for url in self.endpoints():
+                if url not in baseline:
+                    with CaptureQueriesContext(connection) as queries:
+                        self.assertEqual(self.client.get(url).status_code, 200)
+                    baseline[url] = len(queries)
+                    self.assertLessEqual(baseline[url], self.BUDGET, url)
+                    continue
+                with self.subTest(url=url, rows=size):
+                    with self.assertNumQueries(baseline[url]):
+                        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ServeFileTests(CaviartTestCase):
+    def setUp(self):
+        super(ServeFileTests, self).setUp()
+        self.path = os.path.join(self.media_root, 'data.bin')
+        with open(self.path, 'wb') as f:
+            f.write(bytes(range(100)))
+
+    def get(self, **headers):
+        request = RequestFactory().get('/raw', **headers)
+        return http.serve_file(request, self.path, 'application/octet-stream', etag='abc')
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+
+    @override_settings(CAVIART_SENDFILE='x-accel-redirect',
+                       CAVIART_ACCEL_REDIRECT_PREFIX='/protected/')
+    def test_accel_redirect_is_quoted(self):
+        self.path = os.path.join(self.media_root, 'src dir', 'r\u00e9sum\u00e9 100%?.txt')
+        response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/src%20dir/r%C3%A9sum%C3%A9%20100%25%3F.txt')
+
+    def test_ranges(self):
+        for header, content_range, data in [
+                ('bytes=10-19', 'bytes 10-19/100', bytes(range(10, 20))),
+                ('bytes=90-', 'bytes 90-99/100', bytes(range(90, 100))),
+                ('bytes=-5', 'bytes 95-99/100', bytes(range(95, 100))),
+                ('bytes=95-200', 'bytes 95-99/100', bytes(range(95, 100)))]:
+            with self.subTest(header=header):
+                response = self.get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response['Content-Range'], content_range)
+                self.assertEqual(response['Content-Length'], str(len(data)))
+                self.assertEqual(b''.join(response.streaming_content), data)
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=100-', 'bytes=20-10', 'bytes=-0'):
+            with self.subTest(header=header):
+                response = self.get(HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_stale_if_range_gets_the_whole_file(self):
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"abc"').status_code, 206)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"').status_code, 200)
+
+    def test_not_modified(self):
+        last_mod = timezone.now()
+        factory = RequestFactory()
+        for headers, expected in [
+                ({'HTTP_IF_NONE_MATCH': '"abc"'}, 304),
+                ({'HTTP_IF_NONE_MATCH': 'W/"abc", "def"'}, 304),
+                ({'HTTP_IF_NONE_MATCH': '"def"'}, None),
+                ({'HTTP_IF_MODIFIED_SINCE': http_date(time.time() + 60)}, 304),
+                ({'HTTP_IF_MODIFIED_SINCE': http_date(time.time() - 60)}, None),
+                ({}, None)]:
+            with self.subTest(headers=headers):
+                response = http.not_modified_response(
+                    factory.get('/raw', **headers), 'abc', last_mod)
+                self.assertEqual(response and response.status_code, expected)
+
+    @skipUnless(BENCHMARKS, 'Set CAVIART_BENCHMARKS=1 to run benchmarks')
+    def test_benchmark_memory(self):
+        size = 1024 ** 3
+        with open(self.path, 'wb') as f:
+            f.truncate(size)  # Sparse
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.monotonic()
+        served = sum(len(chunk) for chunk in self.get().streaming_content)
+        duration = time.monotonic() - started
+        # ru_maxrss is the peak resident set size, in kilobytes
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        report('serve_file(1 GB)', seconds='%.2f' % duration,
+               peak_rss_growth_kb=growth)
+        self.assertEqual(served, size)
+        self.assertLess(growth, 64 * 1024)
+
+
+class ProjectFileViewTests(CaviartTestCase):
+    def setUp(self):
+        super(ProjectFileViewTests, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.write('data.bin', 'x' * 100)
+        models.ProjectFile.objects.register_paths(self.project, ['data.bin'])
+        self.url = '/projects/%s/files/%d/raw' % (
+            self.project.pk, models.ProjectFile.objects.get().pk)
+
+    def test_raw_range_and_not_modified(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 10)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=200-').status_code, 416)
+
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class OperationBatchTests(CaviartTestCase):
+    def setUp(self):
+        super(OperationBatchTests, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/projects/%s/ops' % self.project.pk
+
+    def operation(self, project=None):
+        return {'project': 'http://testserver/projects/%s' % (project or self.project).pk,
+                'type': 'fake_clirize', 'status': 'F'}
+
+    def test_batch_creates_every_operation(self):
+        response = self.client.post(self.url + '/batch', [self.operation()] * 3, format='json')
+        self.assertEqual(response.status_code, 201)
+        created = list(models.Operation.objects.filter(project=self.project).order_by('pk'))
+        self.assertEqual(len(created), 3)
+        # The same shape whatever the database backend
+        self.assertEqual([operation['url'] for operation in response.data], [
+            'http://testserver/projects/%s/ops/%d' % (self.project.pk, operation.pk)
+            for operation in created])
+        self.assertNotIn('log', response.data[0])
+
+    def test_batch_answers_with_its_own_operations(self):
+        bulk_create = models.OperationQuerySet.bulk_create
+        def interleaved_bulk_create(queryset, *args, **kwargs):
+            created = bulk_create(queryset, *args, **kwargs)
+            # Another submission of the same user, right after the batch
+            models.Operation.objects.create(
+                project=self.project, sent_by=self.user, type='fake_clirize', status='F')
+            return created
+
+        with mock.patch.object(models.OperationQuerySet, 'bulk_create',
+                               interleaved_bulk_create):
+            response = self.client.post(self.url + '/batch', [self.operation()] * 2,
+                                        format='json')
+        self.assertEqual(response.status_code, 201)
+        batch = models.Operation.objects.filter(batch__isnull=False).order_by('pk')
+        self.assertEqual(len(batch), 2)
+        self.assertEqual([operation['url'] for operation in response.data], [
+            'http://testserver/projects/%s/ops/%d' % (self.project.pk, operation.pk)
+            for operation in batch])
+
+    def test_status_is_left_to_the_scheduler(self):
+        response = self.client.post(self.url, dict(self.operation(), status='R'), format='json')
+        self.assertEqual(response.status_code, 201)
+        operation = models.Operation.objects.get()
+        self.assertEqual(operation.status, 'P')
+
+        response = self.client.patch('%s/%d' % (self.url, operation.pk), {'status': 'F'},
+                                     format='json')
+        self.assertEqual(models.Operation.objects.get().status, 'P')
+
+        self.client.post(self.url + '/batch', [dict(self.operation(), status='Q')], format='json')
+        self.assertEqual(list(models.Operation.objects.values_list('status', flat=True)),
+                         ['P', 'P'])
+
+    def test_timings_are_read_only(self):
+        timings = {
+            'log': 'Fake', 'queued_at': '2000-01-01T00:00:00Z',
+            'started_at': '2000-01-01T00:00:00Z', 'heartbeat_at': '2000-01-01T00:00:00Z',
+            'finished_at': '2000-01-01T00:00:00Z', 'queue_duration': 1000,
+            'tool_duration': 1000, 'registration_duration': 1000, 'save_duration': 1000,
+        }
+        self.assertEqual(self.client.post(
+            self.url, dict(self.operation(), **timings), format='json').status_code, 201)
+        self.client.post(self.url + '/batch', [dict(self.operation(), **timings)], format='json')
+        operation = models.Operation.objects.first()
+        self.client.patch('%s/%d' % (self.url, operation.pk), timings, format='json')
+
+        for operation in models.Operation.objects.all():
+            for field in timings:
+                self.assertIsNone(getattr(operation, field), field)
+
+    def test_batch_is_all_or_nothing(self):
+        invalid = dict(self.operation(), type='no such tool')
+        response = self.client.post(self.url + '/batch', [self.operation(), invalid], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.Operation.objects.exists())
+
+    def test_batch_requires_owned_projects(self):
+        other = get_user_model().objects.create_user('bob', password='secret')
+        project = models.Project.objects.create(owner=other)
+        response = self.client.post(
+            self.url + '/batch', [self.operation(), self.operation(project)], format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(models.Operation.objects.exists())
+
+    def test_operations_require_owned_projects(self):
+        other = get_user_model().objects.create_user('bob', password='secret')
+        project = models.Project.objects.create(owner=other)
+        response = self.client.post(self.url, self.operation(project), format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(models.Operation.objects.exists())
+
+        self.client.post(self.url, self.operation(), format='json')
+        operation = models.Operation.objects.get()
+        response = self.client.patch('%s/%d' % (self.url, operation.pk),
+                                     self.operation(project), format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(models.Operation.objects.get().project_id, self.project.pk)
+
+    def test_batch_size_is_limited(self):
+        with self.settings(CAVIART_MAX_OPERATIONS_PER_BATCH=2):
+            response = self.client.post(self.url + '/batch', [self.operation()] * 3, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.url + '/batch', self.operation(), format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(BENCHMARKS, 'Set CAVIART_BENCHMARKS=1 to run benchmarks')
+    def test_benchmark_batch_against_single_posts(self):
+        count = 500
+        started = time.monotonic()
+        for i in range(count):
+            self.client.post(self.url, self.operation(), format='json')
+        single = count / (time.monotonic() - started)
+
+        started = time.monotonic()
+        for i in range(0, count, 100):
+            self.client.post(self.url + '/batch', [self.operation()] * 100, format='json')
+        batch = count / (time.monotonic() - started)
+
+        report('operation submission (%d operations)' % count,
+               single_ops_per_s='%.0f' % single, batch_ops_per_s='%.0f' % batch)
+        self.assertEqual(models.Operation.objects.count(), 2 * count)
+
+
+@override_settings(CAVIART_MAX_QUEUED_OPERATIONS_PER_PROJECT=1)
+class AdmissionTests(CaviartTestCase):
+    def setUp(self):
+        super(AdmissionTests, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='R')
+
+    def test_rerun_is_admitted(self):
+        ended = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='F')
+        response = self.client.post('/projects/%s/ops/%d/rerun' % (self.project.pk, ended.pk))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(models.Operation.objects.get(pk=ended.pk).status, 'F')
+
+    @override_settings(CAVIART_MAX_QUEUED_OPERATIONS_PER_PROJECT=2)
+    def test_rerun_clears_the_previous_timings(self):
+        now = timezone.now()
+        ended = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='F',
+            queued_at=now, started_at=now, heartbeat_at=now, finished_at=now,
+            queue_duration=1, tool_duration=1, registration_duration=1, save_duration=1)
+        url = '/projects/%s/ops/%d/rerun' % (self.project.pk, ended.pk)
+        self.assertEqual(self.client.get(url).status_code, 405)
+        with mock.patch.object(tools.default_task_queue, 'submit_planned'):
+            self.assertEqual(self.client.post(url).status_code, 200)
+        ended.refresh_from_db()
+        self.assertEqual(ended.status, 'P')
+        for field in ('queued_at', 'started_at', 'heartbeat_at', 'finished_at',
+                      'queue_duration', 'tool_duration', 'registration_duration',
+                      'save_duration'):
+            self.assertIsNone(getattr(ended, field), field)
+
+    def import_archive(self, data):
+        return self.client.post(
+            '/projects/%s/files/import?run=fake_clirize' % self.project.pk,
+            data, content_type='application/x-tar')
+
+    def archive(self):
+        import io, tarfile
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            info = tarfile.TarInfo('src/A.java')
+            info.size = 10
+            archive.addfile(info, io.BytesIO(b'class A {}'))
+        return buffer.getvalue()
+
+    def test_import_is_admitted(self):
+        response = self.import_archive(self.archive())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(models.Operation.objects.count(), 1)
+        # Rejected before anything is extracted
+        self.assertFalse(os.path.exists(
+            os.path.join(self.project.get_project_root(), 'src/A.java')))
+        self.assertFalse(models.ProjectFile.objects.exists())
+
+    @override_settings(CAVIART_MAX_QUEUED_OPERATIONS_PER_PROJECT=2)
+    def test_import_body_is_checked_before_admission(self):
+        # Requests without an archive are not counted as admitted
+        self.assertEqual(self.import_archive(b'').status_code, 400)
+        self.assertEqual(self.import_archive(self.archive()).status_code, 201)
+        self.assertEqual(models.Operation.objects.count(), 2)
+
+
+class FilesVersionTests(CaviartTestCase):
+    def version(self):
+        return models.Project.objects.get(pk=self.project.pk).files_version
+
+    def test_every_write_bumps_the_version(self):
+        self.write('a.txt', 'a')
+        self.write('b.txt', 'b')
+        models.ProjectFile.objects.register_paths(self.project, ['a.txt', 'b.txt'])
+        self.assertEqual(self.version(), 1)
+
+        models.ProjectFile.objects.get(path='a.txt').save()
+        self.assertEqual(self.version(), 2)
+
+        models.ProjectFile.objects.unregister_paths(self.project, ['a.txt'])
+        self.assertEqual(self.version(), 3)
+
+        models.ProjectFile.objects.get(path='b.txt').delete()
+        self.assertEqual(self.version(), 4)
+
+    def test_listing_is_revalidated_after_a_deletion(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = '/projects/%s/files' % self.project.pk
+        for path in ('a.txt', 'b.txt'):
+            self.write(path, path)
+        models.ProjectFile.objects.register_paths(self.project, ['a.txt', 'b.txt'])
+
+        etag = client.get(url)['ETag']
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Same count and same newest last_mod, yet another listing
+        models.ProjectFile.objects.get(path='a.txt').delete()
+        self.write('c.txt', 'c')
+        os.utime(os.path.join(self.project.get_project_root(), 'c.txt'), (0, 0))
+        models.ProjectFile.objects.register_paths(self.project, ['c.txt'])
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_etag_depends_on_the_fields(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.write('a.txt', 'a')
+        models.ProjectFile.objects.register_paths(self.project, ['a.txt'])
+        url = '/projects/%s/files/%d' % (
+            self.project.pk, models.ProjectFile.objects.get().pk)
+
+        etag = client.get(url + '?fields=path')['ETag']
+        self.assertEqual(client.get(url + '?fields=path', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CacheKeyTests(CaviartTestCase):
+    def tool(self, state_root=True):
+        return tools.FakeClirizeTool(
+            self.project.get_project_root(),
+            state_root=self.project.get_state_root() if state_root else None)
+
+    def test_inputs_are_only_hashed_when_changed(self):
+        for i in range(3):
+            self.write('src/F%d.java' % i, 'class F%d {}' % i)
+        with mock.patch('caviart.incremental.hashing.sha256_file',
+                        wraps=hashing.sha256_file) as sha256_file:
+            key = self.tool().get_cache_key()
+            self.assertEqual(sha256_file.call_count, 3)
+            self.assertEqual(self.tool().get_cache_key(), key)
+            self.assertEqual(sha256_file.call_count, 3)
+
+            self.write('src/F0.java', 'class F0 { int x; }')
+            changed = self.tool().get_cache_key()
+            self.assertEqual(sha256_file.call_count, 4)
+        self.assertNotEqual(changed, key)
+        self.assertEqual(self.tool(state_root=False).get_cache_key(), changed)
+
+
+class FollowLogTests(CaviartTestCase):
+    def test_non_finite_wait_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='R')
+        url = '/projects/%s/ops/%d/log' % (self.project.pk, operation.pk)
+        for wait in ('nan', 'inf', '-inf', 'soon'):
+            with self.subTest(wait=wait):
+                self.assertEqual(client.get(url, {'wait': wait}).status_code, 400)
+        self.assertEqual(client.get(url, {'wait': '0'}).status_code, 200)
+
+    def test_long_polling_resumes_from_the_offset(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize',
+            status='R', log='hello')
+        url = '/projects/%s/ops/%d/log' % (self.project.pk, operation.pk)
+
+        data = client.get(url).data
+        self.assertEqual((data['log'], data['offset'], data['finished']), ('hello', 5, False))
+        # Nothing new: answers once the wait is over
+        data = client.get(url, {'offset': 5, 'wait': 0.1}).data
+        self.assertEqual((data['log'], data['offset']), ('', 5))
+
+        models.Operation.objects.filter(pk=operation.pk).update(
+            log='hello world', status='F')
+        started = time.monotonic()
+        data = client.get(url, {'offset': 5, 'wait': 30}).data
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(data, {'status': 'F', 'finished': True,
+                                'offset': 11, 'log': ' world'})
+
+    def test_event_stream_resumes_and_ends(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize',
+            status='X', log='hello\nworld')
+        url = '/projects/%s/ops/%d/log' % (self.project.pk, operation.pk)
+
+        response = client.get(url, HTTP_ACCEPT='text/event-stream',
+                              HTTP_LAST_EVENT_ID='6')
+        self.assertEqual(b''.join(response.streaming_content).decode(),
+                         'id: 11\ndata: world\n\nevent: end\ndata: X\n\n')
+
+
+class OperationMetricsTests(CaviartTestCase):
+    def setUp(self):
+        super(OperationMetricsTests, self).setUp()
+        from django.core.cache import cache
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def create_finished(self, status, queue_duration=None, ago=3600):
+        from datetime import timedelta
+        finished_at = timezone.now() - timedelta(seconds=ago)
+        return models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize',
+            status=status, sent_at=finished_at - timedelta(days=1),
+            queue_duration=queue_duration, tool_duration=1, finished_at=finished_at)
+
+    def test_metrics_come_from_the_database(self):
+        from caviart import metrics
+
+        for status, queue_duration in (('F', 0.2), ('F', 3), ('X', None)):
+            self.create_finished(status, queue_duration)
+
+        # Another process, started after the operations finished
+        metrics.OperationCollector()()
+        rendered = metrics.registry.render()
+        self.assertIn('caviart_operations_finished_total'
+                      '{tool="fake_clirize",status="F"} 2.0', rendered)
+        self.assertIn('caviart_operation_queue_wait_seconds_bucket'
+                      '{tool="fake_clirize",le="0.25"} 1.0', rendered)
+        self.assertIn('caviart_operation_queue_wait_seconds_sum'
+                      '{tool="fake_clirize"} 3.2', rendered)
+        self.assertIn('caviart_operation_phase_duration_seconds_count'
+                      '{tool="fake_clirize",phase="tool"} 3.0', rendered)
+
+    def test_refreshes_only_add_new_operations(self):
+        from datetime import timedelta
+        from caviart import metrics
+
+        collector = metrics.OperationCollector()
+        first = self.create_finished('F')
+        totals = collector.refresh()
+        self.assertEqual(totals['finished'], {('fake_clirize', 'F'): 1})
+
+        # Deleted operations stay counted, and only the operations
+        # past the watermark are queried
+        first.delete()
+        self.create_finished('F', ago=10)  # Not settled yet
+        second = self.create_finished('F', ago=collector.SETTLE_TIME + 1)
+        totals['watermark'] = second.finished_at - timedelta(seconds=1)
+        with CaptureQueriesContext(connection) as queries:
+            totals = collector.refresh(totals)
+        self.assertEqual(totals['finished'], {('fake_clirize', 'F'): 2})
+        self.assertTrue(all('"finished_at" >' in query['sql']
+                            for query in queries.captured_queries))
+
+    @override_settings(CAVIART_METRICS_TOKEN='secret-token')
+    def test_metrics_require_staff_or_the_token(self):
+        client = APIClient()
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        client.force_login(self.user)
+        self.assertEqual(client.get('/metrics').status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        self.assertEqual(APIClient().get(
+            '/metrics', HTTP_AUTHORIZATION='Bearer secret-token').status_code, 200)
+
+
+class OperationTimingTests(CaviartTransactionTestCase):
+    def test_queue_wait_starts_when_queued(self):
+        from datetime import timedelta
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize',
+            status='Q', sent_at=timezone.now() - timedelta(days=1),
+            queued_at=timezone.now())
+        tools.default_task_queue.run_task(operation)
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, 'F')
+        self.assertLess(operation.queue_duration, 60)
+
+
+class CrashingTool(tools.Tool):
+    tool_name = 'test_crash'
+
+    def execute(self):
+        self.log('Started.\n')
+        raise RuntimeError('Boom')
+
+
+class BackendTests(CaviartTransactionTestCase):
+    def test_executor_runs_submitted_operations(self):
+        from caviart.backends import ExecutorBackend
+        backend = ExecutorBackend(max_workers=1)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='fake_clirize', status='Q')
+        backend.run_tool(operation.pk)
+        backend.executor.shutdown(wait=True)
+
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, 'F')
+        self.assertIsNotNone(operation.finished_at)
+
+    def test_unknown_backends_are_reported(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from caviart.backends import get_backend
+        for name in ('nonexistent', 'caviart.backends.NoSuchBackend'):
+            with self.subTest(name=name), override_settings(CAVIART_TASK_BACKEND=name):
+                with self.assertRaises(ImproperlyConfigured):
+                    get_backend()
+
+
+class OperationLogTests(CaviartTransactionTestCase):
+    def test_crashes_append_to_the_streamed_log(self):
+        queue = tools.TaskQueue()
+        queue.register_tool(CrashingTool)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_crash', status='Q')
+        queue.run_task(operation)
+
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, 'X')
+        # Followers already read the streamed part at these offsets
+        self.assertTrue(operation.log.startswith('Started.\nTraceback'))
+        self.assertIn('RuntimeError: Boom', operation.log)
+        self.assertIsNotNone(operation.finished_at)
+
+
+class EditingTool(tools.Tool):
+    tool_name = 'test_edit'
+
+    def execute(self):
+        # Reports nothing: the registered rows come from the tree
+        with tools.atomic_output(self.get_path('a.txt')) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('edited')
+        os.unlink(self.get_path('b.txt'))
+        with open(self.get_path('out/d.txt'), 'w') as f:
+            f.write('created')
+        return tools.ExecutionResult(ok=True, log='', touched_files=[])
+
+
+class ToolRegistrationTests(CaviartTransactionTestCase):
+    def test_rows_follow_the_tree(self):
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self.write(name, name)
+        models.ProjectFile.objects.register_paths(
+            self.project, ['a.txt', 'b.txt', 'c.txt'])
+        os.makedirs(os.path.join(self.project.get_project_root(), 'out'))
+
+        queue = tools.TaskQueue()
+        queue.register_tool(EditingTool)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_edit', status='Q')
+        self.assertEqual(queue.run_task(operation).status, 'F')
+
+        rows = dict(models.ProjectFile.objects.filter(project=self.project)
+                    .values_list('path', 'content_hash'))
+        self.assertEqual(rows, {
+            'a.txt': hashlib.sha256(b'edited').hexdigest(),
+            'c.txt': hashlib.sha256(b'c.txt').hexdigest(),
+            'out/d.txt': hashlib.sha256(b'created').hexdigest(),
+        })
+
+
+class UploadExpiryTests(CaviartTestCase):
+    def upload(self, path, age):
+        from datetime import timedelta
+        session = models.UploadSession.objects.create(
+            project=self.project, path=path, size=10, chunk_size=5,
+            created_by=self.user, created_at=timezone.now() - timedelta(seconds=age))
+        written = time.time() - age
+        os.utime(session.get_partial_path(), (written, written))
+        return session
+
+    def test_abandoned_uploads_are_purged(self):
+        from caviart import trash
+        abandoned = self.upload('a.txt', 7200)
+        recent = self.upload('b.txt', 60)
+        resumed = self.upload('c.txt', 7200)
+        os.utime(resumed.get_partial_path())
+
+        with self.settings(CAVIART_UPLOAD_TTL=3600):
+            trash.purge()
+        self.assertEqual(
+            set(models.UploadSession.objects.values_list('path', flat=True)),
+            {'b.txt', 'c.txt'})
+        self.assertFalse(os.path.exists(abandoned.get_partial_path()))
+        self.assertTrue(os.path.exists(recent.get_partial_path()))
+
+
+class ResumableUploadTests(CaviartTestCase):
+    def setUp(self):
+        super(ResumableUploadTests, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/projects/%s/files/uploads' % self.project.pk
+        self.data = b'0123456789abcdefghij!'
+
+    def open(self, **fields):
+        fields = dict({'path': 'src/data.bin', 'size': len(self.data),
+                       'chunk_size': 8}, **fields)
+        response = self.client.post(self.url, fields, format='json')
+        self.assertEqual(response.status_code, 201)
+        return '%s/%s' % (self.url, response.data['id'])
+
+    def put(self, upload, index, data, checksum=None):
+        return self.client.put(
+            '%s/%d' % (upload, index), data,
+            content_type='application/octet-stream',
+            HTTP_X_CHUNK_CHECKSUM=checksum or hashlib.sha256(data).hexdigest())
+
+    def chunk(self, index):
+        return self.data[index * 8:(index + 1) * 8]
+
+    def test_upload_urls_resolve(self):
+        from django.urls import resolve
+        upload_id = uuid.uuid4()
+        match = resolve('%s/%s/2' % (self.url, upload_id))
+        self.assertEqual(match.func.actions, {'put': 'upload_chunk'})
+        self.assertEqual(match.kwargs['upload_id'], str(upload_id))
+        self.assertEqual(match.kwargs['chunk_index'], '2')
+        match = resolve('%s/%s/commit' % (self.url, upload_id.hex))
+        self.assertEqual(match.func.actions, {'post': 'commit_upload'})
+
+    @override_settings(CAVIART_UPLOAD_MAX_SIZE=1024)
+    def test_size_is_limited(self):
+        response = self.client.post(
+            self.url, {'path': 'big.bin', 'size': 1025}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('size', response.data)
+        self.assertFalse(models.UploadSession.objects.exists())
+
+    def test_chunks_in_any_order_and_resent(self):
+        upload = self.open(checksum=hashlib.sha256(self.data).hexdigest())
+        for index in (2, 0, 1, 0):
+            self.assertEqual(self.put(upload, index, self.chunk(index)).status_code, 204)
+        self.assertEqual(self.client.get(upload).data['received'], [0, 1, 2])
+
+        response = self.client.post(upload + '/commit')
+        self.assertEqual(response.status_code, 201)
+        with open(os.path.join(self.project.get_project_root(), 'src/data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        registered = models.ProjectFile.objects.get(project=self.project, path='src/data.bin')
+        self.assertEqual(registered.content_hash, hashlib.sha256(self.data).hexdigest())
+        self.assertFalse(models.UploadSession.objects.exists())
+
+    def test_corrupted_chunks_are_rejected(self):
+        upload = self.open()
+        self.assertEqual(self.put(upload, 0, self.chunk(0), checksum='0' * 64).status_code, 400)
+        self.assertEqual(self.put(upload, 2, self.chunk(2) + b'x').status_code, 400)
+        self.assertEqual(self.client.get(upload).data['received'], [])
+
+    def test_commit_checks_the_whole_file(self):
+        upload = self.open(checksum='0' * 64)
+        self.assertEqual(self.client.post(upload + '/commit').status_code, 409)
+        for index in range(3):
+            self.put(upload, index, self.chunk(index))
+
+        self.assertEqual(self.client.post(upload + '/commit').status_code, 400)
+        self.assertFalse(models.ProjectFile.objects.filter(path='src/data.bin').exists())
+        self.assertTrue(models.UploadSession.objects.exists())
+
+    def test_unwritable_paths_conflict(self):
+        upload = self.open()
+        for index in range(3):
+            self.put(upload, index, self.chunk(index))
+        os.makedirs(os.path.join(self.project.get_project_root(), 'src/data.bin'))
+        response = self.client.post(upload + '/commit')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('directory', response.data['detail'])
+
+        session = models.UploadSession.objects.get()
+        os.unlink(session.get_partial_path())
+        self.assertEqual(self.put(upload, 0, self.chunk(0)).status_code, 409)
+        self.assertEqual(self.client.post(upload + '/commit').status_code, 409)
+
+
+class ArchiveImportTests(CaviartTestCase):
+    def setUp(self):
+        super(ArchiveImportTests, self).setUp()
+        self.root = self.project.get_project_root()
+        os.makedirs(self.root, exist_ok=True)
+
+    def tar(self, *members):
+        """A tar archive of (name, data) members; data None makes a
+        symlink to /etc/passwd."""
+        import io, tarfile
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type, info.linkname = tarfile.SYMTYPE, '/etc/passwd'
+                    archive.addfile(info)
+                else:
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+        buffer.seek(0)
+        return buffer
+
+    def zip(self, *members):
+        import io, zipfile
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name, data in members:
+                if data is None:
+                    info = zipfile.ZipInfo(name)
+                    info.external_attr = 0o120777 << 16
+                    archive.writestr(info, '/etc/passwd')
+                else:
+                    archive.writestr(name, data)
+        buffer.seek(0)
+        return buffer
+
+    def extract(self, archive):
+        from caviart.archives import extract_archive
+        return extract_archive(archive, self.root)
+
+    def test_members_outside_the_tree_are_skipped(self):
+        for archive in (self.tar, self.zip):
+            with self.subTest(archive=archive.__name__):
+                paths = self.extract(archive(
+                    ('../evil.txt', b'x'), ('/tmp/evil.txt', b'x'),
+                    ('a/../../evil.txt', b'x'), ('ok.txt', b'ok')))
+                self.assertEqual(paths, ['ok.txt'])
+                self.assertFalse(os.path.exists(os.path.join(self.media_root, 'evil.txt')))
+
+    def test_links_are_skipped(self):
+        for archive in (self.tar, self.zip):
+            with self.subTest(archive=archive.__name__):
+                self.assertEqual(self.extract(archive(('link', None))), [])
+                self.assertFalse(os.path.lexists(os.path.join(self.root, 'link')))
+
+    def test_links_in_the_tree_are_not_followed(self):
+        from caviart.archives import ArchiveError
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        os.symlink(outside, os.path.join(self.root, 'out'))
+        with self.assertRaises(ArchiveError):
+            self.extract(self.tar(('out/x.txt', b'x')))
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_conflicting_members_report_what_was_extracted(self):
+        from caviart.archives import ArchiveError, extract_archive
+        for archive in (self.tar, self.zip):
+            with self.subTest(archive=archive.__name__):
+                shutil.rmtree(self.root)
+                os.makedirs(self.root)
+                paths = []
+                with self.assertRaises(ArchiveError):
+                    extract_archive(archive(('a', b'file'), ('a/b', b'nested')),
+                                    self.root, paths)
+                self.assertEqual(paths, ['a'])
+
+    def test_limits(self):
+        from caviart.archives import ArchiveError
+        for archive in (self.tar, self.zip):
+            with self.subTest(archive=archive.__name__):
+                with override_settings(CAVIART_IMPORT_MAX_FILES=2):
+                    with self.assertRaises(ArchiveError):
+                        self.extract(archive(('a', b''), ('b', b''), ('c', b'')))
+                with override_settings(CAVIART_IMPORT_MAX_SIZE=10):
+                    with self.assertRaises(ArchiveError):
+                        self.extract(archive(('big', b'x' * 11)))
+                    self.assertFalse(os.path.exists(os.path.join(self.root, 'big')))
+                    self.assertEqual(self.extract(archive(('small', b'x' * 10))), ['small'])
+
+
+class ArchiveExportTests(CaviartTestCase):
+    def setUp(self):
+        super(ArchiveExportTests, self).setUp()
+        self.root = self.project.get_project_root()
+        for name in ('src/A.java', 'src/A.java.clir', 'src/sub/B.java.clir', 'README'):
+            self.write(name, name)
+        os.makedirs(os.path.join(self.media_root, 'secret'))
+        with open(os.path.join(self.media_root, 'secret', 'x.clir'), 'w') as f:
+            f.write('secret')
+
+    def members(self, archive_format, paths):
+        import io, tarfile, zipfile
+        from caviart.archives import stream_archive
+        data = io.BytesIO(b''.join(stream_archive(self.root, paths, archive_format)))
+        if archive_format == 'zip':
+            with zipfile.ZipFile(data) as archive:
+                return {name: archive.read(name).decode() for name in archive.namelist()}
+        with tarfile.open(fileobj=data, mode='r:gz') as archive:
+            return {member.name: archive.extractfile(member).read().decode()
+                    for member in archive.getmembers()}
+
+    def test_patterns_outside_the_tree_are_rejected(self):
+        from caviart.archives import ArchiveError, list_tree
+        for pattern in ('../**/*.clir', 'src/../../secret/*', '/etc/*', '..\\secret\\*'):
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(ArchiveError):
+                    list_tree(self.root, pattern)
+
+    def test_archives_hold_the_selected_files(self):
+        from caviart.archives import EXPORT_FORMATS, list_tree
+        paths = list_tree(self.root, '**/*.clir')
+        self.assertEqual(paths, ['src/A.java.clir', 'src/sub/B.java.clir'])
+        for archive_format in EXPORT_FORMATS:
+            with self.subTest(archive_format=archive_format):
+                self.assertEqual(self.members(archive_format, paths), {
+                    'src/A.java.clir': 'src/A.java.clir',
+                    'src/sub/B.java.clir': 'src/sub/B.java.clir',
+                })
+
+    def test_download_rejects_patterns_outside_the_tree(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = '/projects/%s/download' % self.project.pk
+        response = client.get(url, {'glob': '../secret/*'})
+        self.assertEqual(response.status_code, 400)
+        response = client.get(url, {'glob': 'src/*.clir', 'archive': 'zip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+
+class SchedulerTests(CaviartTestCase):
+    def setUp(self):
+        super(SchedulerTests, self).setUp()
+        self.sent = timezone.now()
+
+    def operation(self, project=None, user=None, status='P', **kwargs):
+        # Distinct submission times keep the oldest-first order explicit
+        from datetime import timedelta
+        self.sent += timedelta(seconds=1)
+        return models.Operation.objects.create(
+            project=project or self.project, sent_by=user or self.user,
+            type='fake_clirize', status=status, sent_at=self.sent, **kwargs)
+
+    def schedule(self, **limits):
+        from caviart.scheduler import Scheduler
+        dispatched = []
+        Scheduler(**limits).schedule(dispatched.append)
+        return dispatched
+
+    def status(self, operation):
+        return models.Operation.objects.get(pk=operation.pk).status
+
+    def test_dependents_wait_for_their_trigger(self):
+        first = self.operation()
+        second = self.operation(triggered_by=first)
+        self.assertEqual(self.schedule(max_in_flight_per_project=10), [first.pk])
+        self.assertEqual(self.status(first), 'Q')
+        self.assertEqual(self.schedule(max_in_flight_per_project=10), [])
+
+        models.Operation.objects.filter(pk=first.pk).update(status='F')
+        self.assertEqual(self.schedule(max_in_flight_per_project=10), [second.pk])
+
+    def test_failures_cancel_dependents_transitively(self):
+        first = self.operation(status='X')
+        second = self.operation(triggered_by=first)
+        third = self.operation(triggered_by=second)
+        other = self.operation()
+        self.assertEqual(self.schedule(), [other.pk])
+        self.assertEqual([self.status(second), self.status(third)], ['CD', 'CD'])
+
+    def test_limits(self):
+        projects = [self.project] + [
+            models.Project.objects.create(owner=self.user) for i in range(2)]
+        operations = [self.operation(project) for project in projects for i in range(2)]
+        # One per project, oldest first
+        self.assertEqual(self.schedule(max_in_flight=10, max_in_flight_per_project=1),
+                         [operations[0].pk, operations[2].pk, operations[4].pk])
+        models.Operation.objects.filter(status='Q').update(status='F')
+        self.assertEqual(self.schedule(max_in_flight=2, max_in_flight_per_project=1),
+                         [operations[1].pk, operations[3].pk])
+
+    def test_slots_go_to_the_least_loaded_user(self):
+        bob = get_user_model().objects.create_user('bob', password='secret')
+        bobs = models.Project.objects.create(owner=bob)
+        self.operation(models.Project.objects.create(owner=self.user), status='R',
+                       heartbeat_at=timezone.now())
+        older = self.operation()
+        newer = self.operation(bobs, bob)
+        self.assertEqual(self.schedule(max_in_flight=2), [newer.pk])
+        self.assertEqual(self.status(older), 'P')
+
+    def test_stale_operations_are_recovered(self):
+        from datetime import timedelta
+        long_ago = timezone.now() - timedelta(days=1)
+        lost = self.operation(status='Q', queued_at=long_ago)
+        dead = self.operation(models.Project.objects.create(owner=self.user),
+                              status='R', heartbeat_at=long_ago, log='Started')
+        dependent = self.operation(triggered_by=dead)
+        alive = self.operation(models.Project.objects.create(owner=self.user),
+                               status='R', heartbeat_at=timezone.now())
+
+        self.assertEqual(self.schedule(), [lost.pk])
+        dead.refresh_from_db()
+        self.assertEqual(dead.status, 'X')
+        self.assertEqual(dead.log, 'Started\nWorker lost.')
+        self.assertEqual(self.status(dependent), 'CD')
+        self.assertEqual(self.status(alive), 'R')
+
+
+    def test_watchdog_refreshes_the_heartbeat(self):
+        from datetime import timedelta
+        from caviart.watchdog import OperationWatchdog
+        long_ago = timezone.now() - timedelta(days=1)
+        operation = self.operation(status='R', heartbeat_at=long_ago)
+        watchdog = OperationWatchdog(operation.pk, tool=None, poll_interval=3600)
+        watchdog.heartbeat_interval = 0
+        with watchdog:
+            self.assertFalse(watchdog.check())
+        operation.refresh_from_db()
+        self.assertGreater(operation.heartbeat_at, long_ago)
+
+    def test_watchdog_stops_the_tool_once_and_keeps_beating(self):
+        from datetime import timedelta
+        from caviart.watchdog import TIMED_OUT, OperationWatchdog
+        long_ago = timezone.now() - timedelta(days=1)
+        operation = self.operation(status='R', heartbeat_at=long_ago)
+        tool = mock.Mock()
+        watchdog = OperationWatchdog(operation.pk, tool=tool, time_limit=0.001,
+                                     poll_interval=3600)
+        watchdog.heartbeat_interval = 0
+        with watchdog:
+            time.sleep(0.01)
+            self.assertTrue(watchdog.check())
+            self.assertFalse(watchdog.check())
+        tool.cancel.assert_called_once_with(TIMED_OUT)
+        operation.refresh_from_db()
+        self.assertGreater(operation.heartbeat_at, long_ago)
+
+
+class SleepTool(tools.Tool):
+    tool_name = 'test_sleep'
+
+    def execute(self):
+        process = self.run_subprocess(['sleep', '30'])
+        return tools.ExecutionResult(ok=process.returncode == 0, log='', touched_files=[])
+
+
+class RecordingTool(tools.Tool):
+    """Writes <input>.out for every *.txt input, recording which inputs
+    it processed."""
+    tool_name = 'test_record'
+    incremental = True
+    params = {'source_files': '*.txt'}
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingTool, self).__init__(*args, **kwargs)
+        self.processed = []
+
+    def get_output_files(self, path):
+        return [path + '.out']
+
+    def process_file(self, path):
+        self.processed.append(path)
+        with tools.atomic_output(self.get_path(path + '.out')) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('out')
+        return tools.FileResult(ok=True, log='%s done' % path, touched_files=[path + '.out'])
+
+
+class IncrementalTests(CaviartTestCase):
+    def run_tool(self):
+        tool = RecordingTool(self.project.get_project_root(),
+                             state_root=self.project.get_state_root())
+        result = tool.execute()
+        self.assertTrue(result.ok)
+        return tool, result
+
+    def test_only_changed_inputs_are_processed_again(self):
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self.write(name, name)
+        tool, _ = self.run_tool()
+        self.assertEqual(tool.processed, ['a.txt', 'b.txt', 'c.txt'])
+
+        tool, result = self.run_tool()
+        self.assertEqual(tool.processed, [])
+        self.assertEqual(list(result.skipped_files), ['a.txt', 'b.txt', 'c.txt'])
+
+        self.write('b.txt', 'changed')
+        # Touched but unchanged
+        os.utime(os.path.join(self.project.get_project_root(), 'c.txt'), (0, 0))
+        tool, result = self.run_tool()
+        self.assertEqual(tool.processed, ['b.txt'])
+        self.assertEqual(list(result.skipped_files), ['a.txt', 'c.txt'])
+
+        os.unlink(os.path.join(self.project.get_project_root(), 'a.txt.out'))
+        tool, _ = self.run_tool()
+        self.assertEqual(tool.processed, ['a.txt'])
+
+
+class ParallelTool(RecordingTool):
+    """Finishes its inputs in reverse order, failing on fail.txt."""
+    tool_name = 'test_parallel'
+    incremental = False
+    parallelism = 4
+
+    def process_file(self, path):
+        time.sleep({'a.txt': 0.3, 'b.txt': 0.2, 'c.txt': 0.1}.get(path, 0))
+        if path == 'fail.txt':
+            self.processed.append(path)
+            return tools.FileResult(ok=False, log='fail.txt failed', touched_files=[])
+        return super(ParallelTool, self).process_file(path)
+
+
+class ParallelProcessingTests(CaviartTestCase):
+    def tool(self):
+        import io
+        return ParallelTool(self.project.get_project_root(), log_writer=io.StringIO())
+
+    def test_results_are_in_input_order(self):
+        for name in ('a.txt', 'b.txt', 'c.txt', 'd.txt'):
+            self.write(name, name)
+        tool = self.tool()
+        result = tool.execute()
+
+        self.assertTrue(result.ok)
+        # Completion order, the opposite of the input order
+        self.assertEqual(tool.processed, ['d.txt', 'c.txt', 'b.txt', 'a.txt'])
+        self.assertEqual(list(result.rebuilt_files), ['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+        self.assertEqual(list(result.touched_files),
+                         ['a.txt.out', 'b.txt.out', 'c.txt.out', 'd.txt.out'])
+        expected = 'a.txt done\nb.txt done\nc.txt done\nd.txt done\n'
+        self.assertEqual(tool.log_writer.getvalue(), expected + '4 files rebuilt, 0 up to date.')
+        self.assertEqual(result.log, expected + '4 files rebuilt, 0 up to date.')
+
+    def test_failures_are_reported(self):
+        for name in ('a.txt', 'b.txt', 'fail.txt'):
+            self.write(name, name)
+        result = self.tool().execute()
+
+        self.assertFalse(result.ok)
+        self.assertIn('fail.txt failed', result.log.split('\n'))
+        self.assertNotIn('fail.txt', result.rebuilt_files)
+        self.assertEqual(list(result.rebuilt_files), ['a.txt', 'b.txt'])
+
+
+class RelativeOutputTool(tools.Tool):
+    """Writes out.log from a subprocess, relative to its working
+    directory, and <input>.copy next to every *.txt input."""
+    tool_name = 'test_relative'
+    params = {'source_files': '*.txt'}
+
+    def get_output_files(self, path):
+        return [path + '.copy']
+
+    def process_file(self, path):
+        with open(self.get_path(path)) as f, \
+             tools.atomic_output(self.get_path(path + '.copy')) as tmp:
+            with open(tmp, 'w') as output:
+                output.write(f.read())
+        return tools.FileResult(ok=True, log='', touched_files=[path + '.copy'])
+
+    def execute(self):
+        self.run_subprocess('echo out > out.log', shell=True)
+        return super(RelativeOutputTool, self).execute()
+
+
+class ProjectRootTests(CaviartTestCase):
+    def test_tools_stay_in_their_project_root(self):
+        other = models.Project.objects.create(owner=self.user)
+        self.write('a.txt', 'first')
+        self.write('b.txt', 'second', project=other)
+        cwd = os.getcwd()
+
+        tools_ = [RelativeOutputTool(project.get_project_root())
+                  for project in (self.project, other)]
+        threads = [threading.Thread(target=tool.execute) for tool in tools_]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertFalse(os.path.exists(os.path.join(cwd, 'out.log')))
+        for tool, expected in zip(tools_, (['a.txt', 'a.txt.copy', 'out.log'],
+                                           ['b.txt', 'b.txt.copy', 'out.log'])):
+            self.assertEqual(sorted(os.listdir(tool.project_root)), expected)
+
+
+class ToolLimitsTests(CaviartTransactionTestCase):
+    def tool(self, tool_class=SleepTool, **attributes):
+        tool = tool_class(self.project.get_project_root())
+        for name, value in attributes.items():
+            setattr(tool, name, value)
+        return tool
+
+    def test_limits_are_set_before_exec(self):
+        process = self.tool(cpu_time_limit=7, memory_limit=512 * 1024 ** 2).run_subprocess(
+            'ulimit -t; ulimit -v', shell=True, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self.assertEqual(process.stdout.split(), ['7', str(512 * 1024)])
+
+    def test_cpu_and_memory_limits(self):
+        process = self.tool(cpu_time_limit=1).run_subprocess(
+            [sys.executable, '-c', 'while True: pass'])
+        self.assertIn(process.returncode, (-signal.SIGXCPU, -signal.SIGKILL))
+
+        process = self.tool(memory_limit=256 * 1024 ** 2).run_subprocess(
+            [sys.executable, '-c', 'bytearray(512 * 1024 ** 2)'], stderr=subprocess.PIPE)
+        self.assertEqual(process.returncode, 1)
+        self.assertIn(b'MemoryError', process.stderr)
+
+    def test_cancel_kills_the_subprocess(self):
+        tool = self.tool()
+        timer = threading.Timer(0.2, tool.cancel, ['canceled'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = time.monotonic()
+        with self.assertRaises(tools.ToolCanceled):
+            tool.execute()
+        self.assertLess(time.monotonic() - started, tools.TERMINATE_GRACE_PERIOD)
+
+    @override_settings(CAVIART_TOOL_LIMITS={'test_sleep': {'time': 1}},
+                       CAVIART_CANCEL_POLL_INTERVAL=0.1)
+    def test_operations_time_out(self):
+        queue = tools.TaskQueue()
+        queue.register_tool(SleepTool)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_sleep', status='Q')
+        started = time.monotonic()
+        operation = queue.run_task(operation)
+        self.assertLess(time.monotonic() - started, 1 + tools.TERMINATE_GRACE_PERIOD)
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, 'X')
+        self.assertTrue(operation.log.endswith('Timed out after 1 seconds.'))
+
+    @override_settings(CAVIART_OPERATION_HEARTBEAT_INTERVAL=0,
+                       CAVIART_CANCEL_POLL_INTERVAL=0.05)
+    def test_heartbeat_lasts_until_files_are_registered(self):
+        queue = tools.TaskQueue()
+        queue.register_tool(IdleTool)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_idle', status='Q')
+        heartbeats = []
+        def register_changes(*args):
+            for _ in range(2):
+                heartbeats.append(models.Operation.objects.get(pk=operation.pk).heartbeat_at)
+                time.sleep(0.5)
+        with mock.patch.object(queue, '_register_changes', register_changes):
+            queue.run_task(operation)
+        self.assertGreater(heartbeats[1], heartbeats[0])
+        self.assertEqual(self.status(operation), 'F')
+
+    def test_status_changed_meanwhile_is_kept(self):
+        queue = tools.TaskQueue()
+        queue.register_tool(LostTool)
+        operation = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_lost', status='Q')
+        dependent = models.Operation.objects.create(
+            project=self.project, sent_by=self.user, type='test_lost', status='P',
+            triggered_by=operation)
+        operation = queue.run_task(operation)
+        self.assertEqual(operation.status, 'X')
+        self.assertEqual(self.status(operation), 'X')
+        self.assertEqual(self.status(dependent), 'CD')
+        self.assertIsNotNone(models.Operation.objects.get(pk=operation.pk).finished_at)
+
+    def status(self, operation):
+        return models.Operation.objects.get(pk=operation.pk).status
+
+
+class IdleTool(tools.Tool):
+    tool_name = 'test_idle'
+
+    def execute(self):
+        return tools.ExecutionResult(ok=True, log='', touched_files=[])
+
+
+class LostTool(IdleTool):
+    """Given up by the scheduler while it runs."""
+    tool_name = 'test_lost'
+
+    def execute(self):
+        models.Operation.objects.filter(status='R').update(
+            status='X', finished_at=timezone.now())
+        return super(LostTool, self).execute()
@@ -3,25 +3,113 @@
 The tools framework provides a way of defining a toolset for
 performing analysis through the CAVI-ART platform."""
 
-from datetime import datetime
-import os, subprocess
+import hashlib, io, json, logging, os, signal, subprocess, threading, time, traceback, uuid
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from glob import iglob as glob
+from glob import escape as glob_escape, iglob as glob
 
 import six
 
-from django.core.files import File
+from django.conf import settings
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
-from . import models
+from . import hashing, models
+from .backends import get_backend
+from .incremental import FingerprintStore
+from .oplog import OperationLog
+from .resultcache import default_result_cache
+from .scheduler import Scheduler
+from .snapshot import TreeSnapshotter, diff_snapshots
+from .watchdog import CANCELED, TIMED_OUT, OperationWatchdog
 
 
 # Export meaningful objects
-__all__ = ['ExecutionResult', 'TaskQueue', 'Tool' + 'FakeClirizeTool']
+__all__ = ['ExecutionResult', 'FileResult', 'TaskQueue', 'Tool', 'ToolCanceled',
+           'FakeClirizeTool', 'atomic_output', 'is_internal_file']
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of the hidden files holding in-progress writes in project
+# trees: tool outputs and blob links (.tmp, .blob-link) and resumable
+# uploads (.upload).
+INTERNAL_FILE_SUFFIXES = ('.tmp', '.blob-link', '.upload')
+
+
+ExecutionResult = namedtuple('ExecutionResult', [
+    'ok', 'log', 'touched_files', 'rebuilt_files', 'skipped_files'])
+ExecutionResult.__new__.__defaults__ = ((), ())
+
+# Result of processing a single input file (see Tool.process_file)
+FileResult = namedtuple('FileResult', ['ok', 'log', 'touched_files'])
+
+# Seconds between asking the process group of a stopped subprocess to
+# terminate and killing it
+TERMINATE_GRACE_PERIOD = 5
+
+
+class ToolCanceled(Exception):
+    """Raised in a tool stopped by Tool.cancel."""
+
+
+def _limit_args(args, cpu_time, memory, shell=False):
+    """Command running `args` under the resource limits, through the
+    prlimit(1) wrapper of util-linux: it sets them before exec'ing the
+    command, so neither it nor its children ever run unlimited. A
+    preexec_fn would do the same, but is not safe in a threaded
+    process. Returns the new (args, shell)."""
+    limits = []
+    if cpu_time:
+        limits.append('--cpu=%d:%d' % (cpu_time, cpu_time + 1))
+    if memory:
+        limits.append('--as=%d' % memory)
+    if not limits:
+        return args, shell
+    if shell:
+        args = ['/bin/sh', '-c', args]
+    elif isinstance(args, str):
+        args = [args]
+    prlimit = getattr(settings, 'CAVIART_PRLIMIT', 'prlimit')
+    return [prlimit] + limits + ['--'] + list(args), False
+
+
+def _signal_process_group(process, signum):
+    """Send `signum` to the process group led by `process`."""
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass  # Already gone
+
+
+def is_internal_file(name):
+    """Whether the file called `name` holds an in-progress write and
+    is not part of the project."""
+    return name.startswith('.') and name.endswith(INTERNAL_FILE_SUFFIXES)
+
+
+@contextmanager
+def atomic_output(path):
+    """Yield a temporary path to write `path` into, and move it over
+    `path` once the block succeeds. Removing the temporary file
+    inside the block discards the output.
+
+    Files in a project tree, tool outputs included, may be read-only
+    links to shared blobs (see storage.BlobStore). Renaming the new
+    output over `path` breaks the link, leaving the blob untouched, so
+    tools must write their outputs this way rather than in place."""
+    tmp = os.path.join(os.path.dirname(path),
+                       '.%s.%s.tmp' % (os.path.basename(path), uuid.uuid4().hex))
+    try:
+        yield tmp
+        if os.path.exists(tmp):
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
 
 
-ExecutionResult = namedtuple('ExecutionResult', ['ok', 'log', 'touched_files'])
-
 class TaskQueue(object):
     def __init__(self):
         self.registered_tools = {}
@@ -36,58 +124,207 @@ class TaskQueue(object):
         for k in self.registered_tools.keys():
             yield (k, self.registered_tools[k].human_readable_name)
 
-    def run_planned(self):
-        raise Exception('Not yet implemented')
+    @property
+    def backend(self):
+        """Execution backend running dispatched operations (see
+        caviart.backends)."""
+        return get_backend()
+
+    def submit(self, op_id):
+        """Have the backend run operation `op_id`. Returns a job id."""
+        return self.backend.run_tool(op_id)
+
+    def submit_planned(self):
+        """Have the backend dispatch the planned operations."""
+        self.backend.run_planned()
+
+    def run_planned(self, dispatch=None):
+        """Dispatch every planned operation whose dependencies are
+        satisfied, within the scheduler limits. Returns the ids of the
+        dispatched operations."""
+        if dispatch is None:
+            dispatch = self.submit
+        return Scheduler().schedule(dispatch)
+
+    def run_operation(self, op_id):
+        """Run operation `op_id`, then dispatch the operations that may
+        have become ready."""
+        operation = self.run_task(models.Operation.objects.get(pk=op_id))
+        # Dependents may be ready now, and a slot was freed
+        self.submit_planned()
+        return operation
 
     def run_task(self, operation, save=True):
         project = operation.project
         tool_ = self.registered_tools[operation.type]
         operation.status = 'R'
+        operation.log = ''
+        operation.started_at = timezone.now()
+        if operation.queued_at is not None:
+            operation.queue_duration = max(
+                (operation.started_at - operation.queued_at).total_seconds(), 0)
         if save:
-            operation.save()
-
-        with self._change_cwd(project):
-            tool = tool_()
-            execution_result = tool.execute()
-            operation.log = execution_result.log
-            operation.status = 'F' if execution_result.ok else 'X'
-            print("Touched files: %s" % (execution_result.touched_files))
-
-            # Actually create the files on BD for the relevant touched_files
-            for path in execution_result.touched_files:
-                file_instance, created = models.ProjectFile.objects.get_or_create(
-                    project=project,
-                    path=path,
-                )
-
-                if not file_instance.file_type:
-                    file_instance.file_type = 'text/plain'
-
-                with open(path, 'r') as f:
-                    if created: # No previous file contents:
-                        file_instance.content = File(f)
-                    else:
-                        file_instance.content = os.path.join(project.id.hex, path)
-
-                    # The content already changed on disk; but we must
-                    # overwrite the last_mod argument in the DB
-                    file_instance.last_mod = datetime.fromtimestamp(os.path.getmtime(path))
-                    file_instance.save()
-
-
+            # Canceled operations may still be in the queue
+            claimed = models.Operation.objects.filter(
+                pk=operation.pk, status__in=('P', 'Q'),
+            ).update(status='R', log='', started_at=operation.started_at,
+                     heartbeat_at=operation.started_at,
+                     queue_duration=operation.queue_duration)
+            if not claimed:
+                logger.info("Operation %s is no longer queued, not running it",
+                            operation.pk)
+                operation.refresh_from_db()
+                return operation
+
+        # The stored log only ever grows while the operation runs, as
+        # clients follow it by offset (see OperationViewSet.follow_log):
+        # everything goes through the OperationLog and the final save
+        # leaves the log alone
+        oplog = OperationLog(operation.pk).start() if save else None
+        log = oplog if oplog is not None else io.StringIO()
+        tool = watchdog = snapshotter = before = None
+        try:
+            try:
+                tool = tool_(project.get_project_root(),
+                             state_root=project.get_state_root(),
+                             log_writer=log)
+                # What the tool changed is found by diffing the tree,
+                # rather than trusting the touched_files it reports
+                started = time.monotonic()
+                snapshotter = TreeSnapshotter(
+                    tool.project_root,
+                    os.path.join(project.get_state_root(), 'snapshot.json'))
+                before = snapshotter.take()
+                snapshot_duration = time.monotonic() - started
+
+                if save:
+                    watchdog = OperationWatchdog(
+                        operation.pk, tool, tool.get_limits()['time']).start()
+                started = time.monotonic()
+                execution_result = self._execute_cached(tool)
+                operation.tool_duration = time.monotonic() - started
+                # Tools usually stream their log as they go; cached logs
+                # and tools with their own execute() may not have
+                streamed = log.getvalue()
+                if execution_result.log.startswith(streamed):
+                    log.write(execution_result.log[len(streamed):])
+                else:
+                    log.write('\n' + execution_result.log)
+                operation.status = 'F' if execution_result.ok else 'X'
+            except ToolCanceled:
+                pass
+            except Exception:
+                logger.exception("Operation %s crashed", operation.pk)
+                logged = log.getvalue()
+                log.write(('\n' if logged and not logged.endswith('\n') else '') +
+                          traceback.format_exc())
+                operation.status = 'X'
+            if watchdog is not None:
+                watchdog.stop_timer()
+
+            # Actually create, refresh or delete the files on BD,
+            # including those written by failed or canceled runs
+            if before is not None:
+                started = time.monotonic()
+                try:
+                    self._register_changes(operation, snapshotter, before)
+                except Exception:
+                    logger.exception("Operation %s could not register its files",
+                                     operation.pk)
+                    log.write('\n' + traceback.format_exc())
+                    operation.status = 'X'
+                operation.registration_duration = (
+                    snapshot_duration + time.monotonic() - started)
+
+            if tool is not None and tool.cancel_reason == CANCELED:
+                operation.status = 'C'
+                log.write('\nCanceled.')
+            elif tool is not None and tool.cancel_reason == TIMED_OUT:
+                operation.status = 'X'
+                log.write('\nTimed out after %s seconds.' % tool.get_limits()['time'])
+        finally:
+            # The watchdog keeps the heartbeat going until the files are
+            # registered, which may take long on large trees
+            if watchdog is not None:
+                watchdog.close()
+            if oplog is not None:
+                oplog.close()
+
+        operation.log = log.getvalue()
+        operation.finished_at = timezone.now()
         if save:
-            operation.save()
+            started = time.monotonic()
+            self._save_result(operation)
+            operation.save_duration = time.monotonic() - started
+            models.Operation.objects.filter(pk=operation.pk).update(
+                save_duration=operation.save_duration)
+            if operation.status != 'F':
+                Scheduler().cancel_dependents()
         return operation
 
-    @contextmanager
-    def _change_cwd(self, project):
-        prevdir = os.getcwd()
-        newdir = project.get_project_root()
-        os.chdir(os.path.expanduser(newdir))
-        try:
-            yield newdir
-        finally:
-            os.chdir(prevdir)
+    def _save_result(self, operation):
+        """Store the final status and timings of `operation`, unless its
+        status changed meanwhile: it was canceled after its watchdog
+        stopped, or given up as lost by the scheduler (see
+        Scheduler.recover_stale). Then only the timings are stored and
+        `operation` gets the status in the database."""
+        timings = {
+            'tool_duration': operation.tool_duration,
+            'registration_duration': operation.registration_duration,
+        }
+        statuses = ('R', 'C') if operation.status == 'C' else ('R',)
+        if models.Operation.objects.filter(pk=operation.pk, status__in=statuses).update(
+                status=operation.status, finished_at=operation.finished_at, **timings):
+            return
+
+        status = (models.Operation.objects.filter(pk=operation.pk)
+                  .values_list('status', flat=True).first())
+        logger.info("Operation %s became %s while running, not marking it %s",
+                    operation.pk, status, operation.status)
+        models.Operation.objects.filter(pk=operation.pk).update(
+            finished_at=Coalesce('finished_at', Value(operation.finished_at)), **timings)
+        if status is not None:
+            operation.status = status
+
+    def _register_changes(self, operation, snapshotter, before):
+        """Apply to the ProjectFile rows the changes to the project tree
+        since the snapshot `before`."""
+        created, modified, deleted = diff_snapshots(before, snapshotter.take())
+        logger.info("Operation %s created %s, modified %s and deleted %s",
+                    operation.pk, created, modified, deleted)
+        models.ProjectFile.objects.register_paths(operation.project, created + modified)
+        models.ProjectFile.objects.unregister_paths(operation.project, deleted)
+        snapshotter.save()
+
+    def _execute_cached(self, tool, cache=default_result_cache):
+        """Execute `tool`, or reuse the outputs of a previous run on
+        identical inputs when the tool is cacheable."""
+        key = tool.get_cache_key() if cache.enabled else None
+        if key is None:
+            return tool.execute()
+
+        entry = cache.lookup(key)
+        if entry is not None and cache.materialize(entry, tool.project_root):
+            tool.record_inputs()
+            return ExecutionResult(
+                ok=True,
+                log=entry['log'],
+                touched_files=sorted(entry['outputs']),
+            )
+
+        execution_result = tool.execute()
+        # Runs that rebuilt nothing had the same inputs as the previous
+        # one (or only lost some), whose results were cached then
+        rebuilt = execution_result.touched_files or execution_result.rebuilt_files
+        if execution_result.ok and rebuilt:
+            # Failing to cache the results must not fail the run
+            try:
+                outputs = tool.get_all_output_files(execution_result)
+                cache.store(key, execution_result.log, tool.project_root,
+                            outputs, tool.get_output_digests(outputs))
+            except Exception:
+                logger.exception("Could not cache the results of %s", tool.tool_name)
+        return execution_result
 
 
 class MetaTool(type):
@@ -101,7 +338,81 @@ class MetaTool(type):
 
 @six.add_metaclass(MetaTool)
 class Tool(object):
+    """Base class for tools.
+
+    Simple tools only define `params['source_files']` (a glob of their
+    inputs), `process_file` and `get_output_files`, and inherit an
+    `execute` that runs `process_file` on every relevant input. When
+    `incremental` is set, inputs whose fingerprint did not change since
+    they were last processed successfully (and whose outputs exist)
+    are skipped.
+
+    Up to `parallelism` inputs are processed concurrently (it may be
+    overridden per tool through settings.CAVIART_TOOL_PARALLELISM), so
+    `process_file` must be thread-safe. Tools usually spend their time
+    waiting on a subprocess, so threads are enough to use every core.
+
+    Tools run against an explicit `project_root` and must never change
+    the working directory of the process, as several operations may run
+    concurrently in the same worker. File paths handled by tools (inputs,
+    outputs, touched_files) are relative to the project root; use
+    `get_path` to resolve them and pass `cwd=self.project_root` to
+    subprocesses. Existing outputs may be read-only links to shared
+    blobs, so outputs must be written through `atomic_output`.
+
+    Progress should be reported through `log`, which is streamed to
+    clients while the tool runs. The default `execute` logs the result
+    of each input as soon as it and every input before it completed, so
+    the streamed log always matches the final one.
+
+    Tools whose outputs only depend on the contents of their inputs
+    should set `cacheable`: their results are then shared across
+    projects with identical inputs (see resultcache.ResultCache).
+
+    Subprocesses must be started through `run_subprocess`, which runs
+    them in their own process group under the tool's `cpu_time_limit`
+    (seconds) and `memory_limit` (bytes of address space), so that
+    `cancel` can stop them with all their children. An operation is
+    canceled after `time_limit` seconds (see get_limits). Once canceled,
+    no new input is processed and `run_subprocess` raises ToolCanceled.
+
+    Bump `version` whenever a change in the tool makes previous outputs
+    stale."""
     tool_name = 'Unnamed tool'
+    version = '1'
+    params = {}
+    incremental = False
+    parallelism = 1
+    cacheable = False
+    time_limit = None
+    cpu_time_limit = None
+    memory_limit = None
+
+    def __init__(self, project_root, state_root=None, log_writer=None):
+        self.project_root = os.path.abspath(project_root)
+        self.state_root = state_root
+        self.log_writer = log_writer
+        self.cancel_reason = None
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+
+    def log(self, text):
+        """Report `text` as part of the live log of the operation."""
+        if self.log_writer is not None:
+            self.log_writer.write(text)
+
+    def get_path(self, path):
+        """Absolute path of `path`, relative to the project root."""
+        return os.path.join(self.project_root, path)
+
+    def get_input_files(self):
+        """Return the input files of the tool, in a stable order."""
+        pattern = self.params.get('source_files')
+        if pattern is None:
+            return []
+        matches = glob(os.path.join(glob_escape(self.project_root), pattern),
+                       recursive=True)
+        return sorted(os.path.relpath(path, self.project_root) for path in matches)
 
     def get_relevant_files(self, file_set):
         """By default return all files as relevant. This makes the tools
@@ -112,9 +423,254 @@ class Tool(object):
 
         return file_set
 
+    def get_output_files(self, path):
+        """Return the files produced when processing the input `path`."""
+        return []
+
+    def get_parallelism(self):
+        overrides = getattr(settings, 'CAVIART_TOOL_PARALLELISM', {})
+        return max(1, overrides.get(self.tool_name, self.parallelism))
+
+    def get_limits(self):
+        """Resource limits of the tool: 'time' (wall-clock seconds for
+        the whole run), 'cpu_time' (seconds) and 'memory' (bytes) for
+        each subprocess. Overridden per tool by
+        settings.CAVIART_TOOL_LIMITS; None means unlimited."""
+        limits = {
+            'time': self.time_limit or getattr(settings, 'CAVIART_TOOL_TIME_LIMIT', None),
+            'cpu_time': self.cpu_time_limit,
+            'memory': self.memory_limit,
+        }
+        limits.update(getattr(settings, 'CAVIART_TOOL_LIMITS', {}).get(self.tool_name, {}))
+        return limits
+
+    def cancel(self, reason):
+        """Stop the tool: no new input is processed and the process
+        groups of its running subprocesses are terminated, then killed
+        after TERMINATE_GRACE_PERIOD seconds. Safe to call from any
+        thread."""
+        with self._processes_lock:
+            if self.cancel_reason is None:
+                self.cancel_reason = reason
+            processes = list(self._processes)
+        for process in processes:
+            _signal_process_group(process, signal.SIGTERM)
+        deadline = time.monotonic() + TERMINATE_GRACE_PERIOD
+        while (time.monotonic() < deadline and
+               any(process.returncode is None for process in processes)):
+            time.sleep(0.1)
+        for process in processes:
+            if process.returncode is None:
+                _signal_process_group(process, signal.SIGKILL)
+
+    def run_subprocess(self, args, input=None, **kwargs):
+        """Like subprocess.run (without `check` and `timeout`), within
+        the limits of the tool. Raises ToolCanceled if the tool was
+        canceled before or while the subprocess ran."""
+        limits = self.get_limits()
+        kwargs.setdefault('cwd', self.project_root)
+        if input is not None:
+            kwargs['stdin'] = subprocess.PIPE
+
+        with self._processes_lock:
+            if self.cancel_reason is not None:
+                raise ToolCanceled(self.cancel_reason)
+            args, kwargs['shell'] = _limit_args(
+                args, limits['cpu_time'], limits['memory'], kwargs.get('shell', False))
+            process = subprocess.Popen(args, start_new_session=True, **kwargs)
+            self._processes.add(process)
+        try:
+            stdout, stderr = process.communicate(input)
+        except BaseException:
+            _signal_process_group(process, signal.SIGKILL)
+            process.wait()
+            raise
+        finally:
+            with self._processes_lock:
+                self._processes.discard(process)
+
+        if self.cancel_reason is not None:
+            raise ToolCanceled(self.cancel_reason)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    def get_signature(self):
+        """Identify the tool configuration outputs depend on."""
+        return '%s:%s:%s' % (self.tool_name, self.version,
+                             json.dumps(self.params, sort_keys=True))
+
+    def get_all_output_files(self, execution_result):
+        """Return every output of the tool on the current inputs, not
+        only those rebuilt by `execution_result`."""
+        outputs = set(execution_result.touched_files)
+        for path in self.get_relevant_files(self.get_input_files()):
+            outputs.update(output for output in self.get_output_files(path)
+                           if os.path.exists(self.get_path(output)))
+        return sorted(outputs)
+
+    def get_output_digests(self, outputs):
+        """{path: SHA-256} of the files `outputs`. Only those whose size
+        or mtime changed since the last call are hashed again."""
+        fingerprints = self._get_output_hash_store()
+        if fingerprints is None:
+            return {path: hashing.sha256_file(self.get_path(path)) for path in outputs}
+        fingerprints.forget_missing(outputs)
+        for path in outputs:
+            fingerprints.record(path)
+        fingerprints.save()
+        return {path: fingerprints.files[path][2] for path in outputs}
+
+    def get_cache_key(self):
+        """Key identifying the results of the tool on the current
+        inputs, or None if the tool is not cacheable. Inputs are only
+        hashed again when their size or mtime changed."""
+        if not self.cacheable:
+            return None
+        inputs = list(self.get_relevant_files(self.get_input_files()))
+        fingerprints = self._get_input_hash_store()
+        if fingerprints is not None:
+            fingerprints.forget_missing(inputs)
+
+        digest = hashlib.sha256(self.get_signature().encode('utf-8'))
+        for path in inputs:
+            if fingerprints is not None:
+                fingerprints.record(path)
+                content_hash = fingerprints.files[path][2]
+            else:
+                content_hash = hashing.sha256_file(self.get_path(path))
+            digest.update(b'\0' + path.encode('utf-8') + b'\0')
+            digest.update(content_hash.encode('ascii'))
+        if fingerprints is not None:
+            fingerprints.save()
+        return digest.hexdigest()
+
+    def record_inputs(self):
+        """Mark every relevant input as up to date, for outputs that
+        were obtained without running the tool."""
+        fingerprints = self._get_fingerprint_store()
+        if fingerprints is None:
+            return
+        inputs = list(self.get_relevant_files(self.get_input_files()))
+        fingerprints.forget_missing(inputs)
+        for path in inputs:
+            fingerprints.record(path)
+        fingerprints.save()
+
+    def process_file(self, path):
+        """Process a single input file. Returns a FileResult."""
+        raise Exception("You must define either process_file or execute for tool %s." % self._get_tool_name())
+
     def execute(self):
         """Returns an ExecutionResult or the 3-tuple: (status, log, touched_files)"""
-        raise Exception("You must define an execution function for tool %s." % self._get_tool_name())
+        inputs = list(self.get_relevant_files(self.get_input_files()))
+        fingerprints = self._get_fingerprint_store()
+
+        skipped = []
+        if fingerprints is not None:
+            fingerprints.forget_missing(inputs)
+            skipped = [path for path in inputs
+                       if fingerprints.is_up_to_date(path, self.get_output_files(path))]
+        up_to_date = set(skipped)
+        pending = [path for path in inputs if path not in up_to_date]
+
+        ok, logs, touched, rebuilt = True, [], [], []
+        try:
+            for path, result in self._process_files(pending):
+                if result.log:
+                    logs.append(result.log)
+                touched.extend(result.touched_files)
+                if not result.ok:
+                    ok = False
+                    continue
+                rebuilt.append(path)
+                if fingerprints is not None:
+                    fingerprints.record(path)
+        finally:
+            if fingerprints is not None:
+                fingerprints.save()
+
+        logs.append('%d files rebuilt, %d up to date.' % (len(rebuilt), len(skipped)))
+        self.log(logs[-1])
+        return ExecutionResult(
+            ok=ok,
+            log='\n'.join(logs),
+            touched_files=touched,
+            rebuilt_files=rebuilt,
+            skipped_files=skipped,
+        )
+
+    def _process_files(self, paths):
+        """Run process_file on `paths` with a bounded number of them in
+        flight. No new input is started after the first failure.
+
+        Returns (path, FileResult) pairs for every processed input, in
+        input order regardless of completion order."""
+        parallelism = self.get_parallelism()
+        if parallelism == 1:
+            results = []
+            for path in paths:
+                if self.cancel_reason is not None:
+                    raise ToolCanceled(self.cancel_reason)
+                result = self.process_file(path)
+                results.append((path, result))
+                if result.log:
+                    self.log(result.log + '\n')
+                if not result.ok:
+                    break
+            return results
+
+        results = {}
+        logged = 0
+        failed = False
+        pending = iter(enumerate(paths))
+        with ThreadPoolExecutor(max_workers=parallelism) as pool:
+            running = {}
+            while True:
+                while (not failed and self.cancel_reason is None and
+                       len(running) < parallelism):
+                    item = next(pending, None)
+                    if item is None:
+                        break
+                    index, path = item
+                    running[pool.submit(self.process_file, path)] = index
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    results[index] = future.result()
+                    if not results[index].ok:
+                        failed = True
+                while logged in results:
+                    if results[logged].log:
+                        self.log(results[logged].log + '\n')
+                    logged += 1
+
+        if self.cancel_reason is not None:
+            raise ToolCanceled(self.cancel_reason)
+        return [(paths[index], results[index]) for index in sorted(results)]
+
+    def _get_fingerprint_store(self):
+        if not self.incremental or self.state_root is None:
+            return None
+        path = os.path.join(self.state_root, 'fingerprints', self.tool_name + '.json')
+        return FingerprintStore(path, self.get_signature(), self.project_root)
+
+    def _get_input_hash_store(self):
+        """Fingerprints of every current input, whether or not it was
+        processed, so cache keys reuse their hashes."""
+        if self.state_root is None:
+            return None
+        path = os.path.join(self.state_root, 'fingerprints', self.tool_name + '.inputs.json')
+        return FingerprintStore(path, self.get_signature(), self.project_root)
+
+    def _get_output_hash_store(self):
+        """Fingerprints of the outputs last cached, so unchanged ones
+        are not hashed again."""
+        if self.state_root is None:
+            return None
+        path = os.path.join(self.state_root, 'fingerprints', self.tool_name + '.outputs.json')
+        return FingerprintStore(path, self.get_signature(), self.project_root)
 
     def _get_tool_name(self):
         return self.__class__.__qualname__
@@ -123,27 +679,24 @@ class Tool(object):
 
 class FakeClirizeTool(Tool):
     tool_name = 'fake_clirize'
+    incremental = True
+    cacheable = True
+    parallelism = os.cpu_count() or 1
     params = {
         'source_files': '**/*.java',
     }
 
-    def execute(self):
-        created_files = []
-        for file in glob(self.params['source_files'], recursive=True):
-            with open(file) as stdin:
-                p = subprocess.run(['tee', file + '.clir'], stdin=stdin, stderr=subprocess.PIPE, universal_newlines=True)
+    def get_output_files(self, path):
+        return [path + '.clir']
+
+    def process_file(self, path):
+        with open(self.get_path(path)) as stdin, \
+             atomic_output(self.get_path(path + '.clir')) as output:
+            p = self.run_subprocess(['tee', output], stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
             if p.returncode != 0:
-                return ExecutionResult(
-                    ok=False,
-                    log=p.stderr,
-                    touched_files=created_files,
-                )
-            created_files.append(file + '.clir')
-        return ExecutionResult(
-            ok=True,
-            log='All files passed through tee',
-            touched_files=created_files,
-        )
+                os.unlink(output)
+                return FileResult(ok=False, log=p.stderr, touched_files=[])
+        return FileResult(ok=True, log='', touched_files=[path + '.clir'])
 
 
 default_task_queue = TaskQueue()
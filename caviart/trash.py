@@ -0,0 +1,124 @@
+"""Deferred removal of deleted directory trees.
+
+Removing a large project tree takes as long as it has files, so trees
+are not removed when their project is deleted: they are atomically
+renamed into the trash (which lives on the same filesystem as
+MEDIA_ROOT) and purged later in the background, at a bounded rate of
+CAVIART_TRASH_PURGE_RATE files per second so purging does not starve
+the tools and downloads of other projects of disk bandwidth.
+
+Files of a deleted project may still be linked to shared blobs. Once a
+purge removed any of them, unreferenced blobs are collected (see
+storage.BlobStore.collect_garbage).
+
+The purge job also expires abandoned resumable uploads (see
+UploadSessionQuerySet.purge_expired). Besides project deletions, it is
+dispatched when uploads are opened, at most every
+CAVIART_UPLOAD_EXPIRY_INTERVAL seconds; it may also be scheduled
+periodically (e.g. the purge_trash Celery task with celery beat)."""
+
+import fcntl, os, time, uuid
+
+from django.conf import settings
+
+from .storage import default_blob_store
+
+
+PURGE_BATCH_SIZE = 100
+
+
+def get_trash_root():
+    return getattr(settings, 'CAVIART_TRASH_ROOT',
+                   os.path.join(settings.MEDIA_ROOT, '.trash'))
+
+
+def move_to_trash(path):
+    """Atomically move the directory tree at `path` to the trash.
+    Returns whether there was anything to move."""
+    trash_root = get_trash_root()
+    os.makedirs(trash_root, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(
+            trash_root, '%s-%s' % (uuid.uuid4().hex, os.path.basename(path))))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class _Throttle(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.count = 0
+        self.started = time.monotonic()
+
+    def tick(self):
+        self.count += 1
+        if self.rate and self.count % PURGE_BATCH_SIZE == 0:
+            ahead = self.count / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _remove_tree(path, throttle):
+    """Remove the tree at `path` bottom-up. Returns whether any of the
+    removed files was linked elsewhere (e.g. to a blob)."""
+    shared = False
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            filepath = os.path.join(dirpath, name)
+            try:
+                shared |= os.lstat(filepath).st_nlink > 1
+                os.unlink(filepath)
+            except FileNotFoundError:
+                pass
+            throttle.tick()
+        for name in dirnames:
+            dirpath_ = os.path.join(dirpath, name)
+            try:
+                if os.path.islink(dirpath_):
+                    os.unlink(dirpath_)
+                else:
+                    os.rmdir(dirpath_)
+            except FileNotFoundError:
+                pass
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    return shared
+
+
+def purge(rate=None):
+    """Expire abandoned uploads and remove everything in the trash.
+    Returns how many trees were removed, or None if another purge is
+    already running (it will remove what was moved to the trash
+    meanwhile)."""
+    # Imported here: models imports this module
+    from .models import UploadSession
+
+    if rate is None:
+        rate = getattr(settings, 'CAVIART_TRASH_PURGE_RATE', 5000)
+    trash_root = get_trash_root()
+    os.makedirs(trash_root, exist_ok=True)
+    with open(os.path.join(trash_root, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        UploadSession.objects.purge_expired()
+
+        throttle = _Throttle(rate)
+        purged, shared = 0, False
+        while True:
+            entries = [entry for entry in os.scandir(trash_root)
+                       if entry.is_dir(follow_symlinks=False)]
+            if not entries:
+                break
+            for entry in entries:
+                shared |= _remove_tree(entry.path, throttle)
+                purged += 1
+
+        if shared:
+            default_blob_store.collect_garbage()
+        return purged
@@ -8,6 +8,7 @@ from rest_framework_extensions.routers import ExtendedDefaultRouter
 router = ExtendedDefaultRouter(trailing_slash=False)
 router.register(r'auth', JWTKnoxAPIViewSet, base_name='jwt_knox')
 router.register(r'users', viewsets.UserProfileViewSet)
+router.register(r'profiles', viewsets.ProfileViewSet, base_name='profile')
 
 with router.register(r'projects',
                      viewsets.ProjectViewSet,
@@ -1,23 +1,39 @@
 
-from collections import OrderedDict
+import hashlib, math, os, time, uuid
+from collections import Counter
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.functions import Length, Substr
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
 from rest_framework import renderers, status
 from rest_framework.authentication import get_user_model
 from rest_framework.decorators import detail_route, list_route
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.viewsets import ViewSet, ModelViewSet, ReadOnlyModelViewSet
 
-from caviart import models, serializers, tools
+from caviart import hashing, models, pagination, serializers, tools
+from caviart.admission import default_admission_controller
+from caviart.archives import (
+    EXPORT_FORMATS, ArchiveError, extract_archive, list_tree, stream_archive)
+from caviart.backends import get_backend
 from caviart.filters import IsOwnerFilterBackend, ParentLookupMapFilterBackend
+from caviart.http import not_modified_response, serve_file, set_validators
+from caviart.metrics import InstrumentedViewMixin
 from caviart.permissions import IsOwnerOrAdmin
+from caviart.profiling import default_profile_buffer
+from caviart.renderers import EventStreamRenderer
+from caviart.scheduler import Scheduler
 from rest_framework_extensions.mixins import NestedViewSetMixin
 
 
-class UserProfileViewSet(ReadOnlyModelViewSet):
+class UserProfileViewSet(InstrumentedViewMixin, ReadOnlyModelViewSet):
     queryset = get_user_model().objects.all()
     serializer_class = serializers.UserSerializer
     permission_classes = (IsAuthenticated,)
@@ -28,54 +44,358 @@ class UserProfileViewSet(ReadOnlyModelViewSet):
             'msg': 'To test this application send an email to the system administrator. Registrations are disabled for the moment.'})
 
 
-class ProjectViewSet(ModelViewSet):
+class ProjectViewSet(InstrumentedViewMixin, ModelViewSet):
     lookup_url_kwarg = 'project_id'
     queryset = models.Project.objects.all()
     filter_backends = (IsOwnerFilterBackend,)
     permission_classes = (IsOwnerOrAdmin,)
     serializer_class = serializers.ProjectSerializer
+    pagination_class = pagination.ProjectPagination
 
+    def destroy(self, request, *args, **kwargs):
+        """Delete a project, unless some of its operations are queued or
+        running: their tools would keep writing into the tree once it
+        is in the trash. Planned operations are canceled."""
+        instance = self.get_object()
+        with transaction.atomic():
+            # Canceled first, so the scheduler cannot dispatch them
+            models.Operation.objects.filter(project=instance, status='P').update(status='C')
+            if models.Operation.objects.filter(
+                    project=instance, status__in=('Q', 'R')).exists():
+                transaction.set_rollback(True)
+                return Response(
+                    {'detail': 'The project has operations in progress; cancel them first.'},
+                    status=status.HTTP_409_CONFLICT)
+            self.perform_destroy(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def perform_destroy(self, instance):
+        # Deleting the file and operation rows first keeps the cascade
+        # from loading every one of them (and unlinking every file), so
+        # deleting a project takes the same time whatever its size (its
+        # tree is moved to the trash).
+        with transaction.atomic():
+            models.ProjectFile.objects.drop_project(instance)
+            models.Operation.objects.drop_project(instance)
+            instance.delete()
+
+    @detail_route(methods=['post'])
+    def sync(self, request, project_id=None, format=None):
+        """Compare a client manifest (`files`: list of `path` and `hash`,
+        the SHA-256 of the contents) with the project.
+
+        Answers with the paths the client must upload (`upload`: new or
+        changed on the client), those it lacks (`download`: only on the
+        server) and how many are already in sync. With `prune`, files
+        only on the server are deleted instead, so the project mirrors
+        the client."""
+        project = self.get_object()
+        serializer = serializers.SyncManifestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        manifest = {entry['path']: entry['hash']
+                    for entry in serializer.validated_data['files']}
+
+        stored = dict(project.files.values_list('path', 'content_hash'))
+        upload = sorted(path for path, digest in manifest.items()
+                        if stored.get(path) != digest)
+        download = sorted(set(stored) - set(manifest))
+        in_sync = len(manifest) - len(upload)
+
+        deleted = []
+        if serializer.validated_data['prune'] and download:
+            models.ProjectFile.objects.remove_paths(project, download)
+            deleted, download = download, []
+
+        return Response({
+            'upload': upload,
+            'download': download,
+            'deleted': deleted,
+            'in_sync': in_sync,
+        })
 
-class ProjectFileViewSet(NestedViewSetMixin, ModelViewSet):
+    @detail_route(methods=['get'])
+    def download(self, request, project_id=None, format=None):
+        """Download the project tree as a zip or tar.gz archive
+        (`?archive=zip|tar.gz`, zip by default), optionally restricted to
+        the files matching `?glob=` (e.g. `**/*.clir`). The archive is
+        generated while it is being sent."""
+        project = self.get_object()
+        archive_format = request.query_params.get('archive', 'zip')
+        if archive_format not in EXPORT_FORMATS:
+            return Response({'detail': 'Unknown archive format.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            paths = list_tree(project.get_project_root(), request.query_params.get('glob'))
+        except ArchiveError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(
+            stream_archive(project.get_project_root(), paths, archive_format),
+            content_type=EXPORT_FORMATS[archive_format],
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            project, archive_format)
+        return response
+
+
+class ProjectFileViewSet(InstrumentedViewMixin, NestedViewSetMixin, ModelViewSet):
     lookup_field = 'id'
     lookup_url_kwarg = 'file_id'
     parent_lookup_map = { 'project_id': 'project.id' }
-    queryset = models.ProjectFile.objects.all()
+    queryset = models.ProjectFile.objects.select_related('project')
     filter_backends = (IsOwnerFilterBackend, ParentLookupMapFilterBackend,)
     permission_classes = (IsOwnerOrAdmin,)
     serializer_class = serializers.ProjectFileSerializer
+    pagination_class = pagination.ProjectFilePagination
     renderer_classes = (renderers.JSONRenderer, renderers.BrowsableAPIRenderer,)
 
+    @list_route(methods=['post'], url_path='import')
+    def import_archive(self, request, project_id=None, format=None):
+        """Import a whole tree from a tar (optionally compressed) or zip
+        archive sent as the request body. Files are extracted into the
+        project as the body is received and registered in a single
+        transaction.
+
+        `?run=tool1,tool2` plans those operations once the import is
+        done."""
+        project = self.get_project()
+        tool_names = [name for name in request.query_params.get('run', '').split(',') if name]
+        unknown = set(tool_names) - set(tools.default_task_queue.get_registered_tools())
+        if unknown:
+            return Response({'detail': 'Unknown tools: %s.' % ', '.join(sorted(unknown))},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if request.stream is None:
+            return Response({'detail': 'Missing archive.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Admitted once the request is known to be valid, so invalid ones
+        # do not count, but before extracting anything
+        default_admission_controller.admit(request.user, {project.pk: len(tool_names)})
+        paths = []
+        try:
+            extract_archive(request.stream, project.get_project_root(), paths)
+        except ArchiveError as e:
+            # The files extracted before the error stay in the tree
+            models.ProjectFile.objects.register_paths(project, paths)
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            paths = models.ProjectFile.objects.register_paths(project, paths)
+            operations = [
+                models.Operation.objects.create(
+                    type=name, project=project, sent_by=request.user, status='P')
+                for name in tool_names
+            ]
+        return Response({
+            'files': len(paths),
+            'operations': [op.pk for op in operations],
+        }, status=status.HTTP_201_CREATED)
+
+    def get_project(self):
+        """The parent project, checking the user may access it."""
+        project = get_object_or_404(models.Project, pk=self.kwargs['project_id'])
+        self.check_object_permissions(self.request, project)
+        return project
+
+    # The router formats url_path, so it must not contain braces
+    UPLOAD_ID = r'(?P<upload_id>[0-9a-fA-F-]+)'
+    UPLOAD_BUFFER_SIZE = 64 * 1024
+
+    @list_route(methods=['post'], url_path='uploads')
+    def open_upload(self, request, project_id=None, format=None):
+        """Open a resumable upload of `size` bytes to `path`. Chunks are
+        then PUT to uploads/<id>/<index> and the upload committed with a
+        POST to uploads/<id>/commit. Uploads may be resumed after
+        checking which chunks were received with a GET to
+        uploads/<id>."""
+        project = self.get_project()
+        serializer = serializers.UploadSessionSerializer(
+            data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        chunk_size = serializer.validated_data.get(
+            'chunk_size', getattr(settings, 'CAVIART_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+        serializer.save(project=project, created_by=request.user, chunk_size=chunk_size)
+
+        # Abandoned uploads are expired by the purge job
+        interval = getattr(settings, 'CAVIART_UPLOAD_EXPIRY_INTERVAL', 3600)
+        if cache.add('caviart:uploads:expiry', True, interval):
+            get_backend().purge_trash()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @list_route(methods=['get', 'delete'], url_path='uploads/' + UPLOAD_ID)
+    def upload(self, request, project_id=None, upload_id=None, format=None):
+        """Show the state of an upload, or abort it."""
+        session = self.get_upload(upload_id)
+        if request.method == 'DELETE':
+            session.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        serializer = serializers.UploadSessionSerializer(
+            session, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+    @list_route(methods=['put'], url_path='uploads/' + UPLOAD_ID + r'/(?P<chunk_index>[0-9]+)')
+    def upload_chunk(self, request, project_id=None, upload_id=None,
+                     chunk_index=None, format=None):
+        """Write a chunk, sent as the raw request body with its SHA-256
+        in the X-Chunk-Checksum header, at its place in the file."""
+        session = self.get_upload(upload_id)
+        index = int(chunk_index)
+        if index >= session.get_chunk_count():
+            return Response({'detail': 'No such chunk.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        expected = request.META.get('HTTP_X_CHUNK_CHECKSUM', '').lower()
+        if not expected:
+            return Response({'detail': 'Missing X-Chunk-Checksum header.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        length = session.get_chunk_length(index)
+        digest = hashlib.sha256()
+        received = 0
+        stream = request.stream
+        try:
+            partial = open(session.get_partial_path(), 'r+b')
+        except OSError:
+            return self._upload_error_response(session)
+        with partial as f:
+            f.seek(index * session.chunk_size)
+            # Reading one byte past the chunk detects oversized bodies
+            while stream is not None and received <= length:
+                data = stream.read(min(self.UPLOAD_BUFFER_SIZE, length + 1 - received))
+                if not data:
+                    break
+                received += len(data)
+                if received > length:
+                    break
+                digest.update(data)
+                f.write(data)
+
+        error = None
+        if received != length:
+            error = 'Chunk %d must be %d bytes long.' % (index, length)
+        elif digest.hexdigest() != expected:
+            error = 'Checksum mismatch.'
+        if error is not None:
+            # Whatever was received before at this place was overwritten
+            session.chunks.filter(index=index).delete()
+            return Response({'detail': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        models.UploadChunk.objects.update_or_create(
+            session=session, index=index, defaults={'checksum': expected})
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @list_route(methods=['post'], url_path='uploads/' + UPLOAD_ID + '/commit')
+    def commit_upload(self, request, project_id=None, upload_id=None, format=None):
+        """Move a complete upload into place and register the file."""
+        session = self.get_upload(upload_id)
+        received = session.chunks.count()
+        if received != session.get_chunk_count():
+            return Response({'detail': 'Missing %d chunks.' % (session.get_chunk_count() - received)},
+                            status=status.HTTP_409_CONFLICT)
+
+        partial = session.get_partial_path()
+        try:
+            if session.checksum and hashing.sha256_file(partial) != session.checksum.lower():
+                return Response({'detail': 'Checksum mismatch.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            os.replace(partial, os.path.join(session.project.get_project_root(), session.path))
+        except OSError as e:
+            return self._upload_error_response(session, e)
+        with transaction.atomic():
+            models.ProjectFile.objects.register_paths(session.project, [session.path])
+            session.delete()
+        instance = models.ProjectFile.objects.get(project=session.project, path=session.path)
+        serializer = serializers.ProjectFileReadSerializer(
+            instance, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def _upload_error_response(self, session, error=None):
+        """409 answer for an upload whose partial file is gone, or that
+        cannot be moved to its path."""
+        if not os.path.exists(session.get_partial_path()):
+            detail = 'The partial file of the upload is gone; open a new upload.'
+        elif isinstance(error, IsADirectoryError):
+            detail = '%s is a directory.' % session.path
+        else:
+            detail = 'Could not write %s: %s.' % (
+                session.path, error.strerror if error is not None else 'unknown error')
+        return Response({'detail': detail}, status=status.HTTP_409_CONFLICT)
+
+    def get_upload(self, upload_id):
+        session = get_object_or_404(
+            models.UploadSession.objects.select_related('project'),
+            pk=upload_id, project_id=self.kwargs['project_id'])
+        self.check_object_permissions(self.request, session)
+        return session
+
     @detail_route(methods=['get'])
     def raw(self, request, project_id=None, file_id=None, format=None):
         instance = self.get_object()
-        bytes = instance.content.read()
-        instance.content.close()
-        return HttpResponse(bytes, content_type=instance.file_type)
+        etag = instance.get_etag()
+        response = not_modified_response(request, etag, instance.last_mod)
+        if response is not None:
+            return response
+
+        response = serve_file(request, instance.content.path,
+                              instance.file_type, etag=etag)
+        return set_validators(response, etag, instance.last_mod)
 
     def verify(self, request, project_id=None, file_id=None, format=None):
         return Response({'detail': 'Could not verify your file.'}, status=status.HTTP_200_OK)
 
+    def list(self, request, *args, **kwargs):
+        # Every write to the files of a project bumps its files_version,
+        # so the project row alone validates the whole listing.
+        project = self.get_project()
+        etag = self._get_representation_etag(
+            project.pk, project.files_version, request.get_full_path())
+        response = not_modified_response(request, etag, project.files_changed_at)
+        if response is not None:
+            return response
+
+        response = super(ProjectFileViewSet, self).list(request, *args, **kwargs)
+        return set_validators(response, etag, project.files_changed_at)
+
     def retrieve(self, request, project_id=None, file_id=None, format=None):
         instance = self.get_object()
+        etag = self._get_representation_etag(
+            instance.path, instance.file_type, instance.last_mod,
+            instance.content_hash, request.get_full_path())
+        response = not_modified_response(request, etag, instance.last_mod)
+        if response is not None:
+            return response
+
         serializer = self.get_serializer(instance)
         data = serializer.data
-        if not format or format == 'json' or format == 'api':
+        if 'content' in data and (not format or format == 'json' or format == 'api'):
             data['content'] = reverse('projectfile-raw',
                                       request=request,
                                       kwargs={'project_id': project_id,
                                               'file_id': file_id,
                                       })
-        return Response(data)
+        return set_validators(Response(data), etag, instance.last_mod)
+
+    def _get_representation_etag(self, *parts):
+        """Strong ETag for a serialized representation. The negotiated
+        renderer is part of it, as JSON and the browsable API differ."""
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        parts += (renderer.format if renderer else '',)
+        return hashlib.sha1('|'.join(str(part) for part in parts)
+                            .encode('utf-8')).hexdigest()
+
+    def get_queryset(self):
+        queryset = super(ProjectFileViewSet, self).get_queryset()
+        if self.action == 'raw':
+            queryset = queryset.select_related(None).only(
+                'id', 'project', 'content', 'content_hash', 'file_type', 'last_mod')
+        return queryset
 
     def get_serializer_class(self):
         if self.action in ['list', 'retrieve']:
             return serializers.ProjectFileReadSerializer
         return self.serializer_class
 
-from . import tasks
 
-class OperationViewSet(NestedViewSetMixin, ModelViewSet):
+class OperationViewSet(InstrumentedViewMixin, NestedViewSetMixin, ModelViewSet):
     """This implements different Operations that may exist at a given
 point in time.
 
@@ -84,8 +404,11 @@ point in time.
     parent_lookup_map = {
         'project_id': 'project.id',
     }
-    queryset = models.Operation.objects.all()
+    queryset = models.Operation.objects.select_related('project')
+    filter_backends = (IsOwnerFilterBackend, ParentLookupMapFilterBackend,)
+    permission_classes = (IsOwnerOrAdmin,)
     serializer_class = serializers.OperationSerializer
+    pagination_class = pagination.OperationPagination
 
     @list_route(url_path='list')
     def operations(self, request, **kwargs):
@@ -94,21 +417,218 @@ point in time.
             'operations': tool_list,
         })
 
-    def list(self, request, **kwargs):
-        data = super(OperationViewSet, self).list(self, request, **kwargs)
-        response = OrderedDict()
-        response['elements'] = data.data
-        response['operations'] = tools.default_task_queue.get_registered_tools()
-        return Response(response)
+    LOG_POLL_INTERVAL = 0.5
+    LOG_MAX_WAIT = 30
+    LOG_KEEPALIVE = 15
+    BATCH_INSERT_SIZE = 100
+
+    @detail_route(url_path='log', renderer_classes=(
+        renderers.JSONRenderer, renderers.BrowsableAPIRenderer,
+        EventStreamRenderer))
+    def follow_log(self, request, **kwargs):
+        """Follow the log of the operation while it runs.
+
+        Returns the log from the character `offset` on. With `wait`
+        (in seconds), waits for new output or for the operation to end
+        before answering (long polling). Clients accepting
+        `text/event-stream` get server-sent events instead, resuming
+        from `Last-Event-ID`."""
+        operation = self.get_object()
+        offset = (request.query_params.get('offset') or
+                  request.META.get('HTTP_LAST_EVENT_ID') or 0)
+        try:
+            offset = max(int(offset), 0)
+        except ValueError:
+            return Response({'detail': 'Invalid offset.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            return StreamingHttpResponse(
+                self._log_events(operation.pk, offset),
+                content_type=EventStreamRenderer.media_type)
+
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            wait = None
+        if wait is None or not math.isfinite(wait):
+            # min() would let NaN through, which never times out
+            return Response({'detail': 'Invalid wait.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        deadline = time.time() + min(wait, self.LOG_MAX_WAIT)
+        while True:
+            op_status, chunk, offset = self._read_log(operation.pk, offset)
+            finished = op_status in models.Operation.TERMINAL_STATUSES
+            if chunk or finished or time.time() >= deadline:
+                break
+            time.sleep(self.LOG_POLL_INTERVAL)
+
+        return Response({
+            'status': op_status,
+            'finished': finished,
+            'offset': offset,
+            'log': chunk,
+        })
+
+    def _read_log(self, op_id, offset):
+        """Returns the status of the operation, its log from `offset`
+        on, and the new offset, without loading the whole log."""
+        op_status, length, chunk = (
+            models.Operation.objects.filter(pk=op_id)
+            .annotate(log_length=Length('log'), log_tail=Substr('log', offset + 1))
+            .values_list('status', 'log_length', 'log_tail')
+            .get())
+        return op_status, chunk or '', max(length or 0, offset)
+
+    def _log_events(self, op_id, offset):
+        idle = 0
+        while True:
+            op_status, chunk, offset = self._read_log(op_id, offset)
+            if chunk:
+                idle = 0
+                data = ''.join('data: %s\n' % line for line in chunk.split('\n'))
+                yield 'id: %d\n%s\n' % (offset, data)
+            if op_status in models.Operation.TERMINAL_STATUSES:
+                yield 'event: end\ndata: %s\n\n' % op_status
+                return
+            idle += self.LOG_POLL_INTERVAL
+            if idle >= self.LOG_KEEPALIVE:
+                idle = 0
+                yield ': keepalive\n\n'
+            time.sleep(self.LOG_POLL_INTERVAL)
+
+    def get_queryset(self):
+        queryset = super(OperationViewSet, self).get_queryset()
+        if self.action in ('list', 'follow_log', 'rerun', 'cancel'):
+            # Logs may be huge and are only needed when showing a
+            # single operation.
+            queryset = queryset.defer('log')
+        return queryset
 
-    @detail_route()
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return serializers.OperationListSerializer
+        return self.serializer_class
+
+    @detail_route(methods=['post'])
     def rerun(self, request, **kwargs):
-        """Manually request a task to be rerun."""
+        """Manually request a task to be rerun. Only operations that
+        ended can be rerun; they are planned again, without the timings
+        of their previous run, and dispatched by the scheduler like new
+        ones."""
+        op = self.get_object()
+        not_ended = Response({'detail': 'The operation has not ended yet.'},
+                             status=status.HTTP_409_CONFLICT)
+        if op.status not in models.Operation.TERMINAL_STATUSES:
+            return not_ended
+        default_admission_controller.admit(request.user, {op.project_id: 1})
+        planned = models.Operation.objects.filter(
+            pk=op.pk, status__in=models.Operation.TERMINAL_STATUSES,
+        ).update(status='P', queued_at=None, started_at=None, heartbeat_at=None,
+                 finished_at=None, queue_duration=None, tool_duration=None,
+                 registration_duration=None, save_duration=None)
+        if not planned:
+            return not_ended
+        tools.default_task_queue.submit_planned()
+
+        return Response({'status': 'P'})
+
+    @detail_route(methods=['post'])
+    def cancel(self, request, **kwargs):
+        """Cancel a planned, queued or running operation, and the
+        operations depending on it. Running tools are stopped by their
+        worker within CAVIART_CANCEL_POLL_INTERVAL seconds."""
         op = self.get_object()
-        task = tasks.run_tool.delay(op.pk)
+        canceled = models.Operation.objects.filter(
+            pk=op.pk, status__in=('P', 'Q', 'R'),
+        ).update(status='C')
+        if not canceled:
+            return Response({'detail': 'The operation already ended.'},
+                            status=status.HTTP_409_CONFLICT)
+        Scheduler().cancel_dependents()
+        if op.status == 'Q':
+            # A slot was freed (running operations free theirs once
+            # their worker stopped them)
+            tools.default_task_queue.submit_planned()
+        return Response({'status': 'C'})
+
+
+    @list_route(methods=['post'])
+    def batch(self, request, **kwargs):
+        """Create many operations at once from a list of operations as
+        accepted by create. Either every operation is created or none
+        is, and the planned ones are dispatched together once they are
+        committed. Answers with the created operations, in order."""
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of operations.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        max_size = getattr(settings, 'CAVIART_MAX_OPERATIONS_PER_BATCH', 1000)
+        if len(request.data) > max_size:
+            return Response({'detail': 'At most %d operations per batch.' % max_size},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({"running_id": task.id})
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        for project in {item['project'] for item in serializer.validated_data}:
+            self._check_project_owner(project)
+        self._admit(serializer.validated_data)
 
+        # Not every backend returns the ids of bulk-inserted rows
+        # (SQLite, MySQL), so the rows are found back by their batch
+        batch = uuid.uuid4()
+        with transaction.atomic():
+            models.Operation.objects.bulk_create(
+                [models.Operation(sent_by=request.user, status='P', batch=batch, **item)
+                 for item in serializer.validated_data],
+                batch_size=self.BATCH_INSERT_SIZE)
+            operations = list(models.Operation.objects.select_related('project')
+                              .defer('log').filter(batch=batch).order_by('pk'))
+            transaction.on_commit(tools.default_task_queue.submit_planned)
+
+        return Response(
+            serializers.OperationListSerializer(
+                operations, many=True, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED)
 
     def perform_create(self, serializer):
-        obj = serializer.save(sent_by=self.request.user)
+        # New operations are always planned: only the scheduler, rerun
+        # and cancel change the status of an operation
+        self._check_project_owner(serializer.validated_data['project'])
+        self._admit([serializer.validated_data])
+        obj = serializer.save(sent_by=self.request.user, status='P')
+
+    def perform_update(self, serializer):
+        if 'project' in serializer.validated_data:
+            self._check_project_owner(serializer.validated_data['project'])
+        serializer.save()
+
+    def _check_project_owner(self, project):
+        """Operations may only target projects of their sender."""
+        if not (self.request.user.is_superuser or project.is_owner(self.request.user)):
+            raise PermissionDenied('Not an owner of project %s.' % project.pk)
+
+    def _admit(self, items):
+        """Raise Throttled unless the new operations `items` (validated
+        data) fit the admission limits."""
+        counts = Counter(item['project'].pk for item in items)
+        default_admission_controller.admit(self.request.user, counts)
+
+
+class ProfileViewSet(ViewSet):
+    """Request profiles recorded by ProfilingMiddleware, newest first.
+    Profiles are kept in memory by each API process."""
+    permission_classes = (IsAdminUser,)
+
+    def list(self, request, format=None):
+        return Response([
+            {key: value for key, value in entry.items() if key != 'profile'}
+            for entry in default_profile_buffer.entries()])
+
+    def retrieve(self, request, pk=None, format=None):
+        try:
+            entry = default_profile_buffer.get(int(pk))
+        except ValueError:
+            entry = None
+        if entry is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(entry)
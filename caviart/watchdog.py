@@ -0,0 +1,98 @@
+"""Enforcement of cancellation and wall-clock limits on running tools.
+
+While a tool runs, an OperationWatchdog thread polls the status of its
+operation every `poll_interval` seconds. It stops the tool (see
+Tool.cancel) once the operation was canceled through the API or the
+tool ran past its time limit, so hung tools do not hold a worker slot
+forever. The tool is only stopped once, but the watchdog keeps running
+until it is closed.
+
+The watchdog also refreshes the heartbeat of the operation every
+CAVIART_OPERATION_HEARTBEAT_INTERVAL seconds, until the files written
+by the tool are registered: running operations whose heartbeat
+stopped lost their worker, and are marked as crashed by the scheduler
+(see Scheduler.recover_stale)."""
+
+import threading, time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import models
+
+
+CANCELED = 'canceled'
+TIMED_OUT = 'timeout'
+
+
+class OperationWatchdog(object):
+    def __init__(self, operation_id, tool, time_limit=None, poll_interval=None):
+        if poll_interval is None:
+            poll_interval = getattr(settings, 'CAVIART_CANCEL_POLL_INTERVAL', 1.0)
+        self.operation_id = operation_id
+        self.tool = tool
+        self.time_limit = time_limit
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = getattr(
+            settings, 'CAVIART_OPERATION_HEARTBEAT_INTERVAL', 30)
+        self._closed = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._deadline = (time.monotonic() + self.time_limit
+                          if self.time_limit else None)
+        self._heartbeat = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name='watchdog-%s' % self.operation_id)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop_timer(self):
+        """Stop enforcing the time limit once the tool is done, while
+        still watching for cancellation and sending heartbeats."""
+        self._deadline = None
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self):
+        """Stop the tool if it must and was not stopped yet, and send a
+        heartbeat when due. Returns whether the tool was stopped now."""
+        stopped = not self._stopped and self._should_stop()
+        if time.monotonic() - self._heartbeat >= self.heartbeat_interval:
+            self._heartbeat = time.monotonic()
+            models.Operation.objects.filter(pk=self.operation_id, status='R').update(
+                heartbeat_at=timezone.now())
+        return stopped
+
+    def _should_stop(self):
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            reason = TIMED_OUT
+        elif models.Operation.objects.filter(pk=self.operation_id, status='C').exists():
+            reason = CANCELED
+        else:
+            return False
+        self._stopped = True
+        self.tool.cancel(reason)
+        return True
+
+    def _run(self):
+        try:
+            # Heartbeats go on after the tool is stopped, while its
+            # files are registered and its result saved
+            while not self._closed.wait(self.poll_interval):
+                self.check()
+        finally:
+            # This thread owns its own database connection
+            connection.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()